@@ -1,106 +1,149 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import plotly.express as px
 
+from core.cube import rollup, time_rollup
+from core.data import data_available
+from core.filters import filter_key, load_cube_index, load_data_index
+from core.memory import memory_panel
+from core.metrics import debug_panel, stage, start_page
+from core.progressive import progressive_select, progressive_toggle
+from core.reduce import (box_figure, histogram_figure, limit_categories,
+                         line_figure, scatter_figure)
+from core.sketches import (approximate_title, approximate_toggle, ranking,
+                            sketch_selection)
+from core.ui import granularity_select, lazy_tabs, memoize, plotly_chart
+
 # 📌 🚀 Page Configuration
 st.set_page_config(page_title="Purchase Dashboard", layout="wide")
+start_page("home")
 
-# 📌 🚀 Function to Load Data
-
-
-@st.cache_data
-def load_data():
-    file_path = "df_new_3.csv"  # Replace with the correct path
-    try:
-        df = pd.read_csv(file_path)
-        df["Creation Date"] = pd.to_datetime(
-            df["Creation Date"], errors='coerce')
-        return df
-    except FileNotFoundError:
-        st.error("Error: File 'df_new_3.csv' not found!")
-        return pd.DataFrame()  # Returns an empty DataFrame
-
-
-# Load the data
-df = load_data()
-
-if df.empty:
+# Check the shared dataset
+if not data_available():
     st.warning("No data available for display.")
     st.stop()
 
+with stage("load"):
+    data_index = load_data_index()
+    cube_index = load_cube_index()
+
 # 📌 🚀 Create Interactive Filters
 st.sidebar.header("Filters")
 selected_department = st.sidebar.multiselect(
-    "Select Department", df["Department"].unique())
+    "Select Department", data_index.options("Department"))
 selected_supplier = st.sidebar.multiselect(
-    "Select Supplier", df["Supplier Name"].unique())
+    "Select Supplier", data_index.options("Supplier Name"))
 date_range = st.sidebar.date_input("Select Date Range", [])
+granularity = granularity_select()
+approximate = approximate_toggle()
+progressive = progressive_toggle()
+memory_panel()
 
 # Apply filters if selected
-filtered_df = df.copy()
-if selected_department:
-    filtered_df = filtered_df[filtered_df["Department"].isin(
-        selected_department)]
-if selected_supplier:
-    filtered_df = filtered_df[filtered_df["Supplier Name"].isin(
-        selected_supplier)]
-if date_range:
-    filtered_df = filtered_df[(filtered_df["Creation Date"] >= pd.to_datetime(date_range[0])) &
-                              (filtered_df["Creation Date"] <= pd.to_datetime(date_range[1]))]
+filters = {"Department": selected_department,
+           "Supplier Name": selected_supplier}
+with stage("filter"):
+    sketches = sketch_selection(filters, date_range, approximate)
+    filter_state = filter_key(filters, date_range, granularity=granularity,
+                              approximate=sketches is not None)
+    cube_selection = progressive_select(cube_index, filters, date_range, progressive)
+    # Row-level data is only materialised by the distribution charts
+    filtered_rows = progressive_select(data_index, filters, date_range, progressive,
+                                       rows=True)
 
 # 📌 🚀 Create Tabs for Organization
-tabs = st.tabs(["📊 Overview", "🔍 Purchase Analysis",
-               "📈 Department Comparison", "📉 Trends and Evolution"])
-
-with tabs[0]:
-    st.title("📊 Purchase Overview")
-    col1, col2, col3, col4 = st.columns(4)
-    col1.metric("💰 Total Purchases (€)",
-                f"€{filtered_df['Extended Price'].sum():,.2f}")
-    col2.metric("📦 Total Orders", filtered_df.shape[0])
-    col3.metric("🏭 Suppliers", filtered_df["Supplier Name"].nunique())
-    col4.metric("🏢 Departments", filtered_df["Department"].nunique())
-
-    # Purchase trend over time
-    st.subheader("📅 Purchase Evolution")
-    df_time_series = filtered_df.groupby(filtered_df["Creation Date"].dt.to_period(
-        "M")).agg({"Extended Price": "sum"}).reset_index()
-    df_time_series["Creation Date"] = df_time_series["Creation Date"].astype(
-        str)
-    fig_time_series = px.line(df_time_series, x="Creation Date",
-                              y="Extended Price", title="Purchase Evolution Over Time")
-    st.plotly_chart(fig_time_series)
-
-with tabs[1]:
-    st.subheader("🔍 Purchase Analysis")
-    fig = px.bar(filtered_df, x="Supplier Name", y="Extended Price", color="Department",
+tabs = lazy_tabs(["📊 Overview", "🔍 Purchase Analysis",
+                  "📈 Department Comparison", "📉 Trends and Evolution"], key="home_tabs")
+
+
+def overview():
+    totals = rollup(cube_selection, [], {"Extended Price": ("Extended Price", "sum"),
+                                         "Orders": ("Extended Price", "lines")})
+    if sketches is None:
+        suppliers = cube_selection.nunique("Supplier Name")
+        departments = cube_selection.nunique("Department")
+    else:
+        suppliers = sketches.nunique("Supplier Name")
+        departments = sketches.nunique("Department")
+
+    df_time_series = time_rollup(cube_selection, ["Creation Date"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    fig_time_series = line_figure(df_time_series, x="Creation Date",
+                                  y="Extended Price", title="Purchase Evolution Over Time")
+    return totals.iloc[0], suppliers, departments, fig_time_series
+
+
+def purchase_analysis():
+    df_supplier_department = rollup(cube_selection, ["Supplier Name", "Department"], {
+        "Extended Price": ("Extended Price", "sum")})
+    df_supplier_department = limit_categories(
+        df_supplier_department, "Supplier Name", "Extended Price", limit=50)
+    fig = px.bar(df_supplier_department, x="Supplier Name", y="Extended Price", color="Department",
                  title="Total Purchases by Supplier", height=500)
-    st.plotly_chart(fig)
 
-    # Interactive scatter plot
-    st.subheader("📊 Relationship Between Quantity and Unit Price")
-    fig_scatter = px.scatter(filtered_df, x="Quantity", y="Unit Price", size="Extended Price", color="Department",
-                             title="Quantity vs. Unit Price", hover_name="Supplier Name")
-    st.plotly_chart(fig_scatter)
+    fig_scatter = scatter_figure(filtered_rows.frame, x="Quantity", y="Unit Price", size="Extended Price", color="Department",
+                                 title="Quantity vs. Unit Price", hover_name="Supplier Name")
+    return fig, fig_scatter
+
 
-with tabs[2]:
-    st.subheader("📈 Department Comparison")
-    top_departments = filtered_df["Department"].value_counts().reset_index()
+def department_comparison():
+    top_departments = ranking(cube_selection, sketches, "Department", 10)
     top_departments.columns = ["Department", "Number of Purchases"]
-    fig_bar_interactive = px.bar(top_departments.head(10), x="Number of Purchases", y="Department", orientation='h',
-                                 color="Number of Purchases", title="Comparison of Purchases by Department", height=500)
-    st.plotly_chart(fig_bar_interactive)
-
-    # Interactive distribution plot
-    st.subheader("📊 Purchase Value Distribution")
-    fig_hist = px.histogram(filtered_df, x="Extended Price",
-                            nbins=20, title="Distribution of Purchase Values")
-    st.plotly_chart(fig_hist)
-
-with tabs[3]:
-    st.subheader("📉 Trends and Evolution")
-    fig_trend = px.box(filtered_df, x="Department", y="Extended Price",
-                       color="Department", title="Expense Variation by Department")
-    st.plotly_chart(fig_trend)
+    fig_bar_interactive = px.bar(top_departments, x="Number of Purchases", y="Department", orientation='h',
+                                 color="Number of Purchases", title=approximate_title("Comparison of Purchases by Department", top_departments), height=500)
+
+    fig_hist = histogram_figure(filtered_rows.frame, x="Extended Price",
+                                nbins=20, title="Distribution of Purchase Values")
+    return fig_bar_interactive, fig_hist
+
+
+def trends_and_evolution():
+    return box_figure(filtered_rows.frame, x="Department", y="Extended Price",
+                      title="Expense Variation by Department")
+
+
+if tabs[0].open:
+    with tabs[0]:
+        st.title("📊 Purchase Overview")
+        totals, suppliers, departments, fig_time_series = memoize(
+            "home/overview", filter_state, overview)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("💰 Total Purchases (€)",
+                    f"€{totals['Extended Price']:,.2f}")
+        col2.metric("📦 Total Orders", int(totals["Orders"]))
+        col3.metric("🏭 Suppliers", str(suppliers))
+        col4.metric("🏢 Departments", str(departments))
+
+        # Purchase trend over time
+        st.subheader("📅 Purchase Evolution")
+        plotly_chart(fig_time_series)
+
+if tabs[1].open:
+    with tabs[1]:
+        fig, fig_scatter = memoize(
+            "home/purchase_analysis", filter_state, purchase_analysis)
+        st.subheader("🔍 Purchase Analysis")
+        plotly_chart(fig)
+
+        # Interactive scatter plot
+        st.subheader("📊 Relationship Between Quantity and Unit Price")
+        plotly_chart(fig_scatter)
+
+if tabs[2].open:
+    with tabs[2]:
+        fig_bar_interactive, fig_hist = memoize(
+            "home/department_comparison", filter_state, department_comparison)
+        st.subheader("📈 Department Comparison")
+        plotly_chart(fig_bar_interactive)
+
+        # Interactive distribution plot
+        st.subheader("📊 Purchase Value Distribution")
+        plotly_chart(fig_hist)
+
+if tabs[3].open:
+    with tabs[3]:
+        fig_trend = memoize("home/trends_and_evolution",
+                            filter_state, trends_and_evolution)
+        st.subheader("📉 Trends and Evolution")
+        plotly_chart(fig_trend)
+
+debug_panel()
@@ -0,0 +1 @@
+"""Shared data and analytics helpers used by every dashboard page."""
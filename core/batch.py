@@ -0,0 +1,328 @@
+"""Headless batch rendering of dashboard snapshots.
+
+Most mornings start from the same few views, so instead of computing them
+live on the server this renders a configured set of presets ahead of time.
+A preset names a page and its sidebar filters; each is run in its own
+process, in parallel, with Streamlit's AppTest through every tab, so the
+results come from the page code itself. Every tab result is then written
+under ``BATCH_DIR/<dataset version>/``:
+
+* ``results/<digest>.pkl``: the result as :func:`core.ui.memoize` returns
+  it, keyed by tab name and filter state. The dashboard serves it instead
+  of computing whenever a user's filters match a preset, and computes live
+  as soon as they differ or new data is ingested;
+* ``<preset>/<tab>.html`` / ``.png`` / ``.parquet``: each chart as static
+  HTML, as an image (needs the optional ``kaleido`` package) and its trace
+  data, and each table as Parquet, for reading outside the dashboard.
+
+``latest.json`` describes the newest run; older versions are removed.
+Presets come from a JSON list (``--config``) of objects with a ``name``, a
+``page`` (a word of the page file name) and optional ``filters`` mapping
+sidebar widget labels to values, date ranges as ISO dates::
+
+    [{"name": "home-2024", "page": "Home",
+      "filters": {"Select Date Range": ["2024-01-01", "2024-12-31"]}}]
+
+Usage::
+
+    python -m core.batch [--config presets.json] [--jobs 3]
+        [--formats html,png,parquet] [--out DIR]
+"""
+import argparse
+import datetime
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from core.data import DATASET_DIR
+
+BATCH_DIR = os.environ.get("M3_BATCH_DIR", os.path.join(DATASET_DIR, "batch"))
+DEFAULT_PRESETS = [{"name": "home", "page": "Home"},
+                   {"name": "suppliers", "page": "Supplier"},
+                   {"name": "seasonality", "page": "Seasonality"}]
+FORMATS = ["html", "png", "parquet"]
+WIDGET_KINDS = ["multiselect", "selectbox", "date_input", "toggle"]
+LATEST_NAME = "latest.json"
+RESULT_MARKER = "BATCH "
+
+
+def version_dir(version, batch_dir=BATCH_DIR):
+    return os.path.join(batch_dir, f"{version:05d}")
+
+
+def result_path(name, state, version, batch_dir=BATCH_DIR):
+    """Stored result of tab ``name`` for filter ``state`` at ``version``."""
+    digest = hashlib.sha1(repr((name, state)).encode()).hexdigest()[:20]
+    return os.path.join(version_dir(version, batch_dir), "results",
+                        f"{digest}.pkl")
+
+
+def load_result(name, state, version, batch_dir=BATCH_DIR):
+    """The batch-rendered result for ``name`` and ``state``, or None.
+
+    The files are written by this module only and trusted like the rest of
+    the dataset directory.
+    """
+    path = result_path(name, state, version, batch_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as handle:
+        return pickle.load(handle)
+
+
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def figure_frame(fig):
+    """Long-form ``trace, x, y`` frame of the point data of ``fig``."""
+    parts = []
+    for index, trace in enumerate(fig.data):
+        x, y = getattr(trace, "x", None), getattr(trace, "y", None)
+        if x is None or y is None or len(x) != len(y):
+            continue  # Heatmaps and server-side box statistics.
+        parts.append(pd.DataFrame({"trace": trace.name or f"trace {index}",
+                                   "x": list(x), "y": list(y)}))
+    if not parts:
+        return None
+    frame = pd.concat(parts, ignore_index=True)
+    for column in ("x", "y"):
+        if frame[column].dtype == object:  # Mixed types do not fit Arrow.
+            frame[column] = frame[column].astype(str)
+    return frame
+
+
+def export_result(result, path, formats):
+    """Write the parts of one tab result as ``path`` + extension.
+
+    Returns the files written and the scalar values (KPIs), by part name.
+    """
+    from plotly.basedatatypes import BaseFigure
+
+    # A plain tuple holds several parts; an ``Estimate`` is a single value.
+    parts = result if type(result) is tuple else (result,)
+    files, values = [], {}
+    for number, part in enumerate(parts, start=1):
+        stem = f"{path}-{number}" if len(parts) > 1 else path
+        if isinstance(part, pd.Series):
+            part = part.to_frame(part.name or "value")
+        if isinstance(part, BaseFigure):
+            frame = figure_frame(part) if "parquet" in formats else None
+            if "html" in formats:
+                files.append(stem + ".html")
+                part.write_html(files[-1], include_plotlyjs="directory")
+            if "png" in formats:
+                files.append(stem + ".png")
+                part.write_image(files[-1])
+        elif isinstance(part, pd.DataFrame):
+            frame = part
+        elif hasattr(part, "savefig"):  # A Matplotlib figure.
+            if "png" in formats:
+                files.append(stem + ".png")
+                part.savefig(files[-1])
+            continue
+        else:
+            values[os.path.basename(stem)] = str(part)
+            continue
+        if frame is not None:
+            files.append(stem + ".parquet")
+            frame.to_parquet(files[-1])
+    return files, values
+
+
+def page_file(word):
+    """The page whose file name contains ``word``."""
+    from core.bench import PAGES
+
+    for page in PAGES:
+        if word.lower() in os.path.basename(page).lower():
+            return page
+    raise ValueError(f"No page matches {word!r}")
+
+
+def set_filters(app, filters):
+    """Set the sidebar widgets of ``app`` named in ``filters``."""
+    remaining = dict(filters)
+    for kind in WIDGET_KINDS:
+        for widget in getattr(app.sidebar, kind):
+            if widget.label not in remaining:
+                continue
+            value = remaining.pop(widget.label)
+            if kind == "date_input":
+                value = tuple(datetime.date.fromisoformat(day)
+                              for day in value)
+            widget.set_value(value)
+    if remaining:
+        raise ValueError(f"Unknown sidebar filters: {', '.join(remaining)}")
+
+
+def render_preset(preset, batch_dir, formats):
+    """Run ``preset`` through every tab and write its results."""
+    from streamlit.testing.v1 import AppTest
+
+    from core.bench import PAGE_TIMEOUT, each_tab
+    from core.results import result_cache
+
+    start = time.perf_counter()
+    page = page_file(preset["page"])
+    app = AppTest.from_file(page, default_timeout=PAGE_TIMEOUT).run()
+    if preset.get("filters"):
+        set_filters(app, preset["filters"])
+        app.run()
+        # Keep only what the preset's own filter state computes.
+        result_cache().clear()
+        app.run()
+    for _ in each_tab(app):
+        app.run()
+    errors = [str(element.value) for element in
+              list(app.exception) + list(app.error)]
+
+    version, items = result_cache().items()
+    preset_dir = os.path.join(version_dir(version, batch_dir), preset["name"])
+    os.makedirs(preset_dir, exist_ok=True)
+    files, values = [], {}
+    for (name, state), result in items:
+        _write_atomic(result_path(name, state, version, batch_dir),
+                      lambda path: _dump(result, path))
+        written, scalars = export_result(
+            result, os.path.join(preset_dir, name.replace("/", "-")),
+            formats)
+        files += [os.path.relpath(path, batch_dir) for path in written]
+        values.update(scalars)
+    return {"name": preset["name"], "page": os.path.basename(page),
+            "filters": preset.get("filters", {}), "version": version,
+            "tabs": len(items), "files": files, "values": values,
+            "errors": errors, "seconds": time.perf_counter() - start}
+
+
+def _dump(result, path):
+    with open(path, "wb") as handle:
+        pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _child(preset, batch_dir, formats):
+    """Render ``preset`` in a fresh process; returns its manifest entry."""
+    from core.bench import REPO_DIR
+
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+        filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")]))}
+    completed = subprocess.run(
+        [sys.executable, "-m", "core.batch", "preset", json.dumps(preset),
+         batch_dir, ",".join(formats)],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    error = completed.stderr.strip().splitlines()[-1:] or ["no result"]
+    return {"name": preset["name"], "page": preset["page"], "files": [],
+            "values": {}, "errors": error, "seconds": float("nan")}
+
+
+def remove_versions(batch_dir, current):
+    """Delete the rendered results of dataset versions before ``current``."""
+    for name in os.listdir(batch_dir):
+        if name.isdigit() and int(name) < current:
+            shutil.rmtree(os.path.join(batch_dir, name), ignore_errors=True)
+
+
+def render(presets, batch_dir=BATCH_DIR, jobs=None, formats=FORMATS):
+    """Render ``presets`` in parallel; returns the run's manifest."""
+    from core.cube import ensure_cube
+    from core.data import dataset_version
+    from core.sketches import ensure_sketches
+
+    # Ingest once up front rather than racing in every child.
+    ensure_cube()
+    ensure_sketches()
+    version = dataset_version()
+    taken_at = datetime.datetime.now().isoformat(timespec="seconds")
+    with ThreadPoolExecutor(max_workers=jobs or len(presets)) as pool:
+        entries = list(pool.map(
+            lambda preset: _child(preset, batch_dir, formats), presets))
+    manifest = {"version": version, "taken_at": taken_at, "presets": entries}
+    for directory in (version_dir(version, batch_dir), batch_dir):
+        _write_atomic(os.path.join(directory, LATEST_NAME),
+                      lambda path: _write_json(manifest, path))
+    remove_versions(batch_dir, version)
+    return manifest
+
+
+def _write_json(manifest, path):
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+
+
+def _report(entry):
+    print(RESULT_MARKER + json.dumps(entry), flush=True)
+    # Background model fits started by the pages would keep this process,
+    # and its output pipe, alive.
+    os._exit(0)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["preset"]:
+        preset, batch_dir, formats = argv[1:4]
+        _report(render_preset(json.loads(preset), batch_dir,
+                              formats.split(",")))
+
+    parser = argparse.ArgumentParser(
+        prog="python -m core.batch",
+        description="Render dashboard presets to static snapshots.")
+    parser.add_argument("--config",
+                        help="JSON list of presets (default: home, "
+                             "suppliers and seasonality, unfiltered)")
+    parser.add_argument("--jobs", type=int,
+                        help="presets rendered at once (default: all)")
+    parser.add_argument("--formats", default=None,
+                        help=f"comma-separated, from {', '.join(FORMATS)} "
+                             "(default: all available)")
+    parser.add_argument("--out", default=BATCH_DIR,
+                        help="output directory; the dashboard serves "
+                             "snapshots from M3_BATCH_DIR")
+    args = parser.parse_args(argv)
+
+    has_kaleido = importlib.util.find_spec("kaleido") is not None
+    if args.formats is None:
+        formats = [kind for kind in FORMATS if kind != "png" or has_kaleido]
+    else:
+        formats = [kind for kind in args.formats.split(",") if kind]
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+        if "png" in formats and not has_kaleido:
+            parser.error("PNG export needs the kaleido package")
+    presets = DEFAULT_PRESETS
+    if args.config:
+        with open(args.config, encoding="utf-8") as handle:
+            presets = json.load(handle)
+    for preset in presets:
+        page_file(preset["page"])  # Fail early on a typo.
+
+    manifest = render(presets, os.path.abspath(args.out), args.jobs, formats)
+    failed = 0
+    for entry in manifest["presets"]:
+        print(f"{entry['name']:<16} {entry['seconds']:8.3f}s "
+              f"{len(entry['files']):4d} files")
+        for error in entry["errors"]:
+            failed += 1
+            print(f"  error: {error}")
+    print(f"Snapshots of dataset version {manifest['version']} in "
+          f"{version_dir(manifest['version'], os.path.abspath(args.out))}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
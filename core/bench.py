@@ -0,0 +1,227 @@
+"""Headless benchmark of the dashboard pages.
+
+For each extract size a synthetic extract is generated (``core.synthetic``,
+cached in the work directory) and ingested. Then every page is driven with
+Streamlit's AppTest, in a fresh process per page and query backend, so
+caches start cold and peak memory is the page's own. Each page records:
+
+* ``load``: the first run, including loading the shared data;
+* ``rerun``: a rerun with nothing changed;
+* ``filter`` / ``date range`` / ``clear filter``: the first sidebar
+  multiselect set to its first option, the date range set to the last 90
+  days of data, then the multiselect cleared;
+* ``tab <label>``: switching to each further tab.
+
+Results are written as CSV with one row per step. A page or ingest process
+that fails is recorded as one step with the end of its stderr in ``error``,
+reported, and makes the run exit non-zero, as does comparing against an
+earlier results file and finding steps that got slower.
+
+Usage::
+
+    python -m core.bench --rows 100k,1m --backends pandas,duckdb
+        [--out bench-results.csv] [--baseline old.csv] [--tolerance 0.2]
+"""
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = [os.path.join(REPO_DIR, "01_Home.py")] + sorted(
+    glob.glob(os.path.join(REPO_DIR, "pages", "*.py")))
+BACKENDS = ["pandas", "arrow", "duckdb"]
+PAGE_TIMEOUT = int(os.environ.get("M3_BENCH_TIMEOUT", "600"))
+RESULT_MARKER = "BENCH "
+# Lines of a failed child's stderr kept in its report.
+STDERR_LINES = 20
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def each_tab(app):
+    """Switch ``app`` to each tab after the first; yields the tab labels.
+
+    The caller reruns the app after each switch.
+    """
+    tab_keys = [key for key in app.session_state.keys()
+                if key.endswith("_tabs")]
+    if tab_keys:
+        for tab in list(app.tabs)[1:]:
+            app.session_state[tab_keys[0]] = tab.label
+            yield tab.label
+
+
+def drive_page(page, date_range):
+    """Run ``page`` through the benchmark steps; returns one dict per step."""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(page, default_timeout=PAGE_TIMEOUT)
+    steps = []
+
+    def run(step, widget=None):
+        start = time.perf_counter()
+        (widget or app).run()
+        steps.append({"step": step, "seconds": time.perf_counter() - start,
+                      "errors": len(app.exception) + len(app.error)})
+
+    run("load")
+    run("rerun")
+    if len(app.sidebar.multiselect) and app.sidebar.multiselect[0].options:
+        first = app.sidebar.multiselect[0]
+        run("filter", first.select(first.options[0]))
+    if len(app.sidebar.date_input):
+        run("date range", app.sidebar.date_input[0].set_value(date_range))
+    if len(app.sidebar.multiselect) and app.sidebar.multiselect[0].value:
+        run("clear filter", app.sidebar.multiselect[0].set_value([]))
+    for label in each_tab(app):
+        run(f"tab {label}")
+    return steps
+
+
+def _child(command, env, workdir):
+    """Run ``python -m core.bench <command>`` and return its results."""
+    env = {**os.environ, **env,
+           "PYTHONPATH": os.pathsep.join(
+               filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")]))}
+    completed = subprocess.run(
+        [sys.executable, "-m", "core.bench"] + command, cwd=workdir, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if completed.returncode == 0:
+        for line in completed.stdout.splitlines():
+            if line.startswith(RESULT_MARKER):
+                return json.loads(line[len(RESULT_MARKER):])
+    stderr = completed.stderr.strip().splitlines()[-STDERR_LINES:]
+    error = "\n".join(stderr) or f"exit code {completed.returncode}, no result"
+    return [{"step": command[0], "seconds": float("nan"), "errors": 1,
+             "peak_rss_mb": float("nan"), "error": error}]
+
+
+def _report(results):
+    print(RESULT_MARKER + json.dumps(results), flush=True)
+    # Background model fits must not hold up the measurement process, and
+    # their pool workers would keep its output pipe open.
+    for child in multiprocessing.active_children():
+        child.terminate()
+    os._exit(0)
+
+
+def run_benchmark(sizes, backends, workdir, pages=PAGES):
+    """Benchmark every page for each size and backend; returns a frame."""
+    from core.data import read_manifest
+    from core.synthetic import parse_rows, write_extract
+
+    rows = []
+    os.makedirs(workdir, exist_ok=True)
+    for size in sizes:
+        lines = parse_rows(size)
+        csv_path = os.path.abspath(os.path.join(workdir, f"extract-{size}.csv"))
+        dataset_dir = os.path.abspath(os.path.join(workdir,
+                                                   f"dataset-{size}"))
+        if not os.path.exists(csv_path):
+            print(f"Generating {lines} order lines...", flush=True)
+            write_extract(csv_path, lines)
+        env = {"M3_CSV_PATH": csv_path, "M3_DATASET_DIR": dataset_dir}
+        ingested = _child(["ingest"], env, workdir)
+        rows += [{"rows": lines, "backend": "", "page": "", **result}
+                 for result in ingested]
+        if any("error" in result for result in ingested):
+            continue
+
+        watermark = pd.Timestamp(read_manifest(dataset_dir)["watermark"])
+        date_range = [(watermark - pd.Timedelta(days=90)).date().isoformat(),
+                      watermark.date().isoformat()]
+        for backend in backends:
+            for page in pages:
+                name = os.path.basename(page)
+                print(f"{size} {backend} {name}", flush=True)
+                results = _child(["page", page] + date_range,
+                                 {**env, "M3_QUERY_BACKEND": backend}, workdir)
+                rows += [{"rows": lines, "backend": backend, "page": name,
+                          **result} for result in results]
+    return pd.DataFrame(rows)
+
+
+def regressions(results, baseline, tolerance=0.2):
+    """Steps more than ``tolerance`` slower than in ``baseline``."""
+    keys = ["rows", "backend", "page", "step"]
+    merged = results.merge(baseline[keys + ["seconds"]], on=keys,
+                           suffixes=("", "_baseline"))
+    merged["ratio"] = merged["seconds"] / merged["seconds_baseline"]
+    return merged[merged["ratio"] > 1 + tolerance]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["ingest"]:
+        from core.cube import ensure_cube
+        start = time.perf_counter()
+        ensure_cube()
+        _report([{"step": "ingest", "seconds": time.perf_counter() - start,
+                  "errors": 0, "peak_rss_mb": peak_rss_mb()}])
+    if argv[:1] == ["page"]:
+        page, start, end = argv[1:4]
+        steps = drive_page(page, tuple(datetime.date.fromisoformat(day)
+                                       for day in (start, end)))
+        _report([{**step, "peak_rss_mb": peak_rss_mb()} for step in steps])
+
+    parser = argparse.ArgumentParser(
+        prog="python -m core.bench",
+        description="Benchmark the dashboard pages headlessly.")
+    parser.add_argument("--rows", default="100k",
+                        help="comma-separated sizes, e.g. 100k,1m,10m")
+    parser.add_argument("--backends", default="pandas",
+                        help=f"comma-separated, from {', '.join(BACKENDS)}")
+    parser.add_argument("--pages", default="",
+                        help="only pages whose file name contains one of "
+                             "these comma-separated words")
+    parser.add_argument("--workdir", default="bench-data")
+    parser.add_argument("--out", default="bench-results.csv")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    words = [word for word in args.pages.split(",") if word]
+    pages = [page for page in PAGES
+             if not words or any(word in os.path.basename(page)
+                                 for word in words)]
+    results = run_benchmark(args.rows.split(","), args.backends.split(","),
+                            args.workdir, pages)
+    results.to_csv(args.out, index=False)
+    summary = results.pivot_table(index=["rows", "page", "step"],
+                                  columns="backend", values="seconds",
+                                  aggfunc="first", sort=False)
+    print(summary.round(3).to_string())
+    print(results.groupby(["rows", "backend"])["peak_rss_mb"].max()
+          .round(1).to_string())
+    failed = results[results["error"].notna()] if "error" in results \
+        else results.iloc[:0]
+    for failure in failed.itertuples():
+        print(f"Failed: {failure.rows} {failure.backend} {failure.page} "
+              f"{failure.step}\n{failure.error}")
+    if args.baseline:
+        slower = regressions(results, pd.read_csv(args.baseline),
+                             args.tolerance)
+        if len(slower):
+            print("Slower than the baseline:")
+            print(slower[["rows", "backend", "page", "step", "seconds",
+                          "seconds_baseline", "ratio"]].round(3).to_string(
+                index=False))
+            return 1
+    return 1 if len(failed) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
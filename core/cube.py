@@ -0,0 +1,395 @@
+"""Daily rollup cuboids over the dashboard dimensions.
+
+Every chart on the pages is a sum, count, min, max or mean of a measure
+grouped by some mix of ``Creation Date`` and the categorical dimensions. A
+cuboid keeps, per day and per observed combination of a few dimensions, the
+number of order lines plus sum/count/min/max/sum of squares for each
+measure, so those groupbys can be answered without touching the row-level
+data. Keyed on every dimension at once a day barely aggregates anything, so
+the cube is a set of small cuboids instead (``CUBOIDS``): the day alone, the
+day with each dimension, and the few combinations the pages group or filter
+by together. A query reads the smallest cuboid holding its group and filter
+columns (see :class:`core.filters.CubeSelection`). The cuboids are stored
+together in one Parquet file, tagged by a ``Cuboid`` column.
+
+A cube built from a weighted sample of the lines (see ``core.progressive``)
+holds estimates instead, and :func:`time_rollup` then adds the margins of
+error of its sums and counts.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from core.data import (CATEGORY_COLUMNS, DATASET_DIR, DATE_COLUMN,
+                       compact_frame, concat_frames, dataset_lock, empty_frame,
+                       ensure_dataset, part_month, read_manifest, scan_parts,
+                       write_manifest)
+from core.metrics import timed
+from core.reduce import MIN_SERIES_POINTS, POINT_BUDGET
+
+CUBE_NAME = "cuboids.parquet"
+
+TIME_COLUMNS = [DATE_COLUMN, "Year", "Month"]
+DIMENSIONS = TIME_COLUMNS + CATEGORY_COLUMNS
+# Dimensions of each cuboid besides the day (with its Year and Month). Every
+# set of columns a page groups and filters by together must fall within one.
+CUBOIDS = [(), ("Department",), ("Supplier Name",), ("Buyer",),
+           ("ShipTo City",), ("Item Type",), ("Supplier Name", "Department"),
+           ("Buyer", "Department"), ("Buyer", "Department", "Item Type")]
+# Every dimension at once: the grain of a cube over a sample of the lines.
+FULL_GRAIN = tuple(CATEGORY_COLUMNS)
+CUBOID_COLUMN = "Cuboid"
+MEASURES = ["Extended Price", "Quantity", "Unit Price"]
+STATS = ["sum", "count", "min", "max", "sumsq"]
+LINES = "Lines"
+# Time buckets for charts over ``Creation Date``, finest first, as pandas
+# period frequencies.
+GRANULARITIES = {"Day": "D", "Week": "W", "Month": "M", "Quarter": "Q"}
+# Columns of a sample cube: each row's stratum, the stratum's weight (lines
+# per sampled line) and its number of sampled lines.
+STRATUM = "Stratum"
+WEIGHT = "Weight"
+SAMPLED = "Sampled"
+# Normal quantile of the 95% margins of error.
+MARGIN_Z = 1.96
+
+
+def stat_column(measure, stat):
+    return f"{measure}:{stat}"
+
+
+def cuboid_name(dimensions):
+    return "+".join(dimensions) or "day"
+
+
+def build_cube(df, weights=None, cuboids=CUBOIDS):
+    """Aggregate row-level order lines to the daily ``cuboids``.
+
+    Returns a dict from each cuboid's dimensions to its frame. With
+    ``weights`` (one per line) lines, sums and counts are weighted, so a cube
+    built from a sample estimates the cube of the whole population.
+    """
+    keys = df[DIMENSIONS].copy()
+    keys[DATE_COLUMN] = keys[DATE_COLUMN].dt.normalize()
+    values = df[MEASURES].astype("float64")
+    squares = (values ** 2).add_suffix(":sq")
+    columns = [keys, values, squares]
+    if weights is not None:
+        weights = pd.Series(weights, index=df.index, name=WEIGHT)
+        columns += [weights, values.mul(weights, axis=0).add_suffix(":w"),
+                    values.notna().mul(weights, axis=0).add_suffix(":n"),
+                    squares.mul(weights, axis=0).add_suffix(":w")]
+    grouped = pd.concat(columns, axis=1).groupby(
+        DIMENSIONS, observed=True, dropna=False, sort=False)
+
+    parts = {LINES: grouped.size() if weights is None
+             else grouped[WEIGHT].sum()}
+    for measure in MEASURES:
+        column = grouped[measure]
+        if weights is None:
+            parts[stat_column(measure, "sum")] = column.sum()
+            parts[stat_column(measure, "count")] = column.count()
+        else:
+            parts[stat_column(measure, "sum")] = grouped[f"{measure}:w"].sum()
+            parts[stat_column(measure, "count")] = grouped[f"{measure}:n"].sum()
+        parts[stat_column(measure, "min")] = column.min()
+        parts[stat_column(measure, "max")] = column.max()
+        square = f"{measure}:sq" if weights is None else f"{measure}:sq:w"
+        parts[stat_column(measure, "sumsq")] = grouped[square].sum()
+    full = pd.DataFrame(parts).reset_index()
+    return {dimensions: compact_frame(
+        full if dimensions == FULL_GRAIN else combine_stats(
+            full, TIME_COLUMNS + list(dimensions), dropna=False).reset_index())
+        for dimensions in cuboids}
+
+
+def cuboid(cube, columns=()):
+    """Cube rows to aggregate ``columns`` from.
+
+    ``cube`` is either a cuboid frame, used as is, or a cube selection (see
+    :class:`core.filters.CubeSelection`), whose matching rows are taken from
+    the smallest cuboid holding ``columns``.
+    """
+    return cube if isinstance(cube, pd.DataFrame) else cube.cover(columns)
+
+
+def _combine_spec():
+    spec = {LINES: "sum"}
+    for measure in MEASURES:
+        for stat in STATS:
+            spec[stat_column(measure, stat)] = stat if stat in (
+                "min", "max") else "sum"
+    return spec
+
+
+def combine_stats(frame, by, dropna=True):
+    """Re-aggregate cube (or partial cube) rows to the ``by`` grain."""
+    if not by:
+        totals = frame.agg(_combine_spec()).to_frame().T
+        return totals.astype({LINES: "int64"})
+    return frame.groupby(by, observed=True, dropna=dropna, sort=False).agg(
+        _combine_spec())
+
+
+def _derive(rolled, measure, stat):
+    if stat == "lines":
+        return rolled[LINES]
+    if stat in STATS:
+        return rolled[stat_column(measure, stat)]
+    total = rolled[stat_column(measure, "sum")]
+    count = rolled[stat_column(measure, "count")]
+    mean = total / count.where(count > 0)
+    if stat == "mean":
+        return mean
+    if stat == "std":
+        sumsq = rolled[stat_column(measure, "sumsq")]
+        variance = (sumsq - count * mean ** 2) / (count - 1).where(count > 1)
+        return np.sqrt(variance.clip(lower=0))
+    raise ValueError(f"Unsupported statistic: {stat}")
+
+
+@timed("aggregation")
+def rollup(cube, by, agg):
+    """Answer a groupby from the cube.
+
+    ``by`` is a list of cube dimensions (``[]`` for a grand total) and ``agg``
+    maps output column names to ``(measure, stat)`` pairs, where ``stat`` is
+    one of sum, count, min, max, mean, std or ``"lines"`` for the number of
+    order lines. Returns a flat frame like ``groupby(...).agg(...)
+    .reset_index()`` would, without rows for unobserved groups. ``cube`` is
+    a cuboid frame or a cube selection (see :func:`cuboid`).
+    """
+    rolled = combine_stats(cuboid(cube, by), by)
+    if by:
+        rolled = rolled[rolled[LINES] > 0]
+    result = pd.DataFrame(
+        {name: _derive(rolled, measure, stat)
+         for name, (measure, stat) in agg.items()}, index=rolled.index)
+    if not by:
+        return result.reset_index(drop=True)
+    if DATE_COLUMN in by:
+        result = result.sort_index()
+    return result.reset_index()
+
+
+def sample_margins(cube, by, agg):
+    """95% margins of error of the sums and counts :func:`rollup` estimates
+    from a sample cube, indexed by ``by``; None if ``agg`` has neither.
+
+    Uses the stratified-sampling variance of an estimated total, summed over
+    the strata each group draws lines from.
+    """
+    sampled = {}
+    for name, (measure, stat) in agg.items():
+        if stat == "lines":
+            sampled[name] = (LINES, LINES)
+        elif stat in ("sum", "count"):
+            # Line counts are sums of 0/1 values, their own squares.
+            column = stat_column(measure, stat)
+            sampled[name] = (column, stat_column(measure, "sumsq")
+                             if stat == "sum" else column)
+    if not sampled:
+        return None
+    # Within a stratum every line has the same weight, so dividing it out
+    # recovers the sums over the sampled lines.
+    weight = cube[WEIGHT].astype("float64")
+    columns = {}
+    for name, (column, square) in sampled.items():
+        columns[f"{name}:y"] = cube[column] / weight
+        columns[f"{name}:yy"] = cube[square] / weight
+    cells = cube[by + [STRATUM, WEIGHT, SAMPLED]].assign(**columns).groupby(
+        by + [STRATUM], observed=True, sort=False).agg(
+        {**{column: "sum" for column in columns},
+         WEIGHT: "first", SAMPLED: "first"})
+    weight, n = cells[WEIGHT], cells[SAMPLED].astype("float64")
+    scale = n * weight ** 2 * (1 - 1 / weight) / (n - 1).where(n > 1)
+    margins = {}
+    for name in sampled:
+        y, yy = cells[f"{name}:y"], cells[f"{name}:yy"]
+        variance = (scale * (yy - y ** 2 / n).clip(lower=0)).fillna(0)
+        margins[f"{name} margin"] = MARGIN_Z * np.sqrt(
+            variance.groupby(level=list(range(len(by))), observed=True).sum())
+    return pd.DataFrame(margins)
+
+
+def choose_granularity(start, end, series=1, budget=None):
+    """Finest granularity at which ``series`` lines over ``[start, end]``
+    fit the point budget, each keeping at least ``MIN_SERIES_POINTS``."""
+    points = max((budget or POINT_BUDGET) // max(series, 1), MIN_SERIES_POINTS)
+    for name, freq in GRANULARITIES.items():
+        if len(pd.period_range(start, end, freq=freq)) <= points:
+            return name
+    return name
+
+
+@timed("aggregation")
+def time_rollup(cube, by, agg, granularity=None, budget=None):
+    """:func:`rollup` with ``Creation Date`` bucketed to ``granularity``.
+
+    ``granularity`` is a key of ``GRANULARITIES``, or None to choose one from
+    the dates in ``cube`` and the number of series (the combinations of the
+    other ``by`` columns). Buckets are labelled by their first day and the
+    result's ``attrs["granularity"]`` names the one used. Over a sample cube
+    each estimated sum and count gets a ``"<name> margin"`` column, listed
+    in ``attrs["margins"]``.
+    """
+    cube = cuboid(cube, by)
+    dates = cube[DATE_COLUMN]
+    if granularity is None:
+        others = [column for column in by if column != DATE_COLUMN]
+        series = len(cube[others].drop_duplicates()) if others else 1
+        granularity = "Day" if dates.isna().all() else choose_granularity(
+            dates.min(), dates.max(), series, budget)
+    if granularity != "Day":
+        # Bucket each distinct day once rather than every cube row.
+        codes, days = pd.factorize(dates)
+        starts = days.to_period(GRANULARITIES[granularity]).start_time
+        cube = cube.assign(**{DATE_COLUMN: pd.Series(
+            starts.take(codes, allow_fill=True, fill_value=pd.NaT),
+            index=cube.index)})
+    result = rollup(cube, by, agg)
+    margins = sample_margins(cube, by, agg) if WEIGHT in cube else None
+    if margins is not None:
+        result = result.join(margins, on=by)
+        result.attrs["margins"] = {name[:-len(" margin")]: name
+                                   for name in margins.columns}
+    result.attrs["granularity"] = granularity
+    return result
+
+
+def top_n(cube, column, n=10, measure=None, stat="lines"):
+    """Rank ``column`` values by order-line count (or ``measure``/``stat``)."""
+    ranked = rollup(cube, [column], {"value": (measure, stat)})
+    ranked = ranked.sort_values("value", ascending=False, kind="stable")
+    return ranked.head(n).reset_index(drop=True)
+
+
+@timed("aggregation")
+def daily_series(cube, measure="Extended Price", stat="sum"):
+    """Gap-free daily series of ``measure``, forward-filling missing days."""
+    daily = rollup(cube, [DATE_COLUMN], {measure: (measure, stat)})
+    return daily.set_index(DATE_COLUMN)[measure].asfreq("D").ffill()
+
+
+def combine_cubes(cubes):
+    """Merge partial cubes that may share dimension combinations."""
+    if len(cubes) == 1:
+        return cubes[0]
+    return {dimensions: compact_frame(combine_stats(
+        concat_frames([cube[dimensions] for cube in cubes]),
+        TIME_COLUMNS + list(dimensions), dropna=False).reset_index())
+        for dimensions in cubes[0]}
+
+
+def build_cube_from_parts(parts, dataset_dir=DATASET_DIR):
+    """Build the cube chunk by chunk, holding one month's partials at a time."""
+    months = {}
+    for part in parts:
+        months.setdefault(part_month(part), []).append(part)
+    cubes = []
+    for month_parts in months.values():
+        partials = [build_cube(chunk)
+                    for chunk in scan_parts(month_parts, dataset_dir)]
+        if partials:
+            cubes.append(combine_cubes(partials))
+    if not cubes:
+        return build_cube(empty_frame(parts[:1], dataset_dir)) if parts \
+            else {}
+    if None in months and len(months) > 1:
+        # Unpartitioned parts may overlap any month.
+        return combine_cubes(cubes)
+    return {dimensions: compact_frame(concat_frames(
+        [cube[dimensions] for cube in cubes])) for dimensions in cubes[0]}
+
+
+def merge_cube(cube, delta_cube, since=None):
+    """Fold ``delta_cube`` into ``cube``, regrouping only rows from ``since`` on.
+
+    Cube rows dated before ``since`` cannot overlap the delta and are kept
+    as they are.
+    """
+    merged_cube = {}
+    for dimensions, frame in cube.items():
+        if since is None:
+            tail = pd.Series(True, index=frame.index)
+        else:
+            tail = (frame[DATE_COLUMN] >= since) | frame[DATE_COLUMN].isna()
+        merged = combine_cubes([{dimensions: frame[tail]},
+                                {dimensions: delta_cube[dimensions]}])
+        merged_cube[dimensions] = compact_frame(
+            concat_frames([frame[~tail], merged[dimensions]]))
+    return merged_cube
+
+
+def write_cube(cube, dataset_dir=DATASET_DIR):
+    """Store the cuboids of ``cube`` in the one ``CUBE_NAME`` file.
+
+    A cuboid with as many rows as one holding more dimensions (such as
+    buyers, who each order for one department) answers nothing faster and
+    is left out.
+    """
+    frames = []
+    for dimensions, frame in cube.items():
+        if any(set(dimensions) < set(other) and len(cube[other]) <= len(frame)
+               for other in cube):
+            continue
+        absent = {column: pd.Categorical([None] * len(frame))
+                  for column in CATEGORY_COLUMNS if column not in dimensions}
+        frame = frame.assign(**absent, **{
+            CUBOID_COLUMN: pd.Categorical([cuboid_name(dimensions)] * len(frame))})
+        frames.append(frame[DIMENSIONS + [column for column in frame.columns
+                                          if column not in DIMENSIONS]])
+    cube_path = os.path.join(dataset_dir, CUBE_NAME)
+    tmp_path = f"{cube_path}.{os.getpid()}.tmp"
+    concat_frames(frames).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cube_path)
+
+
+def read_cube(cube_path):
+    """The cuboids stored by :func:`write_cube`, by their dimensions."""
+    stored = pd.read_parquet(cube_path)
+    cube = {}
+    for name, frame in stored.groupby(CUBOID_COLUMN, observed=True,
+                                      sort=False):
+        dimensions = () if name == "day" else tuple(name.split("+"))
+        absent = [column for column in CATEGORY_COLUMNS
+                  if column not in dimensions]
+        cube[dimensions] = compact_frame(frame.drop(
+            columns=absent + [CUBOID_COLUMN]).reset_index(drop=True))
+    return cube
+
+
+def ensure_cube(dataset_dir=DATASET_DIR):
+    """Return the manifest, rebuilding the cube if it is missing or stale."""
+    manifest = ensure_dataset(dataset_dir=dataset_dir)
+    cube_path = os.path.join(dataset_dir, CUBE_NAME)
+
+    def stale():
+        return (not os.path.exists(cube_path)
+                or manifest["cube_version"] != manifest["version"])
+
+    if stale():
+        with dataset_lock(dataset_dir):
+            # Another process may have rebuilt it while we waited.
+            manifest = read_manifest(dataset_dir)
+            if stale():
+                write_cube(build_cube_from_parts(manifest["parts"],
+                                                 dataset_dir), dataset_dir)
+                manifest["cube_version"] = manifest["version"]
+                write_manifest(manifest, dataset_dir)
+    return manifest
+
+
+@st.cache_resource(max_entries=1, show_spinner="Loading purchase rollups...")
+def _read_cube(cube_path, version):
+    # ``version`` is only part of the cache key so an updated cube is reloaded.
+    return read_cube(cube_path)
+
+
+def load_cube():
+    """Return the shared daily cuboids, by their dimensions; callers must
+    treat them as read-only."""
+    manifest = ensure_cube()
+    return _read_cube(os.path.join(DATASET_DIR, CUBE_NAME), manifest["version"])
@@ -0,0 +1,475 @@
+"""Shared purchase-order dataset.
+
+Raw CSV extracts are parsed into a typed, append-only Parquet dataset
+(dictionary-encoded text columns, pre-parsed ``Creation Date``, derived
+``Buyer``/``Year``/``Month`` columns). Every part is written with the same
+``STORAGE_TYPES`` and read back with them; numbers are only downcast in
+memory, once read (``compact_frame``). The dataset
+directory holds the part files of each ingested extract, partitioned by
+``Creation Date`` month (``month=YYYY-MM/part-*.parquet``), plus a
+``manifest.json`` recording the parts, the dataset version and the
+``Creation Date`` watermark; see ``core.ingest``. Everything that writes to
+the directory holds :func:`dataset_lock`, which excludes other threads and
+other server processes alike.
+
+By default the row-level data is loaded through ``load_data()``, which
+writes each dataset version once as an uncompressed Feather snapshot
+(``snapshot-NNNNN.feather``) and maps it read-only, so every session and
+every server process on the host shares the same pages. With another
+``M3_QUERY_BACKEND`` no page holds the rows: ``scan_parts`` reads them in
+chunks with the filters pushed down (see ``core.filters.ScanIndex``), or
+DuckDB queries the parts (``core.sql``).
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import streamlit as st
+from pandas.api.types import union_categoricals
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+CSV_PATH = os.environ.get("M3_CSV_PATH", "df_new_3.csv")
+DATASET_DIR = os.environ.get("M3_DATASET_DIR", "df_new_3.dataset")
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".lock"
+# Explicit format for "Creation Date"; None lets pandas infer it once at build time.
+DATE_FORMAT = os.environ.get("M3_DATE_FORMAT") or None
+
+# Engine for row-level queries: "pandas" holds every order line in memory,
+# "arrow" scans the Parquet parts in chunks and "duckdb" queries them in SQL.
+# M3_OUT_OF_CORE=1 is shorthand for the arrow backend.
+QUERY_BACKEND = os.environ.get("M3_QUERY_BACKEND") or (
+    "arrow" if os.environ.get("M3_OUT_OF_CORE", "") == "1" else "pandas")
+OUT_OF_CORE = QUERY_BACKEND != "pandas"
+# Rows per chunk when parsing extracts and scanning parts.
+CHUNK_ROWS = int(os.environ.get("M3_CHUNK_ROWS", "500000"))
+NULL_MONTH = "none"
+# Share the in-memory dataset between processes through a memory-mapped
+# Feather snapshot (pandas backend only).
+MEMORY_MAP = os.environ.get("M3_MEMORY_MAP", "1") == "1"
+SNAPSHOT_PREFIX = "snapshot-"
+
+DATE_COLUMN = "Creation Date"
+CATEGORY_COLUMNS = ["Department", "Supplier Name",
+                    "Buyer", "ShipTo City", "Item Type"]
+DERIVED_COLUMNS = ["Buyer", "Year", "Month"]
+TEXT_COLUMNS = CATEGORY_COLUMNS + ["Buyer: First Name", "Buyer: Last Name",
+                                  "Product Description"]
+# Arrow type of each column in every part, whatever width a chunk held in
+# memory; parts written with other widths are read back as these too.
+# Columns not listed keep the type inferred for them.
+STORAGE_TYPES = {
+    DATE_COLUMN: pa.timestamp("ns"),
+    **{column: pa.dictionary(pa.int32(), pa.string()) for column in TEXT_COLUMNS},
+    "Quantity": pa.int64(), "Unit Price": pa.float64(),
+    "Extended Price": pa.float64(), "Year": pa.int16(), "Month": pa.int8(),
+}
+
+
+class MissingExtract(Exception):
+    """There is no dataset yet and no CSV extract to build it from."""
+
+
+def _buyer_names(first, last):
+    """``first + " " + last`` computed once per distinct pair of names."""
+    first = first.astype("category")
+    last = last.astype("category")
+    width = len(last.cat.categories) + 1
+    pairs = (first.cat.codes.to_numpy(np.int64) + 1) * width + \
+        last.cat.codes.to_numpy(np.int64) + 1
+    uniques, inverse = np.unique(pairs, return_inverse=True)
+    first_codes, last_codes = uniques // width - 1, uniques % width - 1
+    valid = (first_codes >= 0) & (last_codes >= 0)
+    labels = np.where(
+        valid,
+        first.cat.categories.take(first_codes.clip(0)).astype(str).to_numpy(object)
+        + " " + last.cat.categories.take(last_codes.clip(0)).astype(str).to_numpy(object),
+        None)
+    label_codes, categories = pd.factorize(labels)
+    return pd.Categorical.from_codes(label_codes[inverse], categories)
+
+
+def compact_frame(df):
+    """Dictionary-encode text columns and losslessly downcast numeric ones."""
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) or \
+                pd.api.types.is_datetime64_any_dtype(values):
+            continue
+        if pd.api.types.is_object_dtype(values) or \
+                pd.api.types.is_string_dtype(values):
+            df[column] = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values) and not \
+                pd.api.types.is_bool_dtype(values):
+            df[column] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values):
+            narrow = pd.to_numeric(values, downcast="float")
+            if narrow.dtype != values.dtype and narrow.astype(
+                    values.dtype).equals(values):
+                df[column] = narrow
+    return df
+
+
+def _text(values):
+    """``values`` as a categorical of strings, even when all missing."""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype("category")
+    categories = values.cat.categories
+    if not pd.api.types.is_string_dtype(categories):
+        values = values.cat.rename_categories(categories.astype(str))
+    return values
+
+
+def _typed(df):
+    df[DATE_COLUMN] = pd.to_datetime(
+        df[DATE_COLUMN], format=DATE_FORMAT, errors="coerce")
+    for column in TEXT_COLUMNS:
+        if column in df.columns:
+            df[column] = _text(df[column])
+    df = compact_frame(df)
+    df["Buyer"] = _buyer_names(df["Buyer: First Name"], df["Buyer: Last Name"])
+    df["Year"] = df[DATE_COLUMN].dt.year
+    df["Month"] = df[DATE_COLUMN].dt.month
+    return compact_frame(df)
+
+
+def parse_extract(csv_path):
+    """Read a raw CSV extract and return it with the shared typed schema."""
+    return _typed(pd.read_csv(csv_path))
+
+
+def iter_extract(csv_path, chunk_rows=CHUNK_ROWS):
+    """Parse a raw CSV extract ``chunk_rows`` lines at a time."""
+    with pd.read_csv(csv_path, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield _typed(chunk.reset_index(drop=True))
+
+
+def concat_frames(frames):
+    """Concatenate frames, unioning categories so categoricals stay categorical."""
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    combined = {}
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            values = [frame[column] for frame in frames]
+            if len({value.cat.categories.dtype for value in values}) > 1:
+                # e.g. an all-missing chunk read back with object categories.
+                values = [value.cat.rename_categories(
+                    value.cat.categories.astype(object)) for value in values]
+            combined[column] = pd.Series(union_categoricals(values),
+                                         name=column)
+    result = pd.concat(
+        [frame.drop(columns=list(combined)) for frame in frames],
+        ignore_index=True)
+    for column, values in combined.items():
+        result[column] = values
+    return result[frames[0].columns]
+
+
+def read_manifest(dataset_dir=DATASET_DIR):
+    """Return the dataset manifest, or an empty one before the first ingest."""
+    path = os.path.join(dataset_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"version": 0, "parts": [], "rows": 0, "watermark": None,
+                "source_mtime": None, "cube_version": None}
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def write_manifest(manifest, dataset_dir=DATASET_DIR):
+    """Atomically replace the manifest; readers never see a partial update."""
+    path = os.path.join(dataset_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def dataset_lock(dataset_dir=DATASET_DIR):
+    """Hold the exclusive lock on ``dataset_dir`` for the ``with`` block.
+
+    The lock is a file lock, so it also excludes other processes. It is not
+    reentrant: code holding it must not call anything that takes it again.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, LOCK_NAME), "a+b") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        else:
+            handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # Gave up after 10 seconds; keep waiting.
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def storage_schema(schema):
+    """``schema`` with the ``STORAGE_TYPES`` of the columns it has."""
+    return pa.schema([field.with_type(STORAGE_TYPES.get(field.name, field.type))
+                      for field in schema])
+
+
+def write_part(frame, path, row_group_size=None):
+    """Write a parsed chunk as a part file with the ``STORAGE_TYPES``."""
+    schema = storage_schema(pa.Schema.from_pandas(frame, preserve_index=False))
+    frame.to_parquet(path, index=False, schema=schema,
+                     row_group_size=row_group_size)
+
+
+def open_parts(parts, dataset_dir=DATASET_DIR):
+    """Arrow dataset of the given part files, typed with ``STORAGE_TYPES``.
+
+    Without the explicit schema Arrow would take the first part's types.
+    """
+    paths = [os.path.join(dataset_dir, part) for part in parts]
+    schema = ds.dataset(paths[:1], format="parquet").schema
+    return ds.dataset(paths, format="parquet", schema=storage_schema(schema))
+
+
+def read_parts(parts, dataset_dir=DATASET_DIR, filter=None, columns=None):
+    """Read the given part files as one frame, optionally with a row filter."""
+    return compact_frame(open_parts(parts, dataset_dir).to_table(
+        filter=filter, columns=columns).to_pandas())
+
+
+def part_month(part):
+    """``YYYY-MM`` partition of a part file, ``"none"`` for undated lines.
+
+    Parts written before the dataset was partitioned by month return None.
+    """
+    directory = os.path.dirname(part)
+    if not directory.startswith("month="):
+        return None
+    return directory[len("month="):]
+
+
+def prune_parts(parts, start=None, end=None, nulls=True):
+    """Parts that may hold lines dated within ``[start, end)``.
+
+    Undated lines are only kept with ``nulls``; unpartitioned parts are
+    always kept.
+    """
+    first = start.strftime("%Y-%m") if start is not None else None
+    last = (end - pd.Timedelta(1, "ns")).strftime("%Y-%m") \
+        if end is not None else None
+    kept = []
+    for part in parts:
+        month = part_month(part)
+        if month == NULL_MONTH:
+            if not nulls:
+                continue
+        elif month is not None and ((first and month < first) or
+                                    (last and month > last)):
+            continue
+        kept.append(part)
+    return kept
+
+
+def scan_parts(parts, dataset_dir=DATASET_DIR, filter=None, columns=None,
+               chunk_rows=CHUNK_ROWS):
+    """Yield the matching lines of ``parts`` as frames of up to ``chunk_rows``.
+
+    ``filter`` is pushed down to the Parquet reader, which skips row groups
+    whose statistics cannot match.
+    """
+    if not parts:
+        return
+    dataset = open_parts(parts, dataset_dir)
+    for batch in dataset.to_batches(filter=filter, columns=columns,
+                                    batch_size=chunk_rows):
+        if batch.num_rows:
+            yield compact_frame(batch.to_pandas())
+
+
+def empty_frame(parts, dataset_dir=DATASET_DIR, columns=None):
+    """Zero-row frame with the stored schema."""
+    schema = open_parts(parts[:1], dataset_dir).schema
+    if columns is not None:
+        schema = pa.schema([schema.field(column) for column in columns])
+    return schema.empty_table().to_pandas()
+
+
+def ensure_dataset(csv_path=CSV_PATH, dataset_dir=DATASET_DIR):
+    """Return the manifest, ingesting the CSV extract when it is new or newer."""
+    manifest = read_manifest(dataset_dir)
+    if os.path.exists(csv_path):
+        mtime = os.path.getmtime(csv_path)
+        if manifest["source_mtime"] is None or mtime > manifest["source_mtime"]:
+            from core.ingest import ingest_extract
+            ingest_extract(csv_path, dataset_dir, source_mtime=mtime)
+            manifest = read_manifest(dataset_dir)
+    elif not manifest["parts"]:
+        raise MissingExtract(csv_path)
+    return manifest
+
+
+def data_available():
+    """Whether there are order lines to show; reports a missing extract."""
+    try:
+        manifest = ensure_dataset()
+    except MissingExtract:
+        st.error(f"Error: File '{CSV_PATH}' not found!")
+        return False
+    return manifest["rows"] > 0
+
+
+def dataset_version():
+    """Identifier of the current dataset contents, for cache keys."""
+    return ensure_dataset()["version"]
+
+
+def snapshot_path(version, dataset_dir=DATASET_DIR):
+    """Feather snapshot of the whole dataset at ``version``."""
+    return os.path.join(dataset_dir, f"{SNAPSHOT_PREFIX}{version:05d}.feather")
+
+
+def write_snapshot(frame, path):
+    """Write ``frame`` as one uncompressed record batch that maps zero-copy.
+
+    Missing values keep their numpy form (NaN, NaT, category code -1) in the
+    data buffers, with an Arrow validity bitmap for NaT and codes, so
+    :func:`map_snapshot` can use every fixed-width buffer as is.
+    """
+    arrays = []
+    for column in frame.columns:
+        values = frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy()
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(codes, mask=codes < 0),
+                pa.array(values.cat.categories.to_numpy(dtype=object))))
+        elif values.dtype.kind in "iufM":
+            arrays.append(pa.array(values.to_numpy(), from_pandas=False))
+        else:
+            arrays.append(pa.array(values, from_pandas=True))
+    table = pa.Table.from_arrays(arrays, names=list(frame.columns))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, tmp_path, compression="uncompressed",
+                          chunksize=max(len(frame), 1))
+    os.replace(tmp_path, path)
+
+
+def _buffer_values(array):
+    dtype = np.dtype(array.type.to_pandas_dtype())
+    return np.frombuffer(array.buffers()[1], dtype=dtype, count=len(array),
+                         offset=array.offset * dtype.itemsize)
+
+
+def map_snapshot(path):
+    """Frame whose columns are read-only views of the memory-mapped snapshot.
+
+    The pages stay in the OS page cache, shared by every process mapping the
+    file; only the category labels are copied.
+    """
+    table = feather.read_table(path, memory_map=True)
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        array = column.chunk(0) if column.num_chunks == 1 \
+            else column.combine_chunks()
+        kind = array.type
+        if pa.types.is_dictionary(kind):
+            columns[name] = pd.Categorical.from_codes(
+                _buffer_values(array.indices),
+                categories=array.dictionary.to_pandas(), validate=False)
+        elif pa.types.is_integer(kind) or pa.types.is_floating(kind) or (
+                pa.types.is_timestamp(kind) and kind.tz is None):
+            columns[name] = _buffer_values(array)
+        else:
+            columns[name] = array.to_pandas()
+    return pd.DataFrame(columns, copy=False)
+
+
+def remove_snapshots(path):
+    """Delete the snapshots older than ``path``.
+
+    Processes still mapping one keep their view; where the platform refuses
+    to delete a mapped file it is left for a later call.
+    """
+    dataset_dir, current = os.path.split(path)
+    for name in os.listdir(dataset_dir):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(".feather") \
+                and name < current:
+            try:
+                os.remove(os.path.join(dataset_dir, name))
+            except OSError:
+                pass
+
+
+class _DatasetStore:
+    """Process-wide copy of the dataset that grows as new parts are ingested.
+
+    With ``MEMORY_MAP`` the first process to load a version writes its
+    snapshot and every process maps it instead of holding a private copy.
+    """
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        self.lock = threading.Lock()
+        self.parts = []
+        self.version = None
+        self.frame = None
+
+    def _read(self, manifest):
+        known = manifest["parts"][:len(self.parts)]
+        if self.frame is not None and known == self.parts:
+            new_parts = manifest["parts"][len(self.parts):]
+            return concat_frames(
+                [self.frame, read_parts(new_parts, self.dataset_dir)])
+        return read_parts(manifest["parts"], self.dataset_dir)
+
+    def get(self, manifest):
+        with self.lock:
+            if manifest["version"] != self.version:
+                if MEMORY_MAP:
+                    path = snapshot_path(manifest["version"], self.dataset_dir)
+                    if not os.path.exists(path):
+                        write_snapshot(self._read(manifest), path)
+                        remove_snapshots(path)
+                    self.frame = map_snapshot(path)
+                else:
+                    self.frame = self._read(manifest)
+                self.parts = list(manifest["parts"])
+                self.version = manifest["version"]
+            return self.frame
+
+
+@st.cache_resource(show_spinner="Loading purchase data...")
+def _dataset_store(dataset_dir):
+    return _DatasetStore(dataset_dir)
+
+
+def load_data():
+    """Return the shared dataset; callers must treat it as read-only.
+
+    Holds every order line in memory, so it is not used in out-of-core mode.
+    """
+    try:
+        manifest = ensure_dataset()
+    except MissingExtract:
+        st.error(f"Error: File '{CSV_PATH}' not found!")
+        return pd.DataFrame()  # Returns an empty DataFrame
+    return _dataset_store(DATASET_DIR).get(manifest)
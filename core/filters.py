@@ -0,0 +1,421 @@
+"""Index-based filter engine shared by the sidebar widgets on every page.
+
+For each filter column the index keeps, per distinct value, the sorted list of
+row ids holding it (built once from the dictionary-encoded categorical codes),
+plus a sorted date index for range lookups. A selection starts from the
+smallest matching row-id list and probes the remaining filters on those rows
+only, so no full-table masks or copies are built per interaction. The
+rollup cube gets one such index per cuboid (:class:`CubeIndex`), and a cube
+selection reads the smallest cuboid that holds the columns a query needs.
+
+With the arrow query backend the row-level index is a :class:`ScanIndex`:
+options come from the cube index and selections scan the month partitions
+of the stored dataset with the filters pushed down to the Parquet reader.
+The duckdb backend (``core.sql``) answers the same selections in SQL.
+"""
+import operator
+import os
+from functools import cached_property, reduce
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import streamlit as st
+
+from core.cube import LINES, TIME_COLUMNS, load_cube
+from core.data import (CATEGORY_COLUMNS, DATASET_DIR, DATE_COLUMN,
+                       QUERY_BACKEND, concat_frames, dataset_version, empty_frame,
+                       ensure_dataset, load_data, prune_parts, scan_parts)
+from core.metrics import timed
+
+FILTER_COLUMNS = CATEGORY_COLUMNS + ["Year", "Month"]
+# Lines a scanned selection materialises at most; beyond that it is sampled.
+SCAN_ROW_LIMIT = int(os.environ.get("M3_SCAN_ROW_LIMIT", "1000000"))
+# How per-chunk results of each aggregate combine.
+COMBINE = {"sum": "sum", "count": "sum", "size": "sum",
+           "min": "min", "max": "max"}
+
+
+def normalize_date_range(date_range):
+    """Return half-open ``(start, end)`` bounds, or None until both ends are
+    picked.
+
+    ``end`` is midnight after the last picked day, so every selection keeps
+    the lines of that whole day as the daily cube does: dates are matched by
+    ``start <= date < end``.
+    """
+    if not date_range or len(date_range) != 2:
+        return None
+    start, end = (pd.to_datetime(value).normalize() for value in date_range)
+    return start, end + pd.Timedelta(days=1)
+
+
+def filter_key(selections=None, date_range=None, **options):
+    """Hashable, order-insensitive form of a sidebar filter state.
+
+    ``options`` are further sidebar choices the results depend on, such as
+    the time granularity.
+    """
+    chosen = tuple(sorted(
+        (column, tuple(sorted(map(str, values))))
+        for column, values in (selections or {}).items() if values))
+    bounds = normalize_date_range(date_range)
+    return (chosen, tuple(bound.isoformat() for bound in bounds) if bounds
+            else None, tuple(sorted(options.items())))
+
+
+def scan_filter(selections=None, date_range=None):
+    """Parquet predicate matching the same lines as :meth:`FilterIndex.rows`."""
+    clauses = [ds.field(column).isin(list(values))
+               for column, values in (selections or {}).items() if values]
+    dates = normalize_date_range(date_range)
+    if dates:
+        date = ds.field(DATE_COLUMN)
+        clauses += [date >= dates[0], date < dates[1]]
+    return reduce(operator.and_, clauses) if clauses else None
+
+
+def aggregate_rows(frame, by, agg):
+    """``frame.groupby(by)`` with ``agg`` mapping names to ``(column, func)``.
+
+    ``func`` is one of sum, count, min, max or ``"size"`` (``column`` is then
+    ignored), so partial results can be combined across chunks. Missing
+    ``by`` values form their own groups.
+    """
+    grouped = frame.groupby(by, observed=True, dropna=False, sort=False)
+    return pd.DataFrame({
+        name: grouped.size() if func == "size" else grouped[column].agg(func)
+        for name, (column, func) in agg.items()}).reset_index()
+
+
+def combine_aggregates(partials, by, agg):
+    """Combine :func:`aggregate_rows` results of disjoint chunks."""
+    if len(partials) == 1:
+        return partials[0]
+    return concat_frames(partials).groupby(
+        by, observed=True, dropna=False, sort=False).agg(
+        {name: COMBINE[func] for name, (_, func) in agg.items()}).reset_index()
+
+
+class Selection:
+    """Rows of ``source`` matching a filter state; ``rows`` is None for all."""
+
+    def __init__(self, source, rows=None):
+        self.source = source
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.source) if self.rows is None else len(self.rows)
+
+    @cached_property
+    @timed("filter")
+    def frame(self):
+        """The selected rows as a DataFrame, materialised on first use."""
+        if self.rows is None:
+            return self.source
+        return self.source.take(self.rows)
+
+    @timed("aggregation")
+    def aggregate(self, by, agg):
+        """Group the selected rows; see :func:`aggregate_rows`."""
+        return aggregate_rows(self.frame, by, agg)
+
+
+class ScanSelection:
+    """Stored lines matching a filter state, read by scanning ``parts``.
+
+    ``size`` is the exact number of matching lines, known from the cube.
+    ``frame`` holds up to ``limit`` of them, as a uniform sample beyond that
+    with the sampled fraction in ``frame.attrs["sample_fraction"]``;
+    :meth:`aggregate` is always exact and only keeps per-group results.
+    """
+
+    def __init__(self, parts, expression, size, template,
+                 dataset_dir=DATASET_DIR, limit=SCAN_ROW_LIMIT):
+        self.parts = parts if size else []
+        self.expression = expression
+        self.size = size
+        self.template = template
+        self.dataset_dir = dataset_dir
+        self.limit = limit
+
+    def __len__(self):
+        return self.size
+
+    def _chunks(self, columns=None):
+        return scan_parts(self.parts, self.dataset_dir, self.expression, columns)
+
+    @cached_property
+    @timed("filter")
+    def frame(self):
+        """The selected lines as a DataFrame, scanned on first use."""
+        fraction = min(1.0, self.limit / self.size) if self.size else 1.0
+        rng = np.random.default_rng(0)
+        chunks = []
+        for chunk in self._chunks():
+            if fraction < 1:
+                chunk = chunk[rng.random(len(chunk)) < fraction]
+            chunks.append(chunk)
+        frame = concat_frames(chunks) if chunks else self.template.copy()
+        frame.attrs["sample_fraction"] = fraction
+        return frame
+
+    @timed("aggregation")
+    def aggregate(self, by, agg):
+        """Group the selected lines chunk by chunk; see :func:`aggregate_rows`."""
+        columns = list(dict.fromkeys(
+            by + [column for column, func in agg.values() if func != "size"]))
+        partials = []
+        for chunk in self._chunks(columns):
+            partials.append(aggregate_rows(chunk, by, agg))
+            if len(partials) > 8:
+                partials = [combine_aggregates(partials, by, agg)]
+        if not partials:
+            return aggregate_rows(self.template[columns], by, agg)
+        return combine_aggregates(partials, by, agg)
+
+
+class FilterIndex:
+    """Per-value row-id postings and a sorted date index over ``frame``."""
+
+    def __init__(self, frame, columns=FILTER_COLUMNS, date_column=DATE_COLUMN):
+        self.frame = frame
+        self.date_column = date_column
+        self._codes = {}
+        self._lookup = {}
+        self._postings = {}
+        # Row ids fit in 32 bits for any frame this app can hold in memory.
+        row_dtype = np.int32 if len(frame) < 2 ** 31 else np.int64
+        for column in columns:
+            if column not in frame:
+                continue
+            values = frame[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.to_numpy()
+                uniques = values.cat.categories
+            else:
+                codes, uniques = pd.factorize(values, sort=True)
+            order = np.argsort(codes, kind="stable").astype(row_dtype)
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self._codes[column] = codes
+            self._lookup[column] = {value: code for code, value in enumerate(uniques)}
+            self._postings[column] = (order, bounds)
+        dates = frame[date_column].to_numpy(dtype="datetime64[ns]")
+        self._date_order = np.argsort(dates, kind="stable").astype(row_dtype)
+        self._sorted_dates = dates[self._date_order]
+        self._dates = dates
+
+    @property
+    def nbytes(self):
+        """Bytes held by the index arrays (the indexed frame not included)."""
+        arrays = [self._date_order, self._sorted_dates, self._dates]
+        arrays += self._codes.values()
+        for order, bounds in self._postings.values():
+            arrays += [order, bounds]
+        return sum(array.nbytes for array in arrays)
+
+    def options(self, column):
+        """Distinct values of ``column`` that occur in the frame."""
+        order, bounds = self._postings[column]
+        present = np.flatnonzero(np.diff(bounds))
+        values = list(self._lookup[column])
+        return [values[code] for code in present]
+
+    def date_bounds(self):
+        """``[first, last]`` non-missing date, or ``[]`` without dates."""
+        valid = self._sorted_dates[~np.isnat(self._sorted_dates)]
+        if not len(valid):
+            return []
+        return [pd.Timestamp(valid[0]), pd.Timestamp(valid[-1])]
+
+    def _value_codes(self, column, values):
+        lookup = self._lookup[column]
+        return np.array(sorted({lookup[v] for v in values if v in lookup}),
+                        dtype=np.int64)
+
+    def _postings_for(self, column, codes):
+        order, bounds = self._postings[column]
+        if len(codes) == 1:
+            return order[bounds[codes[0]]:bounds[codes[0] + 1]]
+        return np.sort(np.concatenate(
+            [order[bounds[code]:bounds[code + 1]] for code in codes]
+            or [np.empty(0, dtype=order.dtype)]))
+
+    def rows(self, selections=None, date_range=None):
+        """Sorted row ids matching the filters, or None when nothing filters."""
+        # Each candidate is (matching rows, row ids, probe on given row ids).
+        candidates = []
+        for column, values in (selections or {}).items():
+            if not values:
+                continue
+            codes = self._value_codes(column, values)
+            _, bounds = self._postings[column]
+            size = int((bounds[codes + 1] - bounds[codes]).sum())
+            candidates.append((
+                size,
+                lambda column=column, codes=codes: self._postings_for(column, codes),
+                lambda rows, column=column, codes=codes: np.isin(
+                    self._codes[column][rows], codes)))
+        dates = normalize_date_range(date_range)
+        if dates:
+            start, end = (np.datetime64(value, "ns") for value in dates)
+            lo = np.searchsorted(self._sorted_dates, start, side="left")
+            hi = np.searchsorted(self._sorted_dates, end, side="left")
+            candidates.append((
+                max(hi - lo, 0),
+                lambda: np.sort(self._date_order[lo:hi]),
+                lambda rows: (self._dates[rows] >= start) & (self._dates[rows] < end)))
+        if not candidates:
+            return None
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        rows = candidates[0][1]()
+        for _, _, probe in candidates[1:]:
+            if not len(rows):
+                break
+            rows = rows[probe(rows)]
+        return rows
+
+    def select(self, selections=None, date_range=None):
+        """Return a lazy :class:`Selection` of the matching rows."""
+        return Selection(self.frame, self.rows(selections, date_range))
+
+
+class CubeSelection:
+    """Cube rows matching a filter state, in whichever cuboid a query needs.
+
+    The matching rows of a cuboid are only looked up when :meth:`cover`
+    first asks for them.
+    """
+
+    def __init__(self, cube_index, selections=None, date_range=None,
+                 empty=False):
+        self.cube_index = cube_index
+        self.selections = {column: list(values) for column, values
+                           in (selections or {}).items() if values}
+        self.date_range = date_range
+        self.empty = empty
+        self._frames = {}
+
+    def cover(self, columns=()):
+        """Matching rows of the smallest cuboid holding ``columns`` and every
+        filtered column."""
+        dimensions = self.cube_index.cuboid(
+            list(columns) + list(self.selections))
+        if dimensions not in self._frames:
+            index = self.cube_index.indexes[dimensions]
+            frame = index.select(self.selections, self.date_range).frame
+            self._frames[dimensions] = frame.iloc[:0] if self.empty else frame
+        return self._frames[dimensions]
+
+    def where(self, selections):
+        """This selection narrowed to the given values of further columns."""
+        narrowed = dict(self.selections)
+        empty = self.empty
+        for column, values in selections.items():
+            if column in narrowed:
+                allowed = set(values)
+                values = [value for value in narrowed[column] if value in allowed]
+            narrowed[column] = list(values)
+            empty = empty or not narrowed[column]
+        return CubeSelection(self.cube_index, narrowed, self.date_range, empty)
+
+    def nunique(self, column):
+        """Distinct values of ``column`` among the matching rows."""
+        return self.cover([column])[column].nunique()
+
+
+class CubeIndex:
+    """A :class:`FilterIndex` over each cuboid of the rollup cube."""
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.indexes = {dimensions: FilterIndex(frame)
+                        for dimensions, frame in cube.items()}
+
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for index in self.indexes.values())
+
+    def cuboid(self, columns):
+        """Dimensions of the smallest cuboid holding all of ``columns``."""
+        wanted = set(columns) - set(TIME_COLUMNS)
+        covering = [dimensions for dimensions in self.cube
+                    if wanted <= set(dimensions)]
+        if not covering:
+            raise ValueError(f"No cuboid holds {sorted(wanted)}")
+        return min(covering, key=lambda dimensions: len(self.cube[dimensions]))
+
+    def options(self, column):
+        return self.indexes[self.cuboid([column])].options(column)
+
+    def date_bounds(self):
+        return self.indexes[self.cuboid([])].date_bounds()
+
+    def select(self, selections=None, date_range=None):
+        """Return a lazy :class:`CubeSelection` of the matching cube rows."""
+        return CubeSelection(self, selections, date_range)
+
+
+class ScanIndex:
+    """Out-of-core counterpart of the row-level :class:`FilterIndex`."""
+
+    def __init__(self, cube_index, parts, dataset_dir=DATASET_DIR):
+        self.cube_index = cube_index
+        self.parts = parts
+        self.dataset_dir = dataset_dir
+        self.template = empty_frame(parts, dataset_dir)
+
+    def options(self, column):
+        return self.cube_index.options(column)
+
+    def date_bounds(self):
+        return self.cube_index.date_bounds()
+
+    def select(self, selections=None, date_range=None):
+        """Return a lazy :class:`ScanSelection` of the matching lines."""
+        size = int(self.cube_index.select(selections, date_range).cover()[
+            LINES].sum())
+        dates = normalize_date_range(date_range)
+        parts = prune_parts(self.parts, *dates, nulls=False) if dates \
+            else self.parts
+        return ScanSelection(parts, scan_filter(selections, date_range), size,
+                             self.template, self.dataset_dir)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _data_index(_frame, version):
+    return FilterIndex(_frame)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _cube_index(_cube, version):
+    return CubeIndex(_cube)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _scan_index(_cube_index, parts, version):
+    return ScanIndex(_cube_index, list(parts))
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _duckdb_index(_cube_index, parts, version):
+    from core.sql import DuckDBIndex, duckdb_connection
+    return DuckDBIndex(_cube_index, list(parts), duckdb_connection())
+
+
+def load_data_index():
+    """Filter index over the shared row-level dataset, per ``QUERY_BACKEND``."""
+    if QUERY_BACKEND == "pandas":
+        return _data_index(load_data(), dataset_version())
+    builders = {"arrow": _scan_index, "duckdb": _duckdb_index}
+    if QUERY_BACKEND not in builders:
+        raise ValueError(f"Unknown query backend: {QUERY_BACKEND}")
+    manifest = ensure_dataset()
+    return builders[QUERY_BACKEND](load_cube_index(), tuple(manifest["parts"]),
+                                   manifest["version"])
+
+
+def load_cube_index():
+    """Filter index over the shared rollup cube."""
+    return _cube_index(load_cube(), dataset_version())
@@ -0,0 +1,191 @@
+"""Batch Holt-Winters forecasts per Department, Supplier and ShipTo City.
+
+Daily spend per segment is taken from the rollup cube, and one model per
+segment is fitted in parallel across a process pool. Each batch is keyed by
+the dimension, the dataset version and the model parameters, and persisted
+under ``MODEL_DIR/segments`` as two Parquet tables: the forecasts in long
+format and the fitted parameters per segment. A batch can be run from the
+"Segment Forecasts" page (in the background) or ahead of time with::
+
+    python -m core.forecasting [Department "Supplier Name" "ShipTo City"]
+"""
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from core.cube import rollup, top_n
+from core.data import DATE_COLUMN, dataset_version
+from core.filters import load_cube_index
+from core.metrics import timed
+from core.models import MODEL_DIR, FitErrors, pool_context
+
+SEGMENT_DIR = os.path.join(MODEL_DIR, "segments")
+FORECAST_WORKERS = int(os.environ.get("M3_FORECAST_WORKERS",
+                                      str(os.cpu_count() or 2)))
+# Segment dimensions and how many of their largest values get a model
+# (None forecasts every value).
+SEGMENT_DIMENSIONS = {"Department": None, "Supplier Name": 50,
+                      "ShipTo City": None}
+HORIZON = int(os.environ.get("M3_FORECAST_HORIZON", "90"))
+MODEL_PARAMS = {"trend": "add", "seasonal": "add", "seasonal_periods": 30}
+
+
+@timed("aggregation")
+def segment_series(cube, dimension, segments=None, measure="Extended Price"):
+    """Daily spend per segment of a cube selection as a wide frame, zero on
+    days without orders."""
+    if segments is not None:
+        cube = cube.where({dimension: segments})
+    daily = rollup(cube, [DATE_COLUMN, dimension],
+                   {measure: (measure, "sum")})
+    wide = daily.pivot_table(index=DATE_COLUMN, columns=dimension,
+                             values=measure, aggfunc="sum", observed=True)
+    return wide.asfreq("D").fillna(0.0)
+
+
+def fit_segment(task):
+    """Fit one segment; runs in a worker process."""
+    from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+    name, series, steps, params = task
+    if len(series) < 2 * params.get("seasonal_periods", 1) + 1:
+        return name, None, {"status": "insufficient history"}
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            fitted = ExponentialSmoothing(series, **params).fit()
+    except Exception as error:
+        return name, None, {"status": f"failed: {error}"}
+    summary = {key: float(value) for key, value in fitted.params.items()
+               if isinstance(value, (float, np.floating))}
+    summary.update(status="ok", sse=float(fitted.sse), aic=float(fitted.aic))
+    return name, fitted.forecast(steps), summary
+
+
+def batch_key(dimension, version, steps=HORIZON, params=MODEL_PARAMS):
+    payload = json.dumps([dimension, version, steps, params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def _batch_paths(key):
+    folder = os.path.join(SEGMENT_DIR, key)
+    return (os.path.join(folder, "forecasts.parquet"),
+            os.path.join(folder, "parameters.parquet"))
+
+
+def run_batch(cube, dimension, steps=HORIZON, params=MODEL_PARAMS,
+              executor=None, version=None):
+    """Forecast every (top) segment of ``dimension`` and persist the batch."""
+    limit = SEGMENT_DIMENSIONS.get(dimension)
+    segments = None
+    if limit:
+        segments = top_n(cube, dimension, limit, "Extended Price", "sum")[
+            dimension].tolist()
+    wide = segment_series(cube, dimension, segments)
+    tasks = [(name, wide[name], steps, params) for name in wide.columns]
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=FORECAST_WORKERS,
+                                       mp_context=pool_context())
+    try:
+        chunksize = max(1, math.ceil(len(tasks) / (FORECAST_WORKERS * 4)))
+        results = list(executor.map(fit_segment, tasks, chunksize=chunksize))
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    forecasts = [pd.DataFrame({"Segment": str(name), DATE_COLUMN: forecast.index,
+                               "Forecast": forecast.to_numpy()})
+                 for name, forecast, _ in results if forecast is not None]
+    forecasts = pd.concat(forecasts, ignore_index=True) if forecasts else \
+        pd.DataFrame(columns=["Segment", DATE_COLUMN, "Forecast"])
+    parameters = pd.DataFrame([{"Segment": str(name), **summary}
+                               for name, _, summary in results])
+
+    version = dataset_version() if version is None else version
+    forecasts_path, parameters_path = _batch_paths(
+        batch_key(dimension, version, steps, params))
+    os.makedirs(os.path.dirname(forecasts_path), exist_ok=True)
+    forecasts.to_parquet(forecasts_path, index=False)
+    parameters.to_parquet(parameters_path, index=False)
+    return forecasts, parameters
+
+
+def load_batch(dimension, version, steps=HORIZON, params=MODEL_PARAMS):
+    """Stored ``(forecasts, parameters)`` for the batch, or None."""
+    forecasts_path, parameters_path = _batch_paths(
+        batch_key(dimension, version, steps, params))
+    if not os.path.exists(parameters_path):
+        return None
+    return pd.read_parquet(forecasts_path), pd.read_parquet(parameters_path)
+
+
+class SegmentForecaster(FitErrors):
+    """Runs segment batches in background threads over a shared process pool."""
+
+    def __init__(self, workers=FORECAST_WORKERS):
+        super().__init__()
+        self.pending = set()
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=pool_context())
+
+    def status(self, key):
+        with self.lock:
+            if key in self.pending:
+                return "fitting"
+            if self._error(key) is not None:
+                return "failed"
+        return "ready"
+
+    def start(self, cube, dimension, version):
+        """Start the batch in the background; returns its key."""
+        key = batch_key(dimension, version)
+        with self.lock:
+            if key in self.pending or self._error(key) is not None:
+                return key
+            self.pending.add(key)
+
+        def _run():
+            try:
+                run_batch(cube, dimension, executor=self.executor,
+                          version=version)
+            except Exception as error:
+                with self.lock:
+                    self._failed(key, error)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+        threading.Thread(target=_run, daemon=True).start()
+        return key
+
+
+@st.cache_resource(show_spinner=False)
+def segment_forecaster():
+    """The process-wide segment forecaster."""
+    return SegmentForecaster()
+
+
+def main(argv=None):
+    dimensions = (sys.argv[1:] if argv is None else argv) or list(
+        SEGMENT_DIMENSIONS)
+    cube = load_cube_index().select()
+    for dimension in dimensions:
+        _, parameters = run_batch(cube, dimension)
+        fitted = int((parameters["status"] == "ok").sum())
+        print(f"{dimension}: {fitted} of {len(parameters)} segments fitted")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Growth and trend rankings of buyers, suppliers, sites and item types.
+
+A :class:`TrendMatrix` is built once per selection from the cube: one row
+per entity (e.g. buyer), one column per period of the selected window, with
+zeros where an entity had no activity. Every metric is then computed for all
+entities at once with array operations instead of a loop per group:
+
+* ``growth``: average period-over-period growth, the geometric mean of the
+  growth between consecutive periods that both have activity;
+* ``slope``: least-squares trend of the measure, in units per period;
+* ``acceleration``: change of that trend per period, from a least-squares
+  parabola.
+"""
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import streamlit as st
+
+from core.cube import GRANULARITIES, cuboid, time_rollup
+from core.data import DATE_COLUMN
+from core.metrics import timed
+
+TREND_METRICS = {"growth": "Growth per period", "slope": "Trend slope",
+                 "acceleration": "Acceleration"}
+# Without a chosen granularity, the coarsest with this many periods is used.
+MIN_PERIODS = 6
+
+
+def trend_granularity(start, end, min_periods=MIN_PERIODS):
+    """Coarsest granularity splitting ``[start, end]`` into ``min_periods``."""
+    for name, freq in reversed(GRANULARITIES.items()):
+        if len(pd.period_range(start, end, freq=freq)) >= min_periods:
+            return name
+    return "Day"
+
+
+class TrendMatrix:
+    """Entity × period values of one measure; see :func:`trend_matrix`."""
+
+    def __init__(self, column, entities, periods, values, granularity):
+        self.column = column
+        self.entities = entities
+        self.periods = periods
+        self.values = values
+        self.granularity = granularity
+        self._table = None
+
+    def growth(self):
+        previous, current = self.values[:, :-1], self.values[:, 1:]
+        active = (previous > 0) & (current > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            logs = np.where(active, np.log(current) - np.log(previous), 0.0)
+        pairs = active.sum(axis=1)
+        return np.where(pairs > 0,
+                        np.expm1(logs.sum(axis=1) / np.maximum(pairs, 1)),
+                        np.nan)
+
+    def _leading_coefficient(self, degree):
+        entities, periods = self.values.shape
+        if periods <= degree or not entities:
+            return np.full(entities, np.nan)
+        # Centred periods keep the fit well conditioned.
+        steps = np.arange(periods) - (periods - 1) / 2
+        return np.polyfit(steps, self.values.T, degree)[0]
+
+    def slope(self):
+        return self._leading_coefficient(1)
+
+    def acceleration(self):
+        return 2 * self._leading_coefficient(2)
+
+    @timed("aggregation")
+    def table(self):
+        """One row per entity with its total and every trend metric."""
+        if self._table is None:
+            self._table = pd.DataFrame({
+                self.column: self.entities, "total": self.values.sum(axis=1),
+                "growth": self.growth(), "slope": self.slope(),
+                "acceleration": self.acceleration()})
+        return self._table
+
+    def rank(self, metric="growth", n=10, ascending=False):
+        """The ``n`` entities highest (or lowest) by ``metric``."""
+        table = self.table().dropna(subset=[metric])
+        table = table.sort_values(metric, ascending=ascending, kind="stable")
+        return table.head(n).reset_index(drop=True)
+
+
+@timed("aggregation")
+def trend_matrix(cube, column, measure=None, stat="lines", granularity=None):
+    """Build the :class:`TrendMatrix` of ``column`` over a cube selection.
+
+    The measure defaults to the number of order lines; ``granularity`` is a
+    key of ``GRANULARITIES``, or None for :func:`trend_granularity` over the
+    selected dates.
+    """
+    cube = cuboid(cube, [column])
+    dates = cube[DATE_COLUMN].dropna()
+    if dates.empty:
+        return TrendMatrix(column, pd.Index([]), pd.DatetimeIndex([]),
+                           np.zeros((0, 0)), granularity or "Day")
+    granularity = granularity or trend_granularity(dates.min(), dates.max())
+    periods = pd.period_range(dates.min(), dates.max(),
+                              freq=GRANULARITIES[granularity]).start_time
+    rolled = time_rollup(cube, [DATE_COLUMN, column],
+                         {"value": (measure, stat)}, granularity)
+    codes, entities = pd.factorize(rolled[column], sort=True)
+    values = np.zeros((len(entities), len(periods)))
+    values[codes, periods.get_indexer(rolled[DATE_COLUMN])] = \
+        rolled["value"].to_numpy(dtype=np.float64)
+    return TrendMatrix(column, pd.Index(entities), periods, values,
+                       granularity)
+
+
+def trend_figure(matrix, metric="growth", n=10, title=None, label=None):
+    """Bars of the ``n`` highest and the ``n`` lowest entities by ``metric``."""
+    column = matrix.column
+    ranked = pd.concat([matrix.rank(metric, n),
+                        matrix.rank(metric, n, ascending=True)])
+    ranked = ranked.drop_duplicates(column).sort_values(metric, kind="stable")
+    axis = f"{TREND_METRICS[metric]} ({matrix.granularity.lower()})"
+    fig = px.bar(ranked, x=metric, y=column, orientation="h", color=metric,
+                 color_continuous_scale="RdYlGn", color_continuous_midpoint=0,
+                 hover_data=["total"], title=title,
+                 labels={metric: axis, column: label or column},
+                 height=max(400, 25 * len(ranked)))
+    if metric == "growth":
+        fig.update_xaxes(tickformat=".0%")
+    return fig
+
+
+def trend_metric_radio(key):
+    """Choice of the metric a growth tab ranks by."""
+    return st.radio("Rank by", list(TREND_METRICS),
+                    format_func=TREND_METRICS.get, horizontal=True, key=key,
+                    help="Growth: average period-over-period change. Trend "
+                         "slope: change per period of a fitted line. "
+                         "Acceleration: change of that slope per period.")
@@ -0,0 +1,214 @@
+"""Incremental ingestion of purchase-order extracts.
+
+Each extract is parsed with the shared schema in chunks, deduplicated on
+the order-line key against the lines already stored in the same
+``Creation Date`` month, and appended to the dataset as new Parquet parts,
+one per month and chunk, sorted by date. Lines of an extract are never
+deduplicated against each other: an extract line is only a duplicate while
+the stored lines hold a copy of it not matched by an earlier line of the
+extract. Lines dated before the ``Creation Date`` watermark are stored in
+their month like any other and reported as ``late``. The rollup cube is
+updated for the affected days only, and the manifest version is bumped so
+running sessions pick up the new rows on their next rerun without reparsing
+history.
+
+Usage::
+
+    python -m core.ingest new_extract.csv [more_extracts.csv ...]
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from core.cube import (CUBE_NAME, build_cube, combine_cubes, merge_cube,
+                       read_cube, write_cube)
+from core.data import (DATASET_DIR, DATE_COLUMN, DERIVED_COLUMNS, NULL_MONTH,
+                       dataset_lock, iter_extract, part_month, read_manifest,
+                       read_parts, write_manifest, write_part)
+
+# Columns identifying an order line; empty means the whole extract row.
+ORDER_LINE_KEY = [column for column in os.environ.get(
+    "M3_ORDER_LINE_KEY", "").split(",") if column]
+
+# Row groups are small enough for date filters to skip most of a part.
+ROW_GROUP_ROWS = 65536
+
+
+def key_columns(frame):
+    return ORDER_LINE_KEY or [column for column in frame.columns
+                              if column not in DERIVED_COLUMNS]
+
+
+def line_keys(frame, columns):
+    """Hash of the order-line key of every row.
+
+    Numbers are widened and dates brought to one resolution first, so that
+    lines hash alike however an extract or a stored part typed them.
+    """
+    keys = frame[columns].copy()
+    for column in columns:
+        if pd.api.types.is_datetime64_any_dtype(keys[column]):
+            keys[column] = keys[column].astype("datetime64[ns]")
+        elif pd.api.types.is_numeric_dtype(keys[column]):
+            keys[column] = keys[column].astype("float64")
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def _months(frame):
+    """``YYYY-MM`` partition of every line, ``NULL_MONTH`` when undated."""
+    return frame[DATE_COLUMN].dt.strftime("%Y-%m").fillna(NULL_MONTH).to_numpy()
+
+
+def _in_month(month):
+    date = ds.field(DATE_COLUMN)
+    if month == NULL_MONTH:
+        return date.is_null()
+    start = pd.Timestamp(f"{month}-01")
+    return (date >= start) & (date < start + pd.offsets.MonthBegin(1))
+
+
+def _stored_keys(parts, month, columns, dataset_dir):
+    """Sorted keys of the stored lines of ``month``."""
+    parts = [part for part in parts if part_month(part) in (month, None)]
+    if not parts:
+        return np.empty(0, dtype=np.uint64)
+    stored = read_parts(parts, dataset_dir, filter=_in_month(month),
+                        columns=columns)
+    return np.sort(line_keys(stored, columns))
+
+
+def _occurrences(sorted_keys, keys):
+    """How often each of ``keys`` occurs in the sorted array ``sorted_keys``."""
+    return (np.searchsorted(sorted_keys, keys, side="right")
+            - np.searchsorted(sorted_keys, keys, side="left"))
+
+
+def _month_parts(frame, version, chunk):
+    """Split ``frame`` into ``(part, lines)`` per ``Creation Date`` month."""
+    for month, lines in frame.groupby(_months(frame), sort=True):
+        part = f"month={month}/part-{version:05d}-{chunk:04d}.parquet"
+        yield part, lines.sort_values(DATE_COLUMN, kind="stable")
+
+
+def ingest_frames(chunks, dataset_dir=DATASET_DIR, source_mtime=None):
+    """Append the new order lines of a parsed extract; returns a summary.
+
+    ``chunks`` yields the extract a frame at a time; they are stored as one
+    dataset version. ``late`` counts the new lines dated before the
+    watermark day. Holds :func:`core.data.dataset_lock` throughout.
+    """
+    with dataset_lock(dataset_dir):
+        manifest = read_manifest(dataset_dir)
+        if source_mtime is not None and manifest["source_mtime"] is not None \
+                and source_mtime <= manifest["source_mtime"]:
+            return {"version": manifest["version"], "added": 0,
+                    "duplicates": 0, "late": 0}
+
+        version = manifest["version"] + 1
+        watermark = None
+        if manifest["watermark"] is not None:
+            watermark = pd.Timestamp(manifest["watermark"]).normalize()
+        # Sorted keys of the stored lines per month, read as months come up,
+        # and of the extract lines seen so far.
+        stored = {}
+        seen = np.empty(0, dtype=np.uint64)
+        received = late = added = 0
+        earliest = latest = None
+        parts = []
+        cubes = []
+        for chunk, delta in enumerate(chunks):
+            received += len(delta)
+            columns = key_columns(delta)
+            keys = line_keys(delta, columns)
+            months = _months(delta)
+            copies = np.zeros(len(keys), dtype=np.int64)
+            for month in np.unique(months):
+                if month not in stored:
+                    stored[month] = _stored_keys(manifest["parts"], month,
+                                                 columns, dataset_dir)
+                in_month = months == month
+                copies[in_month] = _occurrences(stored[month], keys[in_month])
+            # Earlier extract lines with the same key used up stored copies.
+            rank = _occurrences(seen, keys) + \
+                pd.Series(keys).groupby(keys).cumcount().to_numpy()
+            seen = np.sort(np.concatenate([seen, keys]))
+            delta = delta[rank >= copies].reset_index(drop=True)
+            if not len(delta):
+                continue
+            added += len(delta)
+            if watermark is not None:
+                late += int((delta[DATE_COLUMN] < watermark).sum())
+
+            for part, lines in _month_parts(delta, version, chunk):
+                path = os.path.join(dataset_dir, part)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_part(lines, path, ROW_GROUP_ROWS)
+                parts.append(part)
+            cubes.append(build_cube(delta))
+            oldest, newest = delta[DATE_COLUMN].min(), delta[DATE_COLUMN].max()
+            if pd.notna(oldest) and (earliest is None or oldest < earliest):
+                earliest = oldest
+            if pd.notna(newest) and (latest is None or newest > latest):
+                latest = newest
+        duplicates = received - added
+
+        if added:
+            first_version = not manifest["parts"]
+            manifest["parts"].extend(parts)
+            manifest["rows"] += added
+            if latest is not None and (manifest["watermark"] is None or
+                                       latest > pd.Timestamp(manifest["watermark"])):
+                manifest["watermark"] = latest.isoformat()
+
+            cube_path = os.path.join(dataset_dir, CUBE_NAME)
+            delta_cube = combine_cubes(cubes)
+            if os.path.exists(cube_path) and \
+                    manifest["cube_version"] == manifest["version"]:
+                since = None if earliest is None else earliest.normalize()
+                write_cube(merge_cube(read_cube(cube_path), delta_cube,
+                                      since), dataset_dir)
+                manifest["cube_version"] = version
+            elif first_version:
+                write_cube(delta_cube, dataset_dir)
+                manifest["cube_version"] = version
+            manifest["version"] = version
+        if source_mtime is not None:
+            manifest["source_mtime"] = source_mtime
+        write_manifest(manifest, dataset_dir)
+        return {"version": manifest["version"], "added": added,
+                "duplicates": duplicates, "late": late}
+
+
+def ingest_frame(delta, dataset_dir=DATASET_DIR, source_mtime=None):
+    """Append the new order lines of one parsed frame; see :func:`ingest_frames`."""
+    return ingest_frames([delta], dataset_dir, source_mtime)
+
+
+def ingest_extract(csv_path, dataset_dir=DATASET_DIR, source_mtime=None):
+    """Parse and append a CSV extract in chunks; see :func:`ingest_frames`.
+
+    ``source_mtime`` is set when (re)ingesting the main ``df_new_3.csv``
+    extract, so the same file version is not ingested twice.
+    """
+    return ingest_frames(iter_extract(csv_path), dataset_dir, source_mtime)
+
+
+def main(argv=None):
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print(__doc__)
+        return 1
+    for path in paths:
+        summary = ingest_extract(path)
+        print(f"{path}: {summary['added']} new lines "
+              f"({summary['late']} dated before the watermark), "
+              f"{summary['duplicates']} duplicates "
+              f"(dataset version {summary['version']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Memory footprint of the shared in-process data.
+
+:func:`memory_report` measures every column of the shared dataset and daily
+cuboids plus the filter indexes built over them. The total is checked against
+``M3_MEMORY_BUDGET_MB`` (unset means no budget): the Home page shows the
+report in the sidebar and warns when the process is over budget, and
+``python -m core.memory`` prints it and exits non-zero when over budget.
+The panel also shows the size and hit rate of the shared tab result cache.
+"""
+import os
+import sys
+
+import pandas as pd
+import streamlit as st
+
+from core.cube import CUBE_NAME, cuboid_name, ensure_cube, load_cube, read_cube
+from core.data import (DATASET_DIR, MEMORY_MAP, OUT_OF_CORE, dataset_version,
+                       load_data, read_parts)
+from core.filters import (CubeIndex, FilterIndex, load_cube_index,
+                          load_data_index)
+from core.results import result_cache
+
+MEMORY_BUDGET_MB = float(os.environ.get("M3_MEMORY_BUDGET_MB") or 0) or None
+REPORT_COLUMNS = ["Object", "Column", "Type", "Bytes"]
+
+
+def memory_report(frames, indexes=None):
+    """Per-column deep memory usage of ``frames`` plus ``indexes`` totals.
+
+    ``frames`` and ``indexes`` map a display name to a DataFrame and a
+    filter index respectively.
+    """
+    rows = []
+    for name, frame in frames.items():
+        usage = frame.memory_usage(index=False, deep=True)
+        for column, size in usage.items():
+            rows.append((name, column, str(frame[column].dtype), int(size)))
+    for name, index in (indexes or {}).items():
+        rows.append((name, "", "index", int(index.nbytes)))
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    return report.sort_values("Bytes", ascending=False, ignore_index=True)
+
+
+def over_budget(report, budget_mb=MEMORY_BUDGET_MB):
+    return budget_mb is not None and report["Bytes"].sum() > budget_mb * 2 ** 20
+
+
+def cube_frames(cube):
+    """The cuboids of ``cube`` by display name."""
+    return {f"Cube ({cuboid_name(dimensions)})": frame
+            for dimensions, frame in cube.items()}
+
+
+def shared_memory_report():
+    """Report on the data every session of this server process shares."""
+    if OUT_OF_CORE:
+        return memory_report(cube_frames(load_cube()),
+                             {"Cube index": load_cube_index()})
+    # A mapped dataset is resident once per host, not once per process.
+    dataset = "Dataset (memory-mapped)" if MEMORY_MAP else "Dataset"
+    return memory_report(
+        {dataset: load_data(), **cube_frames(load_cube())},
+        {"Dataset index": load_data_index(), "Cube index": load_cube_index()})
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _shared_memory_report(version):
+    # ``version`` is only part of the cache key so new data is measured again.
+    return shared_memory_report()
+
+
+def memory_panel(budget_mb=MEMORY_BUDGET_MB):
+    """Sidebar expander with the shared memory report, measured once per
+    dataset version."""
+    report = _shared_memory_report(dataset_version())
+    total_mb = report["Bytes"].sum() / 2 ** 20
+    if over_budget(report, budget_mb):
+        st.sidebar.warning(
+            f"Shared data uses {total_mb:,.1f} MB, over the "
+            f"{budget_mb:,.0f} MB memory budget.")
+    with st.sidebar.expander("Memory Usage"):
+        budget = f" of {budget_mb:,.0f} MB" if budget_mb else ""
+        st.metric("Shared data", f"{total_mb:,.1f} MB{budget}")
+        st.dataframe(report.assign(MB=report["Bytes"] / 2 ** 20)
+                     .drop(columns="Bytes"), hide_index=True)
+        cache = result_cache().stats()
+        st.caption(
+            f"Result cache: {cache['entries']} results, "
+            f"{cache['bytes'] / 2 ** 20:,.1f} of "
+            f"{cache['budget'] / 2 ** 20:,.0f} MB, {cache['hits']} hits and "
+            f"{cache['misses']} misses ({cache['hit_rate']:.0%} hit rate)")
+
+
+def main():
+    manifest = ensure_cube()
+    cube = read_cube(os.path.join(DATASET_DIR, CUBE_NAME))
+    frames = cube_frames(cube)
+    indexes = {"Cube index": CubeIndex(cube)}
+    if not OUT_OF_CORE:
+        frames["Dataset"] = frame = read_parts(manifest["parts"])
+        indexes["Dataset index"] = FilterIndex(frame)
+    report = memory_report(frames, indexes)
+    print(report.assign(MB=(report["Bytes"] / 2 ** 20).round(2))
+          .drop(columns="Bytes").to_string(index=False))
+    total_mb = report["Bytes"].sum() / 2 ** 20
+    budget = f" (budget {MEMORY_BUDGET_MB:,.0f} MB)" if MEMORY_BUDGET_MB else ""
+    print(f"Total: {total_mb:,.1f} MB{budget}")
+    return 1 if over_budget(report) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
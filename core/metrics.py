@@ -0,0 +1,181 @@
+"""Timings of each stage of a page run, exported to Prometheus.
+
+Every page calls :func:`start_page` first. Stages are then timed with
+:func:`stage` (data load and filter application on the pages) or with the
+:func:`timed` decorator on the shared aggregation primitives, and
+attributed to the page and to the tab whose results are being computed
+(set by :func:`core.ui.memoize`). Whatever a tab's compute spends outside
+timed stages is recorded as its figure construction, and
+:func:`core.ui.plotly_chart` records rendering time and, when
+:func:`metrics_enabled`, payload size.
+
+Observations go to the ``m3_stage_seconds`` and ``m3_payload_bytes``
+histograms, served on ``M3_METRICS_PORT`` when it is set. With
+``M3_DEBUG_PANEL=1`` (or ``?debug=1`` in the URL) :func:`debug_panel` shows
+the breakdown of the current rerun.
+"""
+import contextvars
+import functools
+import os
+import time
+import weakref
+from contextlib import contextmanager
+
+import pandas as pd
+import plotly.io as pio
+import streamlit as st
+from prometheus_client import Histogram, start_http_server
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+METRICS_PORT = int(os.environ.get("M3_METRICS_PORT", "0")) or None
+DEBUG_PANEL = os.environ.get("M3_DEBUG_PANEL", "") == "1"
+
+STAGE_SECONDS = Histogram(
+    "m3_stage_seconds", "Time spent per page, tab and stage.",
+    ["page", "tab", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+             30, 60))
+PAYLOAD_BYTES = Histogram(
+    "m3_payload_bytes", "Serialized size of the charts sent to the browser.",
+    ["page", "tab"],
+    buckets=(1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 5e7))
+
+# (page, tab) the running stages belong to.
+_context = contextvars.ContextVar("m3_stage_context", default=("", ""))
+# Seconds per stage within the running tab compute, observed as one total.
+_tab_stages = contextvars.ContextVar("m3_tab_stages", default=None)
+_active = contextvars.ContextVar("m3_stage_active", default=False)
+# Event of the background computation running in this context; once it is
+# set the computation stops at its next stage.
+cancel_event = contextvars.ContextVar("m3_cancel_event", default=None)
+_payload_sizes = {}
+
+
+@st.cache_resource(show_spinner=False)
+def _exporter(port):
+    start_http_server(port)
+    return port
+
+
+def start_page(page):
+    """Attribute the stages of this rerun to ``page``."""
+    if METRICS_PORT:
+        _exporter(METRICS_PORT)
+    _context.set((page, ""))
+    st.session_state["_stage_timings"] = []
+
+
+def set_tab(tab):
+    """Attribute the following stages to ``tab`` of the current page."""
+    _context.set((_context.get()[0], tab))
+
+
+def record(stage, seconds=None, size=None):
+    """Observe ``seconds`` spent in ``stage`` and/or a payload ``size``."""
+    tab_stages = _tab_stages.get()
+    if seconds is not None and tab_stages is not None:
+        tab_stages[stage] = tab_stages.get(stage, 0.0) + seconds
+        return
+    page, tab = _context.get()
+    if seconds is not None:
+        STAGE_SECONDS.labels(page, tab, stage).observe(seconds)
+    if size is not None:
+        PAYLOAD_BYTES.labels(page, tab).observe(size)
+    # Background threads (e.g. segment forecasts) have no session.
+    timings = st.session_state.get("_stage_timings") \
+        if get_script_run_ctx(suppress_warning=True) else None
+    if timings is not None:
+        timings.append({"tab": tab, "stage": stage, "seconds": seconds,
+                        "bytes": size})
+
+
+class Cancelled(Exception):
+    """Raised by :func:`stage` in a computation that was cancelled."""
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage ``name``; nested stages are folded
+    into the outermost one.
+
+    Every stage is also a cancellation point (see ``cancel_event``).
+    """
+    event = cancel_event.get()
+    if event is not None and event.is_set():
+        raise Cancelled(name)
+    if _active.get():
+        yield
+        return
+    token = _active.set(True)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active.reset(token)
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator form of :func:`stage`."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def compute_tab(tab, compute):
+    """Run a tab's ``compute``, recording one total per stage within it and
+    the untimed remainder as "figure"."""
+    set_tab(tab)
+    tab_stages = {}
+    token = _tab_stages.set(tab_stages)
+    start = time.perf_counter()
+    try:
+        return compute()
+    finally:
+        elapsed = time.perf_counter() - start
+        _tab_stages.reset(token)
+        for name, seconds in tab_stages.items():
+            record(name, seconds)
+        record("figure", max(elapsed - sum(tab_stages.values()), 0.0))
+
+
+def payload_size(fig):
+    """Bytes of the JSON sent for ``fig``, computed once per figure object.
+
+    Memoised figures are re-sent on every rerun, so the size is cached until
+    the figure is garbage-collected (figures are not hashable).
+    """
+    key = id(fig)
+    if key not in _payload_sizes:
+        _payload_sizes[key] = len(pio.to_json(fig, validate=False))
+        weakref.finalize(fig, _payload_sizes.pop, key, None)
+    return _payload_sizes[key]
+
+
+def debug_enabled():
+    """Whether this session shows the :func:`debug_panel`."""
+    return DEBUG_PANEL or st.query_params.get("debug") == "1"
+
+
+def metrics_enabled():
+    """Whether anything reads the observations of this rerun.
+
+    Measurements that cost work of their own (e.g. payload sizes) are only
+    taken then.
+    """
+    return bool(METRICS_PORT) or debug_enabled()
+
+
+def debug_panel():
+    """Sidebar breakdown of this rerun's stages, when enabled."""
+    if not debug_enabled():
+        return
+    timings = pd.DataFrame(st.session_state.get("_stage_timings", []),
+                           columns=["tab", "stage", "seconds", "bytes"])
+    with st.sidebar.expander("⏱ Performance", expanded=True):
+        st.metric("Timed stages", f"{timings['seconds'].sum() * 1000:,.0f} ms")
+        st.dataframe(timings, hide_index=True)
@@ -0,0 +1,233 @@
+"""Store of fitted time-series model results.
+
+Model fits (seasonal decomposition, Holt-Winters forecasts) are keyed by a
+fingerprint of the input series, the model kind and its parameters. Results
+are kept as Parquet files under ``MODEL_DIR`` so every session, and every
+server restart, reuses them. Missing results are fitted in a background
+process pool; callers get ``None`` back until the fit has finished and can
+show a placeholder with :func:`wait_for` instead of blocking the page. A
+failed fit is shown with its error and retried on request, or by the next
+request once ``M3_MODEL_RETRY_SECONDS`` have passed.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import streamlit as st
+from cachetools import LRUCache
+
+from core.data import DATASET_DIR
+from core.metrics import timed
+
+MODEL_DIR = os.environ.get("M3_MODEL_DIR", os.path.join(DATASET_DIR, "models"))
+MODEL_WORKERS = int(os.environ.get("M3_MODEL_WORKERS", "2"))
+POLL_SECONDS = 2
+# Seconds a failed fit is reported before the next request tries again.
+ERROR_TTL = float(os.environ.get("M3_MODEL_RETRY_SECONDS", "300"))
+
+
+def pool_context():
+    """Multiprocessing context for worker pools.
+
+    Streamlit executes pages as ``__main__``, which "spawn" workers would
+    re-run on start-up, so "fork" is used wherever the platform offers it.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("spawn")
+
+
+def fingerprint(series, kind, params):
+    """Stable key for fitting ``kind`` with ``params`` on ``series``."""
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(pd.util.hash_pandas_object(series).to_numpy().tobytes())
+    return digest.hexdigest()[:32]
+
+
+def fit_decomposition(series, period, model="additive"):
+    """Seasonal decomposition as a frame of observed/trend/seasonal/resid."""
+    from statsmodels.tsa.seasonal import seasonal_decompose
+
+    result = seasonal_decompose(series, model=model, period=period)
+    return pd.DataFrame({"observed": result.observed, "trend": result.trend,
+                         "seasonal": result.seasonal, "resid": result.resid})
+
+
+def fit_holt_winters(series, steps, trend="add", seasonal="add",
+                     seasonal_periods=30):
+    """Holt-Winters forecast of the next ``steps`` periods."""
+    from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+    model = ExponentialSmoothing(series, trend=trend, seasonal=seasonal,
+                                 seasonal_periods=seasonal_periods)
+    forecast = model.fit().forecast(steps=steps)
+    return forecast.rename("forecast").to_frame()
+
+
+FITTERS = {"decomposition": fit_decomposition,
+           "holt_winters": fit_holt_winters}
+
+
+def _fit(kind, series, params):
+    # Runs in a worker process.
+    return FITTERS[kind](series, **params)
+
+
+class FitErrors:
+    """Errors of failed background fits, by key.
+
+    An error is forgotten ``ERROR_TTL`` seconds after the failure, or at
+    once on :meth:`retry`, so that the next request fits again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = {}
+
+    def _failed(self, key, error):
+        # Call with ``lock`` held.
+        self.errors[key] = (error, time.monotonic())
+
+    def _error(self, key):
+        # Call with ``lock`` held.
+        if key not in self.errors:
+            return None
+        error, failed_at = self.errors[key]
+        if time.monotonic() - failed_at > ERROR_TTL:
+            del self.errors[key]
+            return None
+        return error
+
+    def error(self, key):
+        """The error of the failed fit of ``key``, or None."""
+        with self.lock:
+            return self._error(key)
+
+    def retry(self, key):
+        """Forget the failure of ``key`` so that it is fitted again."""
+        with self.lock:
+            self.errors.pop(key, None)
+
+
+class ModelStore(FitErrors):
+    """Disk-backed model results with an in-memory LRU and background fits."""
+
+    def __init__(self, model_dir=MODEL_DIR, workers=MODEL_WORKERS):
+        super().__init__()
+        self.model_dir = model_dir
+        self.workers = workers
+        self.memory = LRUCache(maxsize=64)
+        self.pending = {}
+        self._executor = None
+
+    def _path(self, key):
+        return os.path.join(self.model_dir, f"{key}.parquet")
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=pool_context())
+        return self._executor
+
+    def get(self, key):
+        """Stored result for ``key``, or None."""
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key]
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        result = pd.read_parquet(path)
+        with self.lock:
+            self.memory[key] = result
+        return result
+
+    def put(self, key, result):
+        os.makedirs(self.model_dir, exist_ok=True)
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        result.to_parquet(tmp_path)
+        os.replace(tmp_path, self._path(key))
+        with self.lock:
+            self.memory[key] = result
+
+    def status(self, key):
+        """One of "ready", "fitting", "failed" or "missing"."""
+        with self.lock:
+            if key in self.pending:
+                return "fitting"
+            if self._error(key) is not None:
+                return "failed"
+        return "ready" if self.get(key) is not None else "missing"
+
+    def submit(self, key, kind, series, params):
+        """Start a background fit unless one is already running for ``key``."""
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            self.errors.pop(key, None)
+            future = self.executor.submit(_fit, kind, series, params)
+            self.pending[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        try:
+            self.put(key, future.result())
+        except Exception as error:  # Surface the failure to the page.
+            with self.lock:
+                self._failed(key, error)
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    @timed("model")
+    def request(self, kind, series, params, background=True):
+        """Return ``(key, result)``; result is None while the fit runs."""
+        key = fingerprint(series, kind, params)
+        result = self.get(key)
+        if result is None and self.error(key) is None:
+            if background:
+                self.submit(key, kind, series, params)
+            else:
+                result = _fit(kind, series, params)
+                self.put(key, result)
+        return key, result
+
+
+@st.cache_resource(show_spinner=False)
+def model_store():
+    """The process-wide model store."""
+    return ModelStore()
+
+
+def wait_for(key, message="Fitting model in the background...", store=None):
+    """Show a placeholder and rerun the page once ``key`` has been fitted.
+
+    A failed fit is shown with its error and a button to retry it. ``store``
+    is anything with ``status(key)`` and the :class:`FitErrors` methods; it
+    defaults to the model store.
+    """
+    store = store or model_store()
+
+    @st.fragment(run_every=POLL_SECONDS)
+    def _poll():
+        error = store.error(key)
+        if error is not None:
+            st.error(f"Model fit failed: {type(error).__name__}: {error}")
+            if st.button("Retry", key=f"retry_{key}"):
+                store.retry(key)
+                st.rerun()
+        elif store.status(key) == "fitting":
+            st.info(message)
+        else:
+            st.rerun()
+
+    _poll()
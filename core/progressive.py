@@ -0,0 +1,366 @@
+"""Progressive rendering: instant estimates from a sample, refined to exact.
+
+With progressive rendering on (:func:`progressive_toggle`, defaulting to
+``M3_PROGRESSIVE``), :func:`core.ui.memoize` starts a tab's exact
+computation in a background thread and gives it half of the
+``M3_PROGRESSIVE_TARGET_MS`` latency target. If it is not done by then, the
+tab is computed again from a stratified sample of the order lines and drawn
+at once, titled as an estimate, with 95% confidence bands on the line
+charts of sums and counts. The page reruns with the exact result as soon as
+it is ready. When a session asks for a tab with other filters, its
+refinement of that tab for the old filters is cancelled (at the next timed
+stage) unless another session still waits for it.
+
+The sample holds about ``M3_SAMPLE_LINES`` lines, drawn independently in
+each Department × month stratum (at least ``MIN_STRATUM_LINES`` of a
+stratum where it has them), each line weighted by its stratum's lines per
+sampled line. It is stored next to the dataset for each version and indexed
+like the data: the sampled lines, and the weighted cube built from them
+(see ``core.cube.build_cube``). Pages select through
+:func:`progressive_select`, whose selections read the sample while an
+estimate is being computed.
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from cachetools import LRUCache
+from plotly.basedatatypes import BaseFigure
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from core.cube import (CUBE_NAME, FULL_GRAIN, LINES, SAMPLED, STRATUM, WEIGHT,
+                       build_cube, ensure_cube, read_cube)
+from core.data import DATASET_DIR, concat_frames, dataset_lock, scan_parts
+from core.filters import CubeIndex, FilterIndex, Selection, aggregate_rows
+from core.metrics import Cancelled, cancel_event, compute_tab, timed
+from core.models import FitErrors, wait_for
+from core.results import result_cache
+
+PROGRESSIVE = os.environ.get("M3_PROGRESSIVE", "") == "1"
+SAMPLE_LINES = int(os.environ.get("M3_SAMPLE_LINES", "100000"))
+TARGET_SECONDS = int(os.environ.get("M3_PROGRESSIVE_TARGET_MS", "1000")) / 1000
+REFINE_WORKERS = int(os.environ.get("M3_REFINE_WORKERS", "2"))
+MIN_STRATUM_LINES = 30
+STRATA = ["Department", "Year", "Month"]
+SAMPLE_PREFIX = "sample-"
+TOGGLE_KEY = "progressive"
+
+# True while a tab is being estimated from the sample.
+_estimating = contextvars.ContextVar("m3_estimating", default=False)
+
+
+def stratum_plan(cube):
+    """Lines and sampling probability of each Department × month stratum."""
+    strata = cube[("Department",)].groupby(STRATA, observed=True, dropna=False)[LINES].sum()
+    strata = strata[strata > 0].reset_index()
+    strata[STRATUM] = np.arange(len(strata), dtype=np.int32)
+    fraction = min(1.0, SAMPLE_LINES / max(strata[LINES].sum(), 1))
+    strata["Probability"] = np.minimum(
+        1.0, np.maximum(fraction, MIN_STRATUM_LINES / strata[LINES]))
+    return strata
+
+
+@timed("sample")
+def build_sample(parts, cube, dataset_dir=DATASET_DIR, seed=0):
+    """Draw the stratified sample of the lines in ``parts``.
+
+    Adds each line's ``STRATUM``, the number of lines ``SAMPLED`` from it
+    and the ``WEIGHT`` (stratum lines per sampled line) of the line.
+    """
+    strata = stratum_plan(cube)
+    rng = np.random.default_rng(seed)
+    chunks = []
+    for chunk in scan_parts(parts, dataset_dir):
+        keyed = chunk[STRATA].merge(strata[STRATA + [STRATUM, "Probability"]],
+                                    how="left", on=STRATA)
+        keep = rng.random(len(chunk)) < keyed["Probability"].to_numpy()
+        chunks.append(chunk[keep].assign(
+            **{STRATUM: keyed[STRATUM].to_numpy()[keep]}))
+    sample = concat_frames(chunks).reset_index(drop=True)
+    sampled = sample[STRATUM].map(sample[STRATUM].value_counts())
+    sample[SAMPLED] = sampled.astype(np.int32)
+    sample[WEIGHT] = sample[STRATUM].map(
+        strata.set_index(STRATUM)[LINES]) / sampled
+    return sample
+
+
+def ensure_sample(dataset_dir=DATASET_DIR):
+    """Path of the sample of the current dataset version, drawn if missing."""
+    manifest = ensure_cube(dataset_dir)
+    path = os.path.join(dataset_dir, f"{SAMPLE_PREFIX}{manifest['version']:05d}"
+                                     f"-{SAMPLE_LINES}.parquet")
+    if os.path.exists(path):
+        return path
+    with dataset_lock(dataset_dir):
+        if os.path.exists(path):  # Drawn by another process meanwhile.
+            return path
+        cube = read_cube(os.path.join(dataset_dir, CUBE_NAME))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        build_sample(manifest["parts"], cube, dataset_dir).to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        for name in os.listdir(dataset_dir):
+            if name.startswith(SAMPLE_PREFIX) and name.endswith(".parquet") \
+                    and name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(dataset_dir, name))
+                except OSError:
+                    pass
+    return path
+
+
+class SampleSelection(Selection):
+    """Sampled lines matching a filter state; aggregates are estimates."""
+
+    @timed("aggregation")
+    def aggregate(self, by, agg):
+        """Weighted :func:`core.filters.aggregate_rows` of the sample."""
+        frame = self.frame
+        weight = frame[WEIGHT]
+        columns, weighted = {}, {}
+        for name, (column, func) in agg.items():
+            if func in ("size", "sum", "count"):
+                values = weight if func == "size" else \
+                    frame[column].mul(weight) if func == "sum" else \
+                    frame[column].notna().mul(weight)
+                columns[f"{name}:w"] = values
+                weighted[name] = (f"{name}:w", "sum")
+            else:  # min and max need no weighting.
+                weighted[name] = (column, func)
+        return aggregate_rows(frame.assign(**columns), by, weighted)
+
+
+class SampleIndex:
+    """Filter indexes over the sampled lines and over their weighted cube,
+    kept at full grain since it is no bigger than the sample."""
+
+    def __init__(self, sample):
+        # Scales histogram counts back up (see ``core.reduce``).
+        sample.attrs["sample_fraction"] = len(sample) / sample[WEIGHT].sum()
+        strata = sample.groupby(STRATA, observed=True, dropna=False)[
+            [STRATUM, WEIGHT, SAMPLED]].first().reset_index()
+        cube = build_cube(sample, sample[WEIGHT], [FULL_GRAIN])[
+            FULL_GRAIN].merge(strata, how="left", on=STRATA)
+        self.rows = FilterIndex(sample)
+        self.cube = CubeIndex({FULL_GRAIN: cube})
+
+    def select(self, selections=None, date_range=None, rows=False):
+        if rows:
+            return SampleSelection(self.rows.frame,
+                                   self.rows.rows(selections, date_range))
+        return self.cube.select(selections, date_range)
+
+
+@st.cache_resource(max_entries=1, show_spinner="Sampling purchase data...")
+def _sample_index(path):
+    return SampleIndex(pd.read_parquet(path))
+
+
+def load_sample_index():
+    """The shared sample index for the current dataset version."""
+    return _sample_index(ensure_sample())
+
+
+class ProgressiveSelection:
+    """An exact selection that reads the sample while a tab is estimated."""
+
+    def __init__(self, exact, selections, date_range, rows):
+        self.exact = exact
+        self.selections = selections
+        self.date_range = date_range
+        self.rows = rows
+
+    @cached_property
+    def sampled(self):
+        return load_sample_index().select(self.selections, self.date_range,
+                                          self.rows)
+
+    def _current(self):
+        return self.sampled if _estimating.get() else self.exact
+
+    def __len__(self):
+        return len(self._current())
+
+    @property
+    def frame(self):
+        return self._current().frame
+
+    def aggregate(self, by, agg):
+        return self._current().aggregate(by, agg)
+
+    def cover(self, columns=()):
+        return self._current().cover(columns)
+
+    def where(self, selections):
+        return self._current().where(selections)
+
+    def nunique(self, column):
+        return self._current().nunique(column)
+
+
+def progressive_toggle():
+    """Sidebar switch for progressive rendering."""
+    return st.sidebar.toggle(
+        "Progressive rendering", value=PROGRESSIVE, key=TOGGLE_KEY,
+        help="Charts that take long to compute are first estimated from a "
+             "sample, with confidence bands, and replaced by the exact "
+             "figures once ready.")
+
+
+def progressive_select(index, selections=None, date_range=None,
+                       progressive=False, rows=False):
+    """``index.select(...)``, able to answer from the sample when
+    ``progressive``; ``rows`` tells a row-level index from a cube index."""
+    exact = index.select(selections, date_range)
+    if not progressive:
+        return exact
+    return ProgressiveSelection(exact, selections, date_range, rows)
+
+
+def progressive_enabled():
+    return bool(st.session_state.get(TOGGLE_KEY, False))
+
+
+def _run(event, compute):
+    cancel_event.set(event)
+    return compute()
+
+
+class Refiner(FitErrors):
+    """Exact tab results computed in background threads.
+
+    Each job is shared by the sessions waiting for it and cancelled once
+    none of them does; finished jobs are kept until collected.
+    """
+
+    def __init__(self, workers=REFINE_WORKERS):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="m3-refine")
+        self.jobs = {}
+        self.finished = LRUCache(maxsize=32)
+
+    def submit(self, key, compute, session):
+        """Future of ``compute()`` for ``key``, started unless running."""
+        with self.lock:
+            if key in self.finished:
+                return self.finished[key]
+            if key in self.jobs:
+                future, _, sessions = self.jobs[key]
+                sessions.add(session)
+                return future
+            self.errors.pop(key, None)
+            event = threading.Event()
+            # Keeps the page and tab the stages are attributed to.
+            context = contextvars.copy_context()
+            future = self.executor.submit(context.run, _run, event, compute)
+            self.jobs[key] = (future, event, {session})
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self.lock:
+            if key in self.jobs and self.jobs[key][0] is future:
+                del self.jobs[key]
+            if future.cancelled() or isinstance(future.exception(), Cancelled):
+                return
+            if future.exception() is not None:
+                self._failed(key, future.exception())
+            self.finished[key] = future
+
+    def collect(self, key):
+        with self.lock:
+            self.finished.pop(key, None)
+
+    def release(self, key, session):
+        """Stop waiting for ``key`` for ``session``; cancels it if unwanted."""
+        with self.lock:
+            if key not in self.jobs:
+                return
+            future, event, sessions = self.jobs[key]
+            sessions.discard(session)
+            if sessions:
+                return
+            del self.jobs[key]
+        event.set()
+        future.cancel()
+
+    def status(self, key):
+        """One of "fitting", "failed" or "ready", as ``wait_for`` expects."""
+        with self.lock:
+            if key in self.jobs:
+                return "fitting"
+            if self._error(key) is not None:
+                return "failed"
+        return "ready"
+
+    def retry(self, key):
+        """Forget the failed job of ``key`` so that it is computed again."""
+        with self.lock:
+            self.errors.pop(key, None)
+            self.finished.pop(key, None)
+
+
+@st.cache_resource(show_spinner=False)
+def refiner():
+    """The process-wide background refiner."""
+    return Refiner()
+
+
+def mark_estimate(result):
+    """Title the figures of a tab result as estimates."""
+    parts = result if type(result) is tuple else (result,)
+    for part in parts:
+        if isinstance(part, BaseFigure):
+            title = part.layout.title.text
+            part.update_layout(
+                title_text=f"{title} (estimate)" if title else "Estimate")
+    return result
+
+
+def estimate(tab, compute):
+    """``compute()`` for ``tab`` with progressive selections on the sample."""
+    token = _estimating.set(True)
+    try:
+        return mark_estimate(compute_tab(tab, compute))
+    finally:
+        _estimating.reset(token)
+
+
+def refine(name, state, version, exact, compute):
+    """Progressive form of :func:`core.ui.memoize`.
+
+    Returns the exact result when it is cached or computed within half the
+    latency target, else an estimate, and reruns the page once the exact
+    result is ready.
+    """
+    cache = result_cache()
+    jobs = refiner()
+    key = (name, state, version)
+    found, result = cache.peek(name, state, version)
+    if found:
+        jobs.collect(key)
+        return result
+    ctx = get_script_run_ctx(suppress_warning=True)
+    session = ctx.session_id if ctx else None
+    # The same tab asked for with other filters: the old result is stale.
+    refining = st.session_state.setdefault("_refining", {})
+    if refining.get(name, key) != key:
+        jobs.release(refining[name], session)
+    refining[name] = key
+
+    future = jobs.submit(
+        key, lambda: cache.get(name, state, version, exact), session)
+    if future in wait([future], timeout=TARGET_SECONDS / 2).done:
+        jobs.collect(key)
+        del refining[name]
+        return future.result()
+    result = cache.get(f"{name}:estimate", state, version,
+                       lambda: estimate(name.rsplit("/", 1)[-1], compute))
+    wait_for(key, "Showing estimates from a sample while the exact figures "
+                  "are computed...", store=jobs)
+    return result
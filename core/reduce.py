@@ -0,0 +1,223 @@
+"""Server-side reduction of chart payloads.
+
+Sits between the pandas code and Plotly so figure size no longer grows with
+the number of order lines: line series are downsampled with LTTB, box plots
+and histograms are drawn from statistics computed here, large point clouds
+become a sampled WebGL scatter or a density heatmap, and bar charts are
+capped to their largest categories. Every builder takes a point ``budget``
+(defaulting to ``POINT_BUDGET``) bounding what is sent to the browser.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from core.metrics import timed
+
+POINT_BUDGET = int(os.environ.get("M3_POINT_BUDGET", "5000"))
+# Per-series floor so a multi-series line chart keeps every series readable.
+MIN_SERIES_POINTS = 50
+OTHER_LABEL = "Other"
+BOX_STATS = ["q1", "median", "q3", "lowerfence", "upperfence", "mean"]
+
+
+def lttb(x, y, n_out):
+    """Indices of the Largest-Triangle-Three-Buckets downsample of ``(x, y)``.
+
+    ``x`` must be sorted; datetimes are handled as nanosecond integers.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype("datetime64[ns]").astype(np.int64)
+    x = x.astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.nanargmax(area)) if len(area) else start
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_series(frame, x, y, color=None, budget=None):
+    """Downsample every series of a (multi-series) line chart to the budget."""
+    budget = budget or POINT_BUDGET
+    if len(frame) <= budget:
+        return frame
+    if color is None:
+        frame = frame.sort_values(x)
+        return frame.iloc[lttb(frame[x].to_numpy(), frame[y].to_numpy(), budget)]
+    groups = frame.groupby(color, observed=True, sort=False)
+    per_series = max(budget // max(groups.ngroups, 1), MIN_SERIES_POINTS)
+    parts = []
+    for _, series in groups:
+        series = series.sort_values(x)
+        parts.append(series.iloc[lttb(series[x].to_numpy(),
+                                      series[y].to_numpy(), per_series)])
+    return pd.concat(parts)
+
+
+def add_bands(fig, frame, x, y, margin, color=None):
+    """Shade ``y ± margin`` behind each line of ``fig``, in its colour."""
+    colors = {trace.name: trace.line.color for trace in fig.data}
+    groups = frame.groupby(color, observed=True, sort=False) if color \
+        else [("", frame)]
+    bands = []
+    for name, series in groups:
+        series = series.sort_values(x)
+        low, high = series[y] - series[margin], series[y] + series[margin]
+        bands.append(go.Scatter(
+            x=np.concatenate([series[x], series[x][::-1]]),
+            y=np.concatenate([high, low[::-1]]), fill="toself",
+            fillcolor=colors.get(str(name)), opacity=0.2, mode="none",
+            hoverinfo="skip", showlegend=False, legendgroup=str(name)))
+    fig.add_traces(bands)
+    # Behind the lines.
+    fig.data = fig.data[-len(bands):] + fig.data[:-len(bands)]
+
+
+def line_figure(frame, x, y, color=None, budget=None, **kwargs):
+    """``px.line`` over the LTTB-downsampled series.
+
+    The x axis names the time bucket of frames from
+    :func:`core.cube.time_rollup`, and estimates from a sample are drawn
+    with their 95% confidence band.
+    """
+    granularity = frame.attrs.get("granularity")
+    margin = frame.attrs.get("margins", {}).get(y)
+    frame = downsample_series(frame, x, y, color, budget)
+    fig = px.line(frame, x=x, y=y, color=color, **kwargs)
+    if margin:
+        add_bands(fig, frame, x, y, margin, color)
+    if granularity:
+        fig.update_xaxes(title=f"{x} ({granularity.lower()})")
+    return fig
+
+
+@timed("aggregation")
+def limit_categories(frame, column, value, limit):
+    """Keep the ``limit`` largest ``column`` values by ``value``, lump the rest."""
+    totals = frame.groupby(column, observed=True)[value].sum()
+    if len(totals) <= limit:
+        return frame
+    keep = totals.nlargest(limit - 1).index
+    labels = frame[column].astype(object).where(
+        frame[column].isin(keep), OTHER_LABEL)
+    others = [c for c in frame.columns if c not in (column, value)]
+    return frame.assign(**{column: labels}).groupby(
+        [column] + others, observed=True, sort=False)[value].sum().reset_index()
+
+
+def box_stats(frame, x, y):
+    """Quartiles, Tukey whiskers and outliers of ``y`` per ``x`` group."""
+    values = frame[[x, y]].dropna()
+    if values.empty:
+        return pd.DataFrame(columns=BOX_STATS, index=pd.Index([], name=x),
+                            dtype=float), values
+    grouped = values.groupby(x, observed=True)[y]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ["q1", "median", "q3"]
+    iqr = stats["q3"] - stats["q1"]
+    low = values[x].map(stats["q1"] - 1.5 * iqr).astype(float)
+    high = values[x].map(stats["q3"] + 1.5 * iqr).astype(float)
+    inside = (values[y] >= low) & (values[y] <= high)
+    fenced = values[inside].groupby(x, observed=True)[y]
+    stats["lowerfence"] = fenced.min()
+    stats["upperfence"] = fenced.max()
+    stats["mean"] = grouped.mean()
+    return stats, values[~inside]
+
+
+def box_figure(frame, x, y, budget=None, title=None, **layout):
+    """Box plot per ``x`` group drawn from statistics computed server-side.
+
+    Only up to ``budget`` outliers are shipped, sampled uniformly. An empty
+    selection gives a figure without traces.
+    """
+    budget = budget or POINT_BUDGET
+    stats, outliers = box_stats(frame, x, y)
+    if stats.empty:
+        fig = go.Figure()
+        fig.update_layout(title=title, xaxis_title=x, yaxis_title=y, **layout)
+        return fig
+    if len(outliers) > budget:
+        outliers = outliers.sample(budget, random_state=0)
+    outliers = outliers.groupby(x, observed=True)[y]
+    colors = px.colors.qualitative.Plotly
+    fig = go.Figure()
+    for i, (name, row) in enumerate(stats.iterrows()):
+        color = colors[i % len(colors)]
+        fig.add_trace(go.Box(
+            name=str(name), legendgroup=str(name), marker_color=color,
+            q1=[row["q1"]], median=[row["median"]], q3=[row["q3"]],
+            lowerfence=[row["lowerfence"]], upperfence=[row["upperfence"]],
+            mean=[row["mean"]]))
+        if name in outliers.groups:
+            points = outliers.get_group(name)
+            fig.add_trace(go.Scattergl(
+                x=[str(name)] * len(points), y=points, mode="markers",
+                legendgroup=str(name), showlegend=False,
+                marker={"size": 4, "color": color}))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y, **layout)
+    return fig
+
+
+def histogram_figure(frame, x, nbins=20, title=None, **layout):
+    """Histogram with the bins counted server-side.
+
+    Counts are scaled back up when ``frame`` is a sample of the selection.
+    """
+    values = frame[x].dropna().to_numpy()
+    counts, edges = np.histogram(values, bins=nbins)
+    fraction = frame.attrs.get("sample_fraction", 1.0)
+    if fraction < 1:
+        counts = np.round(counts / fraction)
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts,
+                           width=np.diff(edges), name=x))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title="count",
+                      bargap=0, **layout)
+    return fig
+
+
+def scatter_figure(frame, x, y, budget=None, density_factor=20, title=None,
+                   **kwargs):
+    """Scatter plot bounded by ``budget`` points.
+
+    Up to ``budget`` rows are drawn as-is; up to ``density_factor`` times the
+    budget a uniform sample is drawn with WebGL; beyond that the cloud is
+    shown as a 2-D density heatmap binned server-side.
+    """
+    budget = budget or POINT_BUDGET
+    frame = frame.dropna(subset=[x, y])
+    n = len(frame)
+    if n > budget * density_factor:
+        bins = int(np.sqrt(budget))
+        counts, x_edges, y_edges = np.histogram2d(
+            frame[x].to_numpy(float), frame[y].to_numpy(float), bins=bins)
+        fig = go.Figure(go.Heatmap(
+            x=(x_edges[:-1] + x_edges[1:]) / 2,
+            y=(y_edges[:-1] + y_edges[1:]) / 2,
+            z=np.where(counts.T > 0, counts.T, np.nan),
+            colorscale="Viridis", colorbar={"title": "lines"}))
+        fig.update_layout(title=f"{title} (density of {n:,} lines)",
+                          xaxis_title=x, yaxis_title=y)
+        return fig
+    if n > budget:
+        frame = frame.sample(budget, random_state=0)
+        title = f"{title} (sample of {budget:,} of {n:,})"
+    return px.scatter(frame, x=x, y=y, title=title, render_mode="webgl",
+                      **kwargs)
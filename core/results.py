@@ -0,0 +1,113 @@
+"""Tab results shared by every session of the server process.
+
+A tab's charts and tables depend only on the page, the tab, the sidebar
+filter state and the dataset, so :class:`ResultCache` keys them by the tab
+name, the normalized filter state from :func:`core.filters.filter_key`
+(order-insensitive multiselect values, ISO date bounds) and the dataset
+version. Users picking the same filters share one computation. Entries are
+evicted least recently used once their estimated size exceeds
+``M3_RESULT_CACHE_MB``, and everything cached for an older dataset version
+is dropped as soon as new data is ingested.
+"""
+import os
+import sys
+import threading
+
+import pandas as pd
+import streamlit as st
+from cachetools import LRUCache
+from plotly.basedatatypes import BaseFigure
+from prometheus_client import Counter
+
+from core.metrics import payload_size
+
+RESULT_CACHE_MB = float(os.environ.get("M3_RESULT_CACHE_MB", "256"))
+
+CACHE_REQUESTS = Counter(
+    "m3_result_cache_requests", "Tab result lookups by outcome.", ["result"])
+
+
+def result_nbytes(value):
+    """Estimated memory held by a tab result."""
+    if isinstance(value, (tuple, list)):
+        return sum(result_nbytes(item) for item in value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, BaseFigure):
+        # The serialized figure is a fair proxy for its trace data.
+        return payload_size(value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """Size-bounded LRU of tab results for the current dataset version."""
+
+    def __init__(self, budget_mb=RESULT_CACHE_MB):
+        self.lock = threading.Lock()
+        self.entries = LRUCache(maxsize=max(int(budget_mb * 2 ** 20), 1),
+                                getsizeof=result_nbytes)
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.hits += 1
+                CACHE_REQUESTS.labels("hit").inc()
+                return True, self.entries[key]
+            self.misses += 1
+            CACHE_REQUESTS.labels("miss").inc()
+            return False, None
+
+    def get(self, name, state, version, compute):
+        """Cached result of ``compute()`` for tab ``name`` and ``state``.
+
+        ``compute`` runs outside the lock, so concurrent misses on the same
+        key may both compute; the results are identical.
+        """
+        key = (name, state)
+        found, result = self._lookup(key, version)
+        if found:
+            return result
+        result = compute()
+        with self.lock:
+            if version == self.version:
+                try:
+                    self.entries[key] = result
+                except ValueError:  # Larger than the whole budget.
+                    pass
+        return result
+
+    def peek(self, name, state, version):
+        """``(found, result)`` for tab ``name`` and ``state``, not computing."""
+        return self._lookup((name, state), version)
+
+    def items(self):
+        """The cached dataset version and its ``((name, state), result)``."""
+        with self.lock:
+            return self.version, list(self.entries.items())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "bytes": int(self.entries.currsize),
+                    "budget": int(self.entries.maxsize),
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+@st.cache_resource(show_spinner=False)
+def result_cache():
+    """The process-wide tab result cache."""
+    return ResultCache()
@@ -0,0 +1,390 @@
+"""Mergeable per-day sketches for approximate rankings and distinct counts.
+
+For every day of data and every ranked dimension the sketch keeps the
+``SKETCH_CAPACITY`` most frequent values with their exact order-line counts
+(and the sums of ``MEASURES`` over those lines), plus the largest count it
+dropped. Summing the kept counts over a date range gives a lower bound for
+each value; adding the dropped maximum of every day on which a value was
+not kept bounds how far it can be undercounted, so rankings come with a
+guaranteed error. ``GROUPED_RANKINGS`` are kept the same way within each
+value of another dimension, e.g. the products of every department per day.
+Distinct counts use
+one HyperLogLog per day and dimension, merged by taking the register
+maximum over the range (relative standard error ``1.04 / sqrt(2 **
+HLL_PRECISION)``).
+
+Sketches are built from the stored parts one month partition at a time
+under ``DATASET_DIR/sketches`` and only the months whose parts changed are
+rebuilt after an ingest. They can only answer selections restricted by
+date, so pages fall back to the exact cube or rows as soon as a category
+filter is set, or when the user turns the sidebar toggle off.
+"""
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from core.cube import top_n
+from core.data import (DATASET_DIR, DATE_COLUMN, compact_frame, concat_frames,
+                       dataset_lock, ensure_dataset, part_month, scan_parts)
+from core.filters import normalize_date_range
+from core.metrics import timed
+
+SKETCH_DIR = "sketches"
+RANKED_COLUMNS = ["Supplier Name", "Buyer", "ShipTo City", "Department",
+                  "Item Type", "Product Description"]
+DISTINCT_COLUMNS = ["Supplier Name", "Department", "Product Description"]
+# Column ranked within each value of another: ranked column -> group column.
+GROUPED_RANKINGS = {"Product Description": "Department"}
+MEASURES = ["Quantity", "Extended Price"]
+SKETCH_CAPACITY = int(os.environ.get("M3_SKETCH_CAPACITY", "100"))
+# 2 ** 11 registers; the 53 hash bits left after the register index convert
+# to float64 exactly, which the rank computation relies on.
+HLL_PRECISION = 11
+APPROXIMATE = os.environ.get("M3_APPROXIMATE", "") == "1"
+
+
+class Estimate(namedtuple("Estimate", ["value", "error"])):
+    """An approximate count and its relative standard error."""
+
+    def __str__(self):
+        return f"≈{self.value:,.0f} (±{self.error:.0%})"
+
+
+def _hash_values(values):
+    """64-bit hashes of the non-null ``values``, stable across chunks."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        hashes = pd.util.hash_array(
+            values.cat.categories.to_numpy(dtype=object))
+        return hashes[codes[codes >= 0]], codes >= 0
+    valid = values.notna().to_numpy()
+    return pd.util.hash_array(values[valid].to_numpy(dtype=object)), valid
+
+
+def hll_ranks(days, values, precision=HLL_PRECISION):
+    """Per-(day, register) maximum HyperLogLog rank of ``values``."""
+    hashes, valid = _hash_values(values)
+    tail_bits = 64 - precision
+    registers = (hashes >> np.uint64(tail_bits)).astype(np.int64)
+    tail = hashes & np.uint64((1 << tail_bits) - 1)
+    ranks = tail_bits - np.frexp(tail.astype(np.float64))[1] + 1
+    frame = pd.DataFrame({DATE_COLUMN: days[valid], "register": registers,
+                          "rank": ranks.astype(np.uint8)})
+    return frame.groupby([DATE_COLUMN, "register"], dropna=False)["rank"].max()
+
+
+def hll_estimate(registers):
+    """Distinct count estimated from merged HyperLogLog registers."""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)))
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)  # Linear counting for small sets.
+    return estimate
+
+
+def ranking_name(column, group=None):
+    """``Column`` of the sketch rows ranking ``column`` (within ``group``)."""
+    return column if group is None else f"{column} by {group}"
+
+
+def top_summary(counts, capacity=SKETCH_CAPACITY):
+    """Keep the ``capacity`` largest counts per day (and ``Group``, if any).
+
+    ``counts`` has the day, a ``Value`` and its ``Count``. ``Rest`` is the
+    largest count dropped that day (0 when nothing was dropped).
+    """
+    by = [DATE_COLUMN] + (["Group"] if "Group" in counts else [])
+    counts = counts.sort_values(by + ["Count"],
+                                ascending=[True] * len(by) + [False],
+                                kind="stable")
+    rank = counts.groupby(by, dropna=False).cumcount()
+    rest = counts[rank >= capacity].groupby(
+        by, dropna=False)["Count"].max().rename("Rest")
+    kept = counts[rank < capacity].merge(rest, on=by, how="left")
+    kept["Rest"] = kept["Rest"].fillna(0).astype(np.int64)
+    return kept
+
+
+def build_sketches(parts, dataset_dir=DATASET_DIR):
+    """Top-value summaries and HyperLogLog registers of ``parts``, per day.
+
+    Returns ``(top, distinct)``: a long frame with the day, ``Column``,
+    ``Group`` (for ``GROUPED_RANKINGS``), ``Value``, ``Count``, the
+    ``MEASURES`` and ``Rest``, and per distinct-counted column a pair of the
+    days and their ``(days, 2 ** HLL_PRECISION)`` registers.
+    """
+    rankings = [(column, None) for column in RANKED_COLUMNS] + \
+        list(GROUPED_RANKINGS.items())
+    counts = {ranking: [] for ranking in rankings}
+    ranks = {column: [] for column in DISTINCT_COLUMNS}
+    columns = list(dict.fromkeys(
+        [DATE_COLUMN] + RANKED_COLUMNS + list(GROUPED_RANKINGS.values()) +
+        MEASURES))
+    for chunk in scan_parts(parts, dataset_dir, columns=columns):
+        days = chunk[DATE_COLUMN].dt.normalize()
+        lines = chunk[MEASURES].assign(Count=1)
+        for column, group in rankings:
+            keys = [days] + ([chunk[group].astype(object)] if group else []) \
+                + [chunk[column].astype(object)]
+            counts[(column, group)].append(
+                lines.groupby(keys, dropna=False).sum())
+        for column in DISTINCT_COLUMNS:
+            ranks[column].append(hll_ranks(days.to_numpy(), chunk[column]))
+
+    top = []
+    for (column, group), partials in counts.items():
+        if not partials:
+            continue
+        merged = pd.concat(partials)
+        levels = [DATE_COLUMN] + (["Group"] if group else []) + ["Value"]
+        merged = merged.groupby(level=list(range(len(levels))),
+                                dropna=False).sum()
+        merged = merged.rename_axis(levels).reset_index().dropna(
+            subset=levels[1:])
+        top.append(top_summary(merged).assign(
+            Column=ranking_name(column, group)))
+    top = pd.concat(top, ignore_index=True) if top else pd.DataFrame(
+        columns=[DATE_COLUMN, "Group", "Value", "Count"] + MEASURES +
+        ["Rest", "Column"])
+
+    distinct = {}
+    for column, partials in ranks.items():
+        if not partials:
+            continue
+        merged = pd.concat(partials).groupby(level=[0, 1], dropna=False).max()
+        days, day_codes = np.unique(
+            merged.index.get_level_values(0).to_numpy(), return_inverse=True)
+        registers = np.zeros((len(days), 2 ** HLL_PRECISION), dtype=np.uint8)
+        registers[day_codes, merged.index.get_level_values(1)] = merged
+        distinct[column] = (days, registers)
+    return top, distinct
+
+
+def _month_groups(parts):
+    """Parts per month partition; unpartitioned parts may hold any day."""
+    months = {}
+    for part in parts:
+        months.setdefault(part_month(part), []).append(part)
+    if None in months:
+        return {"all": list(parts)}
+    return months
+
+
+def _tmp_path(path):
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def _write_month(directory, name, top, distinct):
+    top_path = os.path.join(directory, f"top-{name}.parquet")
+    top.to_parquet(_tmp_path(top_path), index=False)
+    os.replace(_tmp_path(top_path), top_path)
+    hll_path = os.path.join(directory, f"hll-{name}.npz")
+    arrays = {}
+    for column, (days, registers) in distinct.items():
+        arrays[f"{column}:days"] = days.astype("datetime64[ns]")
+        arrays[f"{column}:registers"] = registers
+    with open(_tmp_path(hll_path), "wb") as handle:
+        np.savez(handle, **arrays)
+    os.replace(_tmp_path(hll_path), hll_path)
+
+
+def _remove_month(directory, name):
+    for path in (f"top-{name}.parquet", f"hll-{name}.npz"):
+        if os.path.exists(os.path.join(directory, path)):
+            os.remove(os.path.join(directory, path))
+
+
+def ensure_sketches(dataset_dir=DATASET_DIR):
+    """Rebuild the sketches of months whose parts changed; returns the months."""
+    manifest = ensure_dataset(dataset_dir=dataset_dir)
+    directory = os.path.join(dataset_dir, SKETCH_DIR)
+    index_path = os.path.join(directory, "index.json")
+    settings = {"capacity": SKETCH_CAPACITY, "precision": HLL_PRECISION,
+                "grouped": GROUPED_RANKINGS, "measures": MEASURES}
+    with dataset_lock(dataset_dir):
+        os.makedirs(directory, exist_ok=True)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as handle:
+                index = json.load(handle)
+        if index.get("settings") != settings:
+            index = {"settings": settings, "months": {}}
+
+        groups = _month_groups(manifest["parts"])
+        for name, parts in groups.items():
+            if index["months"].get(name) != parts:
+                _write_month(directory, name,
+                             *build_sketches(parts, dataset_dir))
+                index["months"][name] = parts
+        for name in set(index["months"]) - set(groups):
+            _remove_month(directory, name)
+            del index["months"][name]
+        with open(_tmp_path(index_path), "w", encoding="utf-8") as handle:
+            json.dump(index, handle, indent=2)
+        os.replace(_tmp_path(index_path), index_path)
+    return sorted(groups)
+
+
+class SketchIndex:
+    """The merged per-day sketches of the whole dataset."""
+
+    def __init__(self, top, distinct):
+        self.top = top
+        self.distinct = distinct
+
+    @classmethod
+    def read(cls, months, dataset_dir=DATASET_DIR):
+        directory = os.path.join(dataset_dir, SKETCH_DIR)
+        top, days, registers = [], {}, {}
+        for name in months:
+            top.append(pd.read_parquet(
+                os.path.join(directory, f"top-{name}.parquet")))
+            with np.load(os.path.join(directory, f"hll-{name}.npz")) as arrays:
+                for column in DISTINCT_COLUMNS:
+                    if f"{column}:days" in arrays:
+                        days.setdefault(column, []).append(
+                            arrays[f"{column}:days"])
+                        registers.setdefault(column, []).append(
+                            arrays[f"{column}:registers"])
+        top = compact_frame(concat_frames(top)) if top else None
+        distinct = {column: (np.concatenate(days[column]),
+                             np.concatenate(registers[column]))
+                    for column in days}
+        return cls(top, distinct)
+
+    def select(self, date_range=None):
+        return SketchSelection(self, normalize_date_range(date_range))
+
+
+class SketchSelection:
+    """Approximate answers for the lines dated within a range."""
+
+    def __init__(self, index, dates):
+        self.index = index
+        self.dates = dates
+
+    def _in_range(self, days):
+        days = np.asarray(days, dtype="datetime64[ns]")
+        if self.dates is None:
+            return np.ones(len(days), dtype=bool)
+        start, end = (np.datetime64(bound.normalize(), "ns")
+                      for bound in self.dates)
+        return (days >= start) & (days < end)
+
+    def _rows(self, name):
+        top = self.index.top
+        return top[(top["Column"] == name).to_numpy() &
+                   self._in_range(top[DATE_COLUMN])]
+
+    @timed("aggregation")
+    def top_n(self, column, n=10):
+        """``n`` most frequent values of ``column`` with their order-line count.
+
+        Counts are lower bounds; ``attrs["error"]`` is the most any listed
+        count may be short by, and ``attrs["unseen"]`` the largest count a
+        value missing from the list can have.
+        """
+        if self.index.top is None:
+            return pd.DataFrame({column: [], "value": []})
+        rows = self._rows(column)
+        rests = int(rows.drop_duplicates(DATE_COLUMN)["Rest"].sum())
+        ranked = rows.groupby("Value", observed=True).agg(
+            value=("Count", "sum"), present=("Rest", "sum")).astype(np.int64)
+        ranked = ranked.sort_values("value", ascending=False, kind="stable")
+        # Upper bound of each count: add the drops of the days it was not kept.
+        bounds = ranked["value"] + rests - ranked["present"]
+        listed = ranked.head(n)
+        result = listed["value"].rename_axis(column).reset_index()
+        result.attrs["error"] = int((rests - listed["present"]).max()) \
+            if len(listed) else 0
+        # A value never kept on any day has at most the sum of the drops.
+        result.attrs["unseen"] = int(max(rests, bounds.iloc[n:].max()
+                                         if len(ranked) > n else 0))
+        return result
+
+    @timed("aggregation")
+    def top_n_by(self, column, group, n=10):
+        """``n`` most frequent values of ``column`` within each ``group`` value.
+
+        One row per listed value with its order-line count and the
+        ``MEASURES`` summed over those lines, all lower bounds;
+        ``attrs["error"]`` is the most any listed count may be short by.
+        Only ``GROUPED_RANKINGS`` are sketched.
+        """
+        if self.index.top is None:
+            return pd.DataFrame({group: [], column: [], "value": []})
+        rows = self._rows(ranking_name(column, group))
+        rests = rows.drop_duplicates([DATE_COLUMN, "Group"]).groupby(
+            "Group", observed=True)["Rest"].sum().astype(np.int64)
+        ranked = rows.groupby(["Group", "Value"], observed=True).agg(
+            value=("Count", "sum"), present=("Rest", "sum"),
+            **{measure: (measure, "sum") for measure in MEASURES}).astype(
+            {"value": np.int64, "present": np.int64})
+        ranked = ranked.reset_index().sort_values(
+            ["Group", "value"], ascending=[True, False], kind="stable")
+        listed = ranked.groupby("Group", observed=True).head(n)
+        short = listed["Group"].map(rests).astype(np.int64) - listed["present"]
+        result = listed.drop(columns="present").rename(
+            columns={"Group": group, "Value": column}).reset_index(drop=True)
+        result.attrs["error"] = int(short.max()) if len(listed) else 0
+        return result
+
+    @timed("aggregation")
+    def nunique(self, column):
+        """Estimated number of distinct ``column`` values."""
+        days, registers = self.index.distinct[column]
+        selected = registers[self._in_range(days)]
+        merged = selected.max(axis=0) if len(selected) else \
+            np.zeros(registers.shape[1], dtype=np.uint8)
+        return Estimate(hll_estimate(merged),
+                        1.04 / np.sqrt(registers.shape[1]))
+
+
+@st.cache_resource(max_entries=1, show_spinner="Building rankings sketches...")
+def _sketch_index(version):
+    # ``version`` is only part of the cache key so new data is picked up.
+    return SketchIndex.read(ensure_sketches())
+
+
+def load_sketch_index():
+    """The shared sketch index for the current dataset version."""
+    return _sketch_index(ensure_dataset()["version"])
+
+
+def approximate_toggle():
+    """Sidebar switch between approximate and exact rankings."""
+    return st.sidebar.toggle(
+        "Approximate rankings", value=APPROXIMATE,
+        help="Top-N rankings and distinct counts from per-day sketches, "
+             "used while no category filter is set. Turn off to recompute "
+             "them exactly.")
+
+
+def sketch_selection(selections, date_range, approximate):
+    """A :class:`SketchSelection` when the filters allow approximate answers."""
+    if not approximate or any(values for values in (selections or {}).values()):
+        return None
+    return load_sketch_index().select(date_range)
+
+
+def approximate_title(title, ranking):
+    """``title`` noting the error bound of an approximate ``ranking``."""
+    if "error" not in ranking.attrs:
+        return title
+    if not ranking.attrs["error"]:
+        return f"{title} (approximate)"
+    return f"{title} (approximate, counts up to {ranking.attrs['error']:,} low)"
+
+
+def ranking(cube_selection, sketches, column, n=10):
+    """Top ``n`` values of ``column`` by order lines, approximate when
+    ``sketches`` (from :func:`sketch_selection`) is given."""
+    if sketches is None:
+        return top_n(cube_selection, column, n)
+    return sketches.top_n(column, n)
@@ -0,0 +1,131 @@
+"""DuckDB backend for row-level queries (``M3_QUERY_BACKEND=duckdb``).
+
+Selections become a SQL ``WHERE`` clause over ``read_parquet`` of the month
+partitions in the date range. DuckDB pushes the predicates into the Parquet
+scan, runs the grouping on all cores and hands back only the result, so no
+intermediate frame is built in Python. Options, date bounds and selection
+sizes still come from the cube index, as with :class:`core.filters.ScanIndex`.
+"""
+import os
+from functools import cached_property
+
+import duckdb
+import streamlit as st
+
+from core.data import DATASET_DIR, DATE_COLUMN, compact_frame
+from core.filters import (SCAN_ROW_LIMIT, ScanIndex, aggregate_rows,
+                          normalize_date_range)
+from core.metrics import timed
+
+# Worker threads per query; unset lets DuckDB use every core.
+DUCKDB_THREADS = int(os.environ.get("M3_DUCKDB_THREADS", "0")) or None
+SQL_AGGREGATES = {"sum": "sum", "count": "count", "min": "min", "max": "max",
+                  "size": "count"}
+# Parts written before the fixed ``STORAGE_TYPES`` may differ in column
+# widths, and their month= directories are not columns.
+READ_PARQUET = "read_parquet(?, hive_partitioning=false, union_by_name=true)"
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _param(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def sql_filter(selections=None, date_range=None):
+    """``WHERE`` clause and parameters matching :meth:`FilterIndex.rows`."""
+    clauses = []
+    params = []
+    for column, values in (selections or {}).items():
+        if not values:
+            continue
+        values = list(values)
+        clauses.append(f"{quote(column)} IN ({', '.join('?' * len(values))})")
+        params += [_param(value) for value in values]
+    dates = normalize_date_range(date_range)
+    if dates:
+        clauses.append(f"{quote(DATE_COLUMN)} >= ? AND {quote(DATE_COLUMN)} < ?")
+        params += [bound.to_pydatetime() for bound in dates]
+    return " AND ".join(clauses) or "TRUE", params
+
+
+class DuckDBSelection:
+    """Stored lines matching a filter state, queried with DuckDB.
+
+    Behaves like :class:`core.filters.ScanSelection`: ``frame`` is a uniform
+    sample beyond ``limit`` lines and :meth:`aggregate` is exact.
+    """
+
+    def __init__(self, connection, parts, where, params, size, template,
+                 dataset_dir=DATASET_DIR, limit=SCAN_ROW_LIMIT):
+        self.connection = connection
+        self.paths = [os.path.join(dataset_dir, part) for part in parts]
+        self.where = where
+        self.params = params
+        self.size = size
+        self.template = template
+        self.limit = limit
+
+    def __len__(self):
+        return self.size
+
+    def _query(self, sql):
+        # A cursor per query, so sessions can query concurrently.
+        return self.connection.cursor().execute(
+            sql.format(source=f"{READ_PARQUET} WHERE {self.where}"),
+            [self.paths] + self.params).df()
+
+    @cached_property
+    @timed("filter")
+    def frame(self):
+        """The selected lines as a DataFrame, queried on first use."""
+        fraction = min(1.0, self.limit / self.size) if self.size else 1.0
+        if not self.size or not self.paths:
+            frame = self.template.copy()
+        elif fraction < 1:
+            frame = self._query(f"SELECT * FROM (SELECT * FROM {{source}}) "
+                                f"USING SAMPLE {int(self.limit)} ROWS "
+                                f"(reservoir, 0)")
+        else:
+            frame = self._query("SELECT * FROM {source}")
+        frame = compact_frame(frame[list(self.template.columns)])
+        frame.attrs["sample_fraction"] = fraction
+        return frame
+
+    @timed("aggregation")
+    def aggregate(self, by, agg):
+        """Group the selected lines in DuckDB; see :func:`aggregate_rows`."""
+        if not self.size or not self.paths:
+            columns = list(dict.fromkeys(
+                by + [column for column, func in agg.values() if func != "size"]))
+            return aggregate_rows(self.template[columns], by, agg)
+        select = [quote(column) for column in by] + [
+            f"{SQL_AGGREGATES[func]}({'*' if func == 'size' else quote(column)})"
+            f" AS {quote(name)}" for name, (column, func) in agg.items()]
+        return compact_frame(self._query(
+            f"SELECT {', '.join(select)} FROM {{source}} GROUP BY ALL"))
+
+
+class DuckDBIndex(ScanIndex):
+    """:class:`ScanIndex` whose selections are answered by DuckDB."""
+
+    def __init__(self, cube_index, parts, connection, dataset_dir=DATASET_DIR):
+        super().__init__(cube_index, parts, dataset_dir)
+        self.connection = connection
+
+    def select(self, selections=None, date_range=None):
+        scan = super().select(selections, date_range)
+        where, params = sql_filter(selections, date_range)
+        return DuckDBSelection(self.connection, scan.parts, where, params,
+                               scan.size, self.template, self.dataset_dir)
+
+
+@st.cache_resource(show_spinner=False)
+def duckdb_connection():
+    """In-memory DuckDB database shared by the server process."""
+    connection = duckdb.connect()
+    if DUCKDB_THREADS:
+        connection.execute(f"SET threads = {DUCKDB_THREADS}")
+    return connection
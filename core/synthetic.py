@@ -0,0 +1,171 @@
+"""Synthetic purchase-order extracts with the schema of ``df_new_3.csv``.
+
+Names, companies, cities and products are drawn once per value with Faker;
+order lines are then sampled with NumPy so that millions of rows stay fast.
+Popularity is skewed (a few suppliers, buyers and products take most of the
+lines), every buyer belongs to one department and usually ships to one
+city, every product has one item type, supplier and list price, and
+volumes follow quarter-end peaks with little activity at weekends.
+
+Usage::
+
+    python -m core.synthetic out.csv --rows 1m [--suppliers 2000 ...]
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from faker import Faker
+
+from core.data import DATE_COLUMN
+
+SIZES = {"100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+CARDINALITIES = {"departments": 25, "suppliers": 2000, "buyers": 150,
+                 "cities": 40, "products": 20000}
+DEPARTMENTS = ["Finance", "Facilities", "IT", "Laboratory", "Maintenance",
+               "Marketing", "Human Resources", "Logistics", "Legal",
+               "Procurement", "Production", "Quality", "Research",
+               "Sales", "Security", "Engineering", "Health and Safety",
+               "Customer Service", "Training", "Administration"]
+ITEM_TYPES = ["Goods", "Services", "IT Equipment", "Consumables",
+              "Spare Parts", "Software", "Furniture", "Works"]
+# Relative order volume per calendar month, peaking at quarter ends.
+MONTH_WEIGHTS = [0.8, 0.9, 1.3, 0.9, 1.0, 1.3, 0.7, 0.6, 1.3, 1.0, 1.1, 1.5]
+WEEKEND_WEIGHT = 0.1
+CHUNK_ROWS = 500_000
+
+
+def parse_rows(text):
+    """Row count from ``"100k"``, ``"1m"``, ``"10m"`` or a plain integer."""
+    text = text.lower()
+    if text in SIZES:
+        return SIZES[text]
+    for suffix, factor in (("k", 1_000), ("m", 1_000_000)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def _distinct(make, size):
+    """``size`` distinct values of ``make()``, numbered once Faker runs dry."""
+    values = list(dict.fromkeys(make() for _ in range(size * 2)))[:size]
+    base = len(values) or 1
+    while len(values) < size:
+        values.append(f"{values[len(values) % base]} {len(values) // base + 1}")
+    return values
+
+
+def _skewed(size, rng, exponent=1.1):
+    """Zipf-like popularity over ``size`` values, in random order."""
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+
+class Catalogue:
+    """The distinct values an extract is drawn from and how they relate."""
+
+    def __init__(self, departments, suppliers, buyers, cities, products,
+                 seed=0):
+        fake = Faker()
+        fake.seed_instance(seed)
+        rng = np.random.default_rng(seed)
+        self.departments = np.array(
+            DEPARTMENTS[:departments] + _distinct(
+                lambda: fake.job().split(",")[0],
+                max(departments - len(DEPARTMENTS), 0)), dtype=object)
+        self.suppliers = np.array(_distinct(fake.company, suppliers),
+                                  dtype=object)
+        self.cities = np.array(_distinct(fake.city, cities), dtype=object)
+        # Numbering a duplicate name pads the last name.
+        names = [name.split("\t") for name in _distinct(
+            lambda: f"{fake.first_name()}\t{fake.last_name()}", buyers)]
+        self.first_names = np.array([first for first, _ in names],
+                                    dtype=object)
+        self.last_names = np.array([last for _, last in names], dtype=object)
+        self.products = np.array(_distinct(
+            lambda: " ".join(fake.words(3)).capitalize(), products),
+            dtype=object)
+
+        self.buyer_weights = _skewed(buyers, rng)
+        self.buyer_department = rng.integers(0, departments, buyers)
+        self.buyer_city = rng.choice(cities, buyers, p=_skewed(cities, rng))
+        self.city_weights = _skewed(cities, rng)
+        self.product_weights = _skewed(products, rng)
+        self.product_type = rng.integers(0, len(ITEM_TYPES), products)
+        self.product_supplier = rng.choice(suppliers, products,
+                                           p=_skewed(suppliers, rng))
+        self.product_price = np.round(rng.lognormal(3.5, 1.2, products), 2)
+
+
+def order_lines(catalogue, rows, start, end, rng):
+    """``rows`` order lines dated between ``start`` and ``end``."""
+    days = pd.date_range(start, end, freq="D")
+    weights = np.take(MONTH_WEIGHTS, days.month - 1) * np.where(
+        days.dayofweek < 5, 1.0, WEEKEND_WEIGHT)
+    dates = days[rng.choice(len(days), rows, p=weights / weights.sum())] + \
+        pd.to_timedelta(rng.integers(7 * 3600, 19 * 3600, rows), unit="s")
+
+    buyers = rng.choice(len(catalogue.buyer_weights), rows,
+                        p=catalogue.buyer_weights)
+    elsewhere = rng.random(rows) < 0.2
+    cities = np.where(elsewhere,
+                      rng.choice(len(catalogue.city_weights), rows,
+                                 p=catalogue.city_weights),
+                      catalogue.buyer_city[buyers])
+    products = rng.choice(len(catalogue.product_weights), rows,
+                          p=catalogue.product_weights)
+    quantity = rng.geometric(0.25, rows)
+    unit_price = np.round(catalogue.product_price[products] *
+                          rng.lognormal(0, 0.05, rows), 2)
+    return pd.DataFrame({
+        DATE_COLUMN: dates.strftime("%Y-%m-%d %H:%M:%S"),
+        "Department": catalogue.departments[
+            catalogue.buyer_department[buyers]],
+        "Supplier Name": catalogue.suppliers[
+            catalogue.product_supplier[products]],
+        "Buyer: First Name": catalogue.first_names[buyers],
+        "Buyer: Last Name": catalogue.last_names[buyers],
+        "ShipTo City": catalogue.cities[cities],
+        "Item Type": np.take(ITEM_TYPES, catalogue.product_type[products]),
+        "Product Description": catalogue.products[products],
+        "Quantity": quantity,
+        "Unit Price": unit_price,
+        "Extended Price": np.round(quantity * unit_price, 2),
+    })
+
+
+def write_extract(path, rows, start="2021-01-01", end="2024-12-31", seed=0,
+                  **cardinalities):
+    """Write a synthetic CSV extract of ``rows`` lines, in chunks."""
+    catalogue = Catalogue(**{**CARDINALITIES, **cardinalities}, seed=seed)
+    rng = np.random.default_rng(seed)
+    for offset in range(0, max(rows, 1), CHUNK_ROWS):
+        order_lines(catalogue, min(CHUNK_ROWS, rows - offset), start, end,
+                    rng).to_csv(path, mode="a" if offset else "w",
+                                header=not offset, index=False)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m core.synthetic",
+        description="Write a synthetic purchase-order extract.")
+    parser.add_argument("path")
+    parser.add_argument("--rows", default="100k",
+                        help="100k, 1m, 10m or a number of lines")
+    parser.add_argument("--start", default="2021-01-01")
+    parser.add_argument("--end", default="2024-12-31")
+    parser.add_argument("--seed", type=int, default=0)
+    for name, default in CARDINALITIES.items():
+        parser.add_argument(f"--{name}", type=int, default=default)
+    args = parser.parse_args(argv)
+    rows = write_extract(
+        args.path, parse_rows(args.rows), args.start, args.end, args.seed,
+        **{name: getattr(args, name) for name in CARDINALITIES})
+    print(f"{args.path}: {rows} order lines")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Lazily rendered, memoised page tabs.
+
+Tabs created with :func:`lazy_tabs` rerun the page when the user switches
+tab and report which one is open, so a page only computes the open tab.
+:func:`memoize` keeps each tab's results in the process-wide result cache
+(``core.results``), keyed by the filter state and dataset version, so
+switching back to a tab is instant and sessions with the same filters share
+the work. Results rendered ahead of time by ``core.batch`` are served
+without computing, and with progressive rendering slow results are first
+estimated from a sample (``core.progressive``). :func:`plotly_chart` sends
+a figure and records its render time and payload size (see
+``core.metrics``), and :func:`granularity_select` offers the time bucket of
+the charts (see ``core.cube.time_rollup``).
+"""
+import streamlit as st
+
+from core.batch import load_result
+from core.cube import GRANULARITIES
+from core.data import dataset_version
+from core.metrics import (compute_tab, metrics_enabled, payload_size, record,
+                          set_tab, stage)
+from core.progressive import progressive_enabled, refine
+from core.results import result_cache
+
+
+def lazy_tabs(labels, key):
+    """``st.tabs`` whose containers expose ``.open`` for the active tab."""
+    return st.tabs(labels, key=key, on_change="rerun")
+
+
+def memoize(name, state, compute):
+    """Return ``compute()``, reusing the result cached for the same state.
+
+    ``state`` must be hashable, e.g. from :func:`core.filters.filter_key`,
+    and ``compute`` must depend on nothing else but the dataset. Results are
+    shared between sessions and must be treated as read-only.
+    """
+    tab = name.rsplit("/", 1)[-1]
+    set_tab(tab)
+    version = dataset_version()
+
+    def load_or_compute():
+        result = load_result(name, state, version)
+        return compute_tab(tab, compute) if result is None else result
+
+    if progressive_enabled():
+        return refine(name, state, version, load_or_compute, compute)
+    return result_cache().get(name, state, version, load_or_compute)
+
+
+def plotly_chart(fig, **kwargs):
+    """``st.plotly_chart`` that records render time, and payload size when
+    metrics are collected (serializing the figure again is not free)."""
+    with stage("render"):
+        st.plotly_chart(fig, **kwargs)
+    if metrics_enabled():
+        record("payload", size=payload_size(fig))
+
+
+def granularity_select():
+    """Sidebar choice of time bucket; None lets each chart choose."""
+    choice = st.sidebar.selectbox(
+        "Time Granularity", ["Auto"] + list(GRANULARITIES),
+        help="Auto picks the finest of day, week, month or quarter that "
+             "keeps each chart within its point budget.")
+    return None if choice == "Auto" else choice
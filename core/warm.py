@@ -0,0 +1,161 @@
+"""Pre-warm the dashboard before it accepts traffic.
+
+Times the import of the libraries and modules every page needs, ingests
+the CSV extract and builds the cube, then runs every page and tab
+headlessly with the default (unfiltered) sidebar state. This fills the
+process-wide caches: the shared dataset and indexes, the tab result cache,
+and the fitted models, whose background fits are waited for. Timings are
+printed per step.
+
+With ``--serve`` the Streamlit server is started in the same process once
+warm, so the first user finds every cache populated::
+
+    python -m core.warm --serve [--port 8501] [--address 0.0.0.0]
+
+Without it only the on-disk artifacts (dataset, cube, snapshot, models)
+outlive the run, which still spares the first ``streamlit run`` user the
+CSV parse.
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+
+# Imported in this order, each timed on its own (so shared dependencies are
+# charged to the first module needing them).
+IMPORTS = ["numpy", "pandas", "pyarrow.dataset", "plotly.express",
+           "streamlit", "core.data", "core.cube", "core.filters",
+           "core.ui"]
+MODEL_TIMEOUT = int(os.environ.get("M3_WARM_MODEL_TIMEOUT", "900"))
+POLL_SECONDS = 1
+
+
+def import_timings(modules=IMPORTS):
+    """Import ``modules`` in order; returns ``(step, seconds)`` pairs.
+
+    Must run before anything else imports them: a module already loaded is
+    reported as such rather than timed at zero.
+    """
+    timings = []
+    for module in modules:
+        if module in sys.modules:
+            timings.append((f"import {module} (already imported)", 0.0))
+            continue
+        start = time.perf_counter()
+        importlib.import_module(module)
+        timings.append((f"import {module}", time.perf_counter() - start))
+    return timings
+
+
+def warm_pages(pages, label="page"):
+    """Run each page and each of its tabs with the default filters."""
+    from streamlit.testing.v1 import AppTest
+
+    from core.bench import PAGE_TIMEOUT, each_tab
+
+    timings = []
+    for page in pages:
+        start = time.perf_counter()
+        app = AppTest.from_file(page, default_timeout=PAGE_TIMEOUT).run()
+        for _ in each_tab(app):
+            app.run()
+        timings.append((f"{label} {os.path.basename(page)}",
+                        time.perf_counter() - start))
+    return timings
+
+
+def wait_for_models(timeout=MODEL_TIMEOUT):
+    """Block until the background model and forecast fits have finished.
+
+    Returns whether any fit was running.
+    """
+    from core.forecasting import segment_forecaster
+    from core.models import model_store
+
+    stores = [model_store(), segment_forecaster()]
+    waited = False
+    deadline = time.monotonic() + timeout
+    while any(store.pending for store in stores) and \
+            time.monotonic() < deadline:
+        waited = True
+        time.sleep(POLL_SECONDS)
+    return waited
+
+
+def warm(pages=None, timings=None):
+    """Warm every cache; returns ``(step, seconds)`` pairs.
+
+    ``timings`` are import timings already taken by the caller, which are
+    measured here otherwise.
+    """
+    timings = list(timings) if timings is not None else import_timings()
+    from core.bench import PAGES
+    from core.cube import ensure_cube
+    from core.data import ensure_dataset
+
+    for step, function in (("dataset", ensure_dataset), ("cube", ensure_cube)):
+        start = time.perf_counter()
+        function()
+        timings.append((step, time.perf_counter() - start))
+    pages = pages or PAGES
+    timings += warm_pages(pages)
+    start = time.perf_counter()
+    if wait_for_models():
+        timings.append(("models", time.perf_counter() - start))
+        # Pages that showed a placeholder can now render their models.
+        timings += warm_pages(pages, label="page (with models)")
+    return timings
+
+
+def _load_server_config(args):
+    """Load the server config before warming, as ``streamlit run`` does."""
+    from streamlit import config
+    from streamlit.web import bootstrap
+
+    from core.bench import PAGES
+
+    flag_options = {"server.port": args.port, "server.address": args.address}
+    flag_options = {name: value for name, value in flag_options.items()
+                    if value is not None}
+    # Locates the app's .streamlit config and secrets, like the CLI does.
+    config._main_script_path = PAGES[0]
+    bootstrap.load_config_options(flag_options=flag_options)
+    return flag_options
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m core.warm",
+        description="Warm the dashboard caches, optionally then serve it.")
+    parser.add_argument("--serve", action="store_true",
+                        help="start the Streamlit server once warm")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--address")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    # Loading the server config imports Streamlit and its dependencies, so
+    # time the imports first.
+    timings = import_timings()
+    if args.serve:
+        flag_options = _load_server_config(args)
+    timings = warm(timings=timings)
+    width = max(len(step) for step, _ in timings)
+    for step, seconds in timings:
+        print(f"{step:<{width}}  {seconds:8.3f}s")
+    print(f"{'total':<{width}}  {time.perf_counter() - start:8.3f}s",
+          flush=True)
+    if not args.serve:
+        return 0
+
+    from streamlit.web import bootstrap
+
+    from core.bench import PAGES
+
+    bootstrap.run(PAGES[0], False, [], flag_options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
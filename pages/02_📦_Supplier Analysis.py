@@ -1,71 +1,104 @@
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
+from core.cube import time_rollup
+from core.data import data_available
+from core.filters import filter_key, load_cube_index, load_data_index
+from core.growth import trend_figure, trend_matrix, trend_metric_radio
+from core.metrics import debug_panel, stage, start_page
+from core.progressive import progressive_select, progressive_toggle
+from core.reduce import box_figure, line_figure
+from core.sketches import (approximate_title, approximate_toggle, ranking,
+                            sketch_selection)
+from core.ui import granularity_select, lazy_tabs, memoize, plotly_chart
+
 # 📌 🚀 Page Configuration
 st.set_page_config(page_title="Supplier Analysis", layout="wide")
+start_page("supplier")
 
-# 📌 🚀 Function to Load Data
-
-
-@st.cache_data
-def load_data():
-    file_path = "df_new_3.csv"  # Replace with the correct path
-    try:
-        df = pd.read_csv(file_path)
-        df["Creation Date"] = pd.to_datetime(
-            df["Creation Date"], errors='coerce')
-        return df
-    except FileNotFoundError:
-        st.error("Error: File 'df_new_3.csv' not found!")
-        return pd.DataFrame()  # Returns an empty DataFrame
-
-
-# Load the data
-df = load_data()
-
-if df.empty:
+# Check the shared dataset
+if not data_available():
     st.warning("No data available for display.")
     st.stop()
 
+with stage("load"):
+    data_index = load_data_index()
+    cube_index = load_cube_index()
+
 # 📌 🚀 Create Interactive Filters
 st.sidebar.header("Filters")
 selected_supplier = st.sidebar.multiselect(
-    "Select Supplier", df["Supplier Name"].unique())
+    "Select Supplier", data_index.options("Supplier Name"))
 date_range = st.sidebar.date_input("Select Date Range", [])
+granularity = granularity_select()
+approximate = approximate_toggle()
+progressive = progressive_toggle()
 
 # Apply filters if selected
-filtered_df = df.copy()
-if selected_supplier:
-    filtered_df = filtered_df[filtered_df["Supplier Name"].isin(
-        selected_supplier)]
-if date_range:
-    filtered_df = filtered_df[(filtered_df["Creation Date"] >= pd.to_datetime(date_range[0])) &
-                              (filtered_df["Creation Date"] <= pd.to_datetime(date_range[1]))]
+filters = {"Supplier Name": selected_supplier}
+with stage("filter"):
+    sketches = sketch_selection(filters, date_range, approximate)
+    filter_state = filter_key(filters, date_range, granularity=granularity,
+                              approximate=sketches is not None)
+    cube_selection = progressive_select(cube_index, filters, date_range, progressive)
+    # Row-level data is only materialised by the distribution charts
+    filtered_rows = progressive_select(data_index, filters, date_range, progressive,
+                                       rows=True)
 
 # 📌 🚀 Create Tabs for Organization
-tabs = st.tabs(
-    ["📦 Top Suppliers", "📊 Purchase Trends", "📈 Supplier Comparison"])
+tabs = lazy_tabs(
+    ["📦 Top Suppliers", "📊 Purchase Trends", "📈 Supplier Comparison",
+     "🚀 Supplier Growth"], key="supplier_tabs")
+
 
-with tabs[0]:
-    st.subheader("📦 Top 10 Suppliers with Most Orders")
-    top_suppliers = filtered_df["Supplier Name"].value_counts(
-    ).reset_index().head(10)
+def top_suppliers_chart():
+    top_suppliers = ranking(cube_selection, sketches, "Supplier Name", 10)
     top_suppliers.columns = ["Supplier", "Number of Orders"]
-    fig_suppliers = px.bar(top_suppliers, x="Number of Orders", y="Supplier", orientation='h',
-                           color="Number of Orders", title="Top 10 Suppliers", height=500)
-    st.plotly_chart(fig_suppliers)
-
-with tabs[1]:
-    st.subheader("📊 Purchase Trends by Supplier")
-    df_supplier_trend = filtered_df.groupby(["Creation Date", "Supplier Name"]).agg({
-        "Extended Price": "sum"}).reset_index()
-    fig_trend = px.line(df_supplier_trend, x="Creation Date", y="Extended Price", color="Supplier Name",
-                        title="Purchase Trends by Supplier")
-    st.plotly_chart(fig_trend)
-
-with tabs[2]:
-    st.subheader("📈 Supplier Comparison")
-    fig_box = px.box(filtered_df, x="Supplier Name", y="Extended Price", color="Supplier Name",
-                     title="Spending Distribution by Supplier")
-    st.plotly_chart(fig_box)
+    return px.bar(top_suppliers, x="Number of Orders", y="Supplier", orientation='h',
+                  color="Number of Orders", title=approximate_title("Top 10 Suppliers", top_suppliers), height=500)
+
+
+def purchase_trends_chart():
+    df_supplier_trend = time_rollup(cube_selection, ["Creation Date", "Supplier Name"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(df_supplier_trend, x="Creation Date", y="Extended Price", color="Supplier Name",
+                       title="Purchase Trends by Supplier")
+
+
+def supplier_comparison_chart():
+    return box_figure(filtered_rows.frame, x="Supplier Name", y="Extended Price",
+                      title="Spending Distribution by Supplier")
+
+
+def supplier_growth_chart(metric):
+    supplier_trends = trend_matrix(cube_selection, "Supplier Name", granularity=granularity)
+    return trend_figure(supplier_trends, metric, title="Fastest Growing and Declining Suppliers by Orders",
+                        label="Supplier")
+
+
+if tabs[0].open:
+    with tabs[0]:
+        st.subheader("📦 Top 10 Suppliers with Most Orders")
+        plotly_chart(memoize("supplier/top_suppliers",
+                     filter_state, top_suppliers_chart))
+
+if tabs[1].open:
+    with tabs[1]:
+        st.subheader("📊 Purchase Trends by Supplier")
+        plotly_chart(memoize("supplier/purchase_trends",
+                     filter_state, purchase_trends_chart))
+
+if tabs[2].open:
+    with tabs[2]:
+        st.subheader("📈 Supplier Comparison")
+        plotly_chart(memoize("supplier/supplier_comparison",
+                     filter_state, supplier_comparison_chart))
+
+if tabs[3].open:
+    with tabs[3]:
+        st.subheader("🚀 Suppliers with Fastest Growth in Orders")
+        growth_metric = trend_metric_radio("supplier_growth_metric")
+        plotly_chart(memoize("supplier/supplier_growth", (filter_state, growth_metric),
+                             lambda: supplier_growth_chart(growth_metric)))
+
+debug_panel()
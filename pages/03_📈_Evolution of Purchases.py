@@ -1,78 +1,96 @@
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
+from core.cube import rollup, time_rollup
+from core.data import data_available
+from core.filters import filter_key, load_cube_index
+from core.metrics import debug_panel, stage, start_page
+from core.progressive import progressive_select, progressive_toggle
+from core.reduce import line_figure
+from core.ui import granularity_select, lazy_tabs, memoize, plotly_chart
+
 # 📌 🚀 Page Configuration
 st.set_page_config(page_title="Purchase Evolution", layout="wide")
+start_page("evolution")
 
-# 📌 🚀 Function to Load Data
-
-
-@st.cache_data
-def load_data():
-    file_path = "df_new_3.csv"  # Replace with the correct path
-    try:
-        df = pd.read_csv(file_path)
-        df["Creation Date"] = pd.to_datetime(
-            df["Creation Date"], errors='coerce')
-        return df
-    except FileNotFoundError:
-        st.error("Error: File 'df_new_3.csv' not found!")
-        return pd.DataFrame()  # Returns an empty DataFrame
-
-
-# Load the data
-df = load_data()
-
-if df.empty:
+# Check the shared dataset
+if not data_available():
     st.warning("No data available for display.")
     st.stop()
 
+with stage("load"):
+    cube_index = load_cube_index()
+
 # 📌 🚀 Create Interactive Filters
 st.sidebar.header("Filters")
-date_range = st.sidebar.date_input("Select Date Range", [
-                                   df["Creation Date"].min(), df["Creation Date"].max()])
+date_range = st.sidebar.date_input(
+    "Select Date Range", cube_index.date_bounds())
+granularity = granularity_select()
+progressive = progressive_toggle()
 
 # Apply filters if selected
-filtered_df = df.copy()
-if date_range:
-    filtered_df = filtered_df[(filtered_df["Creation Date"] >= pd.to_datetime(date_range[0])) &
-                              (filtered_df["Creation Date"] <= pd.to_datetime(date_range[1]))]
+with stage("filter"):
+    filter_state = filter_key(date_range=date_range, granularity=granularity)
+    cube_selection = progressive_select(cube_index, date_range=date_range,
+                                        progressive=progressive)
 
 # 📌 🚀 Create Tabs for Organization
-tabs = st.tabs(["📈 Purchase Evolution", "📊 Price Trends",
-               "📉 Department Comparisons", "🔎 Peak Purchase Analysis"])
-
-with tabs[0]:
-    st.subheader("📈 Total Purchases Over Time")
-    trend_data = filtered_df.groupby("Creation Date")[
-        "Extended Price"].sum().reset_index()
-    fig_trend = px.line(trend_data, x="Creation Date",
-                        y="Extended Price", title="Total Purchase Evolution")
-    st.plotly_chart(fig_trend)
-
-with tabs[1]:
-    st.subheader("📊 Average Prices Over Time")
-    price_trend = filtered_df.groupby("Creation Date")[
-        "Unit Price"].mean().reset_index()
-    fig_price_trend = px.line(price_trend, x="Creation Date",
-                              y="Unit Price", title="Average Prices Over Time")
-    st.plotly_chart(fig_price_trend)
-
-with tabs[2]:
-    st.subheader("📉 Purchase Comparison Between Departments")
-    dept_trend = filtered_df.groupby(["Creation Date", "Department"])[
-        "Extended Price"].sum().reset_index()
-    fig_dept_trend = px.line(dept_trend, x="Creation Date", y="Extended Price", color="Department",
-                             title="Purchase Comparison Between Departments")
-    st.plotly_chart(fig_dept_trend)
-
-with tabs[3]:
-    st.subheader("🔎 Identification of Purchase Peaks")
-    peak_purchases = filtered_df.groupby("Creation Date")[
-        "Extended Price"].sum().reset_index()
+tabs = lazy_tabs(["📈 Purchase Evolution", "📊 Price Trends",
+                  "📉 Department Comparisons", "🔎 Peak Purchase Analysis"], key="evolution_tabs")
+
+
+def purchase_evolution_chart():
+    trend_data = time_rollup(cube_selection, ["Creation Date"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(trend_data, x="Creation Date",
+                       y="Extended Price", title="Total Purchase Evolution")
+
+
+def price_trends_chart():
+    price_trend = time_rollup(cube_selection, ["Creation Date"], {
+        "Unit Price": ("Unit Price", "mean")}, granularity)
+    return line_figure(price_trend, x="Creation Date",
+                       y="Unit Price", title="Average Prices Over Time")
+
+
+def department_comparisons_chart():
+    dept_trend = time_rollup(cube_selection, ["Creation Date", "Department"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(dept_trend, x="Creation Date", y="Extended Price", color="Department",
+                       title="Purchase Comparison Between Departments")
+
+
+def peak_purchases_chart():
+    peak_purchases = rollup(cube_selection, ["Creation Date"], {
+        "Extended Price": ("Extended Price", "sum")})
     peak_purchases = peak_purchases.sort_values(
         "Extended Price", ascending=False).head(10)
-    fig_peaks = px.bar(peak_purchases, x="Creation Date",
-                       y="Extended Price", title="Days with Highest Purchase Volume")
-    st.plotly_chart(fig_peaks)
+    return px.bar(peak_purchases, x="Creation Date",
+                  y="Extended Price", title="Days with Highest Purchase Volume")
+
+
+if tabs[0].open:
+    with tabs[0]:
+        st.subheader("📈 Total Purchases Over Time")
+        plotly_chart(memoize("evolution/purchase_evolution",
+                     filter_state, purchase_evolution_chart))
+
+if tabs[1].open:
+    with tabs[1]:
+        st.subheader("📊 Average Prices Over Time")
+        plotly_chart(memoize("evolution/price_trends",
+                     filter_state, price_trends_chart))
+
+if tabs[2].open:
+    with tabs[2]:
+        st.subheader("📉 Purchase Comparison Between Departments")
+        plotly_chart(memoize("evolution/department_comparisons",
+                     filter_state, department_comparisons_chart))
+
+if tabs[3].open:
+    with tabs[3]:
+        st.subheader("🔎 Identification of Purchase Peaks")
+        plotly_chart(memoize("evolution/peak_purchases",
+                     filter_state, peak_purchases_chart))
+
+debug_panel()
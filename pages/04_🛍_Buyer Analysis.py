@@ -1,121 +1,184 @@
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
+from core.cube import time_rollup, top_n
+from core.data import data_available
+from core.filters import filter_key, load_cube_index, load_data_index
+from core.growth import trend_figure, trend_matrix, trend_metric_radio
+from core.metrics import debug_panel, stage, start_page
+from core.progressive import progressive_select, progressive_toggle
+from core.reduce import line_figure
+from core.sketches import (approximate_title, approximate_toggle, ranking,
+                            sketch_selection)
+from core.ui import granularity_select, lazy_tabs, memoize, plotly_chart
+
 # 📌 🚀 Page Configuration
 st.set_page_config(page_title="Buyer Analysis", layout="wide")
+start_page("buyer")
 
-# 📌 🚀 Function to Load Data
-
-
-@st.cache_data
-def load_data():
-    file_path = "df_new_3.csv"  # Replace with the correct path
-    try:
-        df = pd.read_csv(file_path)
-        df["Creation Date"] = pd.to_datetime(
-            df["Creation Date"], errors='coerce')
-        df["Buyer"] = df["Buyer: First Name"] + " " + df["Buyer: Last Name"]
-        return df
-    except FileNotFoundError:
-        st.error("Error: File 'df_new_3.csv' not found!")
-        return pd.DataFrame()  # Returns an empty DataFrame
-
-
-# Load the data
-df = load_data()
-
-if df.empty:
+# Check the shared dataset
+if not data_available():
     st.warning("No data available for display.")
     st.stop()
 
+with stage("load"):
+    data_index = load_data_index()
+    cube_index = load_cube_index()
+
 # 📌 🚀 Create Interactive Filters
 st.sidebar.header("Filters")
-selected_buyer = st.sidebar.multiselect("Select Buyer", df["Buyer"].unique())
+selected_buyer = st.sidebar.multiselect(
+    "Select Buyer", data_index.options("Buyer"))
 selected_department = st.sidebar.multiselect(
-    "Select Department", df["Department"].unique())
-date_range = st.sidebar.date_input("Select Date Range", [
-                                   df["Creation Date"].min(), df["Creation Date"].max()])
+    "Select Department", data_index.options("Department"))
+date_range = st.sidebar.date_input(
+    "Select Date Range", data_index.date_bounds())
+granularity = granularity_select()
+approximate = approximate_toggle()
+progressive = progressive_toggle()
 
 # Apply filters if selected
-filtered_df = df.copy()
-if selected_buyer:
-    filtered_df = filtered_df[filtered_df["Buyer"].isin(selected_buyer)]
-if selected_department:
-    filtered_df = filtered_df[filtered_df["Department"].isin(
-        selected_department)]
-if date_range:
-    filtered_df = filtered_df[(filtered_df["Creation Date"] >= pd.to_datetime(date_range[0])) &
-                              (filtered_df["Creation Date"] <= pd.to_datetime(date_range[1]))]
+filters = {"Buyer": selected_buyer, "Department": selected_department}
+with stage("filter"):
+    sketches = sketch_selection(filters, date_range, approximate)
+    filter_state = filter_key(filters, date_range, granularity=granularity,
+                              approximate=sketches is not None)
+    cube_selection = progressive_select(cube_index, filters, date_range, progressive)
+    # Row-level data is only read by the exact product-level insights
+    filtered_rows = progressive_select(data_index, filters, date_range, progressive,
+                                       rows=True)
 
 # 📌 🚀 Create Tabs for Organization
-tabs = st.tabs(["🛍 Top Buyers", "📈 Purchase Trends", "📊 Purchases by Category",
-               "🚀 Fastest Growing Buyers", "🔍 Product and Department Insights"])
+tabs = lazy_tabs(["🛍 Top Buyers", "📈 Purchase Trends", "📊 Purchases by Category",
+                  "🚀 Fastest Growing Buyers", "🔍 Product and Department Insights",
+                  "📈 Category Growth"], key="buyer_tabs")
+
 
-with tabs[0]:
-    st.subheader("🛍 Top 10 Buyers with Most Orders")
-    top_buyers = filtered_df["Buyer"].value_counts().reset_index().head(10)
+def top_buyers_chart():
+    top_buyers = ranking(cube_selection, sketches, "Buyer", 10)
     top_buyers.columns = ["Buyer", "Number of Orders"]
-    fig_top_buyers = px.bar(top_buyers, x="Number of Orders", y="Buyer", orientation='h',
-                            color="Number of Orders", title="Top 10 Buyers", height=500, color_continuous_scale="blues")
-    st.plotly_chart(fig_top_buyers)
-
-with tabs[1]:
-    st.subheader("📈 Purchase Trends by Buyer")
-    df_buyer_trend = filtered_df.groupby(["Creation Date", "Buyer"]).agg(
-        {"Extended Price": "sum"}).reset_index()
-    fig_buyer_trend = px.line(df_buyer_trend, x="Creation Date", y="Extended Price", color="Buyer",
-                              title="Purchase Trends by Buyer")
-    st.plotly_chart(fig_buyer_trend)
-
-with tabs[2]:
-    st.subheader("📊 Purchase Evolution by Product Category")
-    top_items = filtered_df["Item Type"].value_counts().head(5).index
-    df_top_items = filtered_df[filtered_df["Item Type"].isin(top_items)]
-    df_items_trend = df_top_items.groupby(["Creation Date", "Item Type"])[
-        "Extended Price"].sum().reset_index()
-    fig_items_trend = px.line(df_items_trend, x="Creation Date", y="Extended Price", color="Item Type",
-                              title="Purchase Evolution by Product Category")
-    st.plotly_chart(fig_items_trend)
-
-with tabs[3]:
-    st.subheader("🚀 Buyers with Fastest Growth in Orders")
-    top_buyers_growth = filtered_df["Buyer"].value_counts(
-    ).reset_index().head(5)
-    top_buyers_growth.columns = ["Buyer", "Number of Orders"]
-    df_top_growth = filtered_df[filtered_df["Buyer"].isin(
-        top_buyers_growth["Buyer"])]
-    df_growth_trend = df_top_growth.groupby(["Creation Date", "Buyer"])[
-        "Extended Price"].sum().reset_index()
-    fig_growth_trend = px.line(df_growth_trend, x="Creation Date", y="Extended Price", color="Buyer",
-                               title="Growth in Purchases by Buyer")
-    st.plotly_chart(fig_growth_trend)
-
-with tabs[4]:
-    st.subheader("🔍 Product and Department Insights")
-    unique_products = filtered_df["Product Description"].nunique()
-    unique_departments = filtered_df["Department"].nunique()
-
-    st.metric("Unique Products", unique_products)
-    st.metric("Unique Departments", unique_departments)
-
-    top_products = filtered_df["Product Description"].value_counts(
-    ).reset_index().head(10)
+    return px.bar(top_buyers, x="Number of Orders", y="Buyer", orientation='h',
+                  color="Number of Orders", title=approximate_title("Top 10 Buyers", top_buyers), height=500, color_continuous_scale="blues")
+
+
+def buyer_trends_chart():
+    df_buyer_trend = time_rollup(cube_selection, ["Creation Date", "Buyer"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(df_buyer_trend, x="Creation Date", y="Extended Price", color="Buyer",
+                       title="Purchase Trends by Buyer")
+
+
+def category_trends_chart():
+    top_items = top_n(cube_selection, "Item Type", 5)["Item Type"]
+    df_top_items = cube_selection.where({"Item Type": top_items})
+    df_items_trend = time_rollup(df_top_items, ["Creation Date", "Item Type"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(df_items_trend, x="Creation Date", y="Extended Price", color="Item Type",
+                       title="Purchase Evolution by Product Category")
+
+
+def buyer_growth_charts(metric):
+    buyer_trends = trend_matrix(cube_selection, "Buyer", granularity=granularity)
+    fig_ranking = trend_figure(buyer_trends, metric,
+                               title="Fastest Growing and Declining Buyers by Orders")
+    fastest_buyers = buyer_trends.rank(metric, 5)["Buyer"]
+    df_top_growth = cube_selection.where({"Buyer": fastest_buyers})
+    df_growth_trend = time_rollup(df_top_growth, ["Creation Date", "Buyer"], {
+        "Number of Orders": (None, "lines")}, buyer_trends.granularity)
+    fig_growth = line_figure(df_growth_trend, x="Creation Date", y="Number of Orders", color="Buyer",
+                             title="Orders of the 5 Fastest Growing Buyers")
+    return fig_ranking, fig_growth
+
+
+def product_insights():
+    if sketches is None:
+        df_products = filtered_rows.aggregate(["Department", "Product Description"], {
+            "Number of Purchases": (None, "size"), "Quantity": ("Quantity", "sum"),
+            "Extended Price": ("Extended Price", "sum")})
+        purchases_by_product = df_products.groupby(
+            "Product Description", observed=True)["Number of Purchases"].sum()
+        unique_products = len(purchases_by_product)
+        unique_departments = cube_selection.nunique("Department")
+        top_products = purchases_by_product.sort_values(
+            ascending=False, kind="stable").reset_index().head(10)
+        top_products_by_department = df_products.dropna(subset=["Department", "Product Description"])[
+            ["Department", "Product Description", "Quantity", "Extended Price"]]
+        top_products_by_department = top_products_by_department.sort_values(
+            by=["Department", "Extended Price"], ascending=[True, False]).groupby("Department", observed=True).head(10)
+    else:
+        unique_products = sketches.nunique("Product Description")
+        unique_departments = sketches.nunique("Department")
+        top_products = sketches.top_n("Product Description", 10)
+        # Ranked by order lines, the only count the sketches bound.
+        top_products_by_department = sketches.top_n_by(
+            "Product Description", "Department", 10).rename(columns={"value": "Number of Purchases"})
     top_products.columns = ["Product Description", "Number of Purchases"]
     fig_top_products = px.bar(top_products, x="Number of Purchases", y="Product Description", orientation='h',
-                              color="Number of Purchases", title="Top 10 Most Purchased Products", height=500, color_continuous_scale="viridis")
-    st.plotly_chart(fig_top_products)
+                              color="Number of Purchases", title=approximate_title("Top 10 Most Purchased Products", top_products), height=500, color_continuous_scale="viridis")
 
-    top_departments = filtered_df["Department"].value_counts(
-    ).reset_index().head(10)
+    top_departments = ranking(cube_selection, sketches, "Department", 10)
     top_departments.columns = ["Department", "Number of Purchases"]
     fig_top_departments = px.bar(top_departments, x="Number of Purchases", y="Department", orientation='h',
-                                 color="Number of Purchases", title="Top 10 Departments with Most Purchases", height=500, color_continuous_scale="plasma")
-    st.plotly_chart(fig_top_departments)
-
-    st.subheader("📋 Top 10 Products Purchased by Department")
-    top_products_by_department = filtered_df.groupby(["Department", "Product Description"]).agg(
-        {"Quantity": "sum", "Extended Price": "sum"}).reset_index()
-    top_products_by_department = top_products_by_department.sort_values(
-        by=["Department", "Extended Price"], ascending=[True, False]).groupby("Department").head(10)
-    st.dataframe(top_products_by_department)
+                                 color="Number of Purchases", title=approximate_title("Top 10 Departments with Most Purchases", top_departments), height=500, color_continuous_scale="plasma")
+
+    return unique_products, unique_departments, fig_top_products, fig_top_departments, top_products_by_department
+
+
+def category_growth_chart(metric):
+    item_trends = trend_matrix(cube_selection, "Item Type", "Extended Price", "sum",
+                               granularity)
+    return trend_figure(item_trends, metric, title="Fastest Growing and Declining Product Categories by Spending")
+
+
+if tabs[0].open:
+    with tabs[0]:
+        st.subheader("🛍 Top 10 Buyers with Most Orders")
+        plotly_chart(memoize("buyer/top_buyers",
+                     filter_state, top_buyers_chart))
+
+if tabs[1].open:
+    with tabs[1]:
+        st.subheader("📈 Purchase Trends by Buyer")
+        plotly_chart(memoize("buyer/buyer_trends",
+                     filter_state, buyer_trends_chart))
+
+if tabs[2].open:
+    with tabs[2]:
+        st.subheader("📊 Purchase Evolution by Product Category")
+        plotly_chart(memoize("buyer/category_trends",
+                     filter_state, category_trends_chart))
+
+if tabs[3].open:
+    with tabs[3]:
+        st.subheader("🚀 Buyers with Fastest Growth in Orders")
+        growth_metric = trend_metric_radio("buyer_growth_metric")
+        fig_ranking, fig_growth = memoize("buyer/buyer_growth", (filter_state, growth_metric),
+                                          lambda: buyer_growth_charts(growth_metric))
+        plotly_chart(fig_ranking)
+        plotly_chart(fig_growth)
+
+if tabs[4].open:
+    with tabs[4]:
+        st.subheader("🔍 Product and Department Insights")
+        (unique_products, unique_departments, fig_top_products, fig_top_departments,
+         top_products_by_department) = memoize("buyer/product_insights", filter_state, product_insights)
+
+        st.metric("Unique Products", str(unique_products))
+        st.metric("Unique Departments", str(unique_departments))
+        plotly_chart(fig_top_products)
+        plotly_chart(fig_top_departments)
+
+        st.subheader("📋 Top 10 Products Purchased by Department")
+        if "error" in top_products_by_department.attrs:
+            st.caption(approximate_title("Most purchased products of each department by order lines",
+                                         top_products_by_department))
+        st.dataframe(top_products_by_department)
+
+if tabs[5].open:
+    with tabs[5]:
+        st.subheader("📈 Product Categories with Fastest Growth in Spending")
+        category_metric = trend_metric_radio("category_growth_metric")
+        plotly_chart(memoize("buyer/category_growth", (filter_state, category_metric),
+                             lambda: category_growth_chart(category_metric)))
+
+debug_panel()
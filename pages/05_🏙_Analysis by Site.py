@@ -1,65 +1,89 @@
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
+from core.cube import time_rollup
+from core.data import data_available
+from core.filters import filter_key, load_cube_index
+from core.growth import trend_figure, trend_matrix, trend_metric_radio
+from core.metrics import debug_panel, stage, start_page
+from core.progressive import progressive_select, progressive_toggle
+from core.reduce import line_figure
+from core.sketches import (approximate_title, approximate_toggle, ranking,
+                            sketch_selection)
+from core.ui import granularity_select, lazy_tabs, memoize, plotly_chart
+
 # 📌 🚀 Page Configuration
 st.set_page_config(page_title="City Analysis", layout="wide")
+start_page("site")
 
-# 📌 🚀 Function to Load Data
-
-
-@st.cache_data
-def load_data():
-    file_path = "df_new_3.csv"  # Replace with the correct path
-    try:
-        df = pd.read_csv(file_path)
-        df["Creation Date"] = pd.to_datetime(
-            df["Creation Date"], errors='coerce')
-        return df
-    except FileNotFoundError:
-        st.error("Error: File 'df_new_3.csv' not found!")
-        return pd.DataFrame()  # Returns an empty DataFrame
-
-
-# Load the data
-df = load_data()
-
-if df.empty:
+# Check the shared dataset
+if not data_available():
     st.warning("No data available for display.")
     st.stop()
 
+with stage("load"):
+    cube_index = load_cube_index()
+
 # 📌 🚀 Create Interactive Filters
 st.sidebar.header("Filters")
 selected_city = st.sidebar.multiselect(
-    "Select Site", df["ShipTo City"].unique())
-date_range = st.sidebar.date_input("Select Date Range", [
-                                   df["Creation Date"].min(), df["Creation Date"].max()])
+    "Select Site", cube_index.options("ShipTo City"))
+date_range = st.sidebar.date_input(
+    "Select Date Range", cube_index.date_bounds())
+granularity = granularity_select()
+approximate = approximate_toggle()
+progressive = progressive_toggle()
 
 # Apply filters if selected
-filtered_df = df.copy()
-if selected_city:
-    filtered_df = filtered_df[filtered_df["ShipTo City"].isin(selected_city)]
-if date_range:
-    filtered_df = filtered_df[(filtered_df["Creation Date"] >= pd.to_datetime(date_range[0])) &
-                              (filtered_df["Creation Date"] <= pd.to_datetime(date_range[1]))]
+filters = {"ShipTo City": selected_city}
+with stage("filter"):
+    sketches = sketch_selection(filters, date_range, approximate)
+    filter_state = filter_key(filters, date_range, granularity=granularity,
+                              approximate=sketches is not None)
+    cube_selection = progressive_select(cube_index, filters, date_range, progressive)
 
 # 📌 🚀 Create Tabs for Organization
-tabs = st.tabs(["🏙 Site with Most Orders",
-               "📈 Purchase Trends by Site"])
+tabs = lazy_tabs(["🏙 Site with Most Orders",
+                  "📈 Purchase Trends by Site", "🚀 Site Growth"], key="site_tabs")
 
-with tabs[0]:
-    st.subheader("🏙 Top 10 Site with Most Orders")
-    top_cities = filtered_df["ShipTo City"].value_counts(
-    ).reset_index().head(10)
+
+def top_cities_chart():
+    top_cities = ranking(cube_selection, sketches, "ShipTo City", 10)
     top_cities.columns = ["City", "Number of Orders"]
-    fig_top_cities = px.bar(top_cities, x="Number of Orders", y="City", orientation='h',
-                            color="Number of Orders", title="Top 10 Cities with Most Orders", height=500, color_continuous_scale="magma")
-    st.plotly_chart(fig_top_cities)
-
-with tabs[1]:
-    st.subheader("📈 Purchase Trends by Site")
-    df_cities_trend = filtered_df.groupby(["Creation Date", "ShipTo City"]).agg({
-        "Extended Price": "sum"}).reset_index()
-    fig_cities_trend = px.line(df_cities_trend, x="Creation Date", y="Extended Price", color="ShipTo City",
-                               title="Purchase Trends by Site")
-    st.plotly_chart(fig_cities_trend)
+    return px.bar(top_cities, x="Number of Orders", y="City", orientation='h',
+                  color="Number of Orders", title=approximate_title("Top 10 Cities with Most Orders", top_cities), height=500, color_continuous_scale="magma")
+
+
+def city_trends_chart():
+    df_cities_trend = time_rollup(cube_selection, ["Creation Date", "ShipTo City"], {
+        "Extended Price": ("Extended Price", "sum")}, granularity)
+    return line_figure(df_cities_trend, x="Creation Date", y="Extended Price", color="ShipTo City",
+                       title="Purchase Trends by Site")
+
+
+def city_growth_chart(metric):
+    city_trends = trend_matrix(cube_selection, "ShipTo City", granularity=granularity)
+    return trend_figure(city_trends, metric, title="Fastest Growing and Declining Sites by Orders",
+                        label="City")
+
+
+if tabs[0].open:
+    with tabs[0]:
+        st.subheader("🏙 Top 10 Site with Most Orders")
+        plotly_chart(memoize("site/top_cities",
+                     filter_state, top_cities_chart))
+
+if tabs[1].open:
+    with tabs[1]:
+        st.subheader("📈 Purchase Trends by Site")
+        plotly_chart(memoize("site/city_trends",
+                     filter_state, city_trends_chart))
+
+if tabs[2].open:
+    with tabs[2]:
+        st.subheader("🚀 Sites with Fastest Growth in Orders")
+        growth_metric = trend_metric_radio("site_growth_metric")
+        plotly_chart(memoize("site/city_growth", (filter_state, growth_metric),
+                             lambda: city_growth_chart(growth_metric)))
+
+debug_panel()
@@ -0,0 +1,71 @@
+import streamlit as st
+import pandas as pd
+
+from core.data import data_available, dataset_version
+from core.filters import load_cube_index
+from core.forecasting import (SEGMENT_DIMENSIONS, load_batch,
+                              segment_forecaster, segment_series)
+from core.metrics import debug_panel, stage, start_page
+from core.models import wait_for
+from core.reduce import line_figure
+from core.ui import lazy_tabs, plotly_chart
+
+# 📌 🚀 Page Configuration
+st.set_page_config(page_title="Segment Forecasts", layout="wide")
+start_page("segments")
+
+# Check the shared dataset
+if not data_available():
+    st.warning("No data available for display.")
+    st.stop()
+
+with stage("load"):
+    cube = load_cube_index().select()
+    version = dataset_version()
+
+# 📌 🚀 Create Interactive Filters
+st.sidebar.header("Filters")
+dimension = st.sidebar.selectbox("Forecast by", list(SEGMENT_DIMENSIONS))
+
+# Forecasts are fitted once per dataset version, in the background
+batch = load_batch(dimension, version)
+if batch is None:
+    forecaster = segment_forecaster()
+    batch_key = forecaster.start(cube, dimension, version)
+    wait_for(batch_key, f"Fitting forecasts per {dimension} in the background...",
+             store=forecaster)
+    st.stop()
+
+forecasts, parameters = batch
+fitted_segments = parameters.loc[parameters["status"] == "ok", "Segment"].tolist()
+selected_segments = st.sidebar.multiselect(
+    "Select Segment", fitted_segments, default=fitted_segments[:5])
+
+# 📌 🚀 Create Tabs for Organization
+tabs = lazy_tabs(["🔮 Segment Forecasts", "⚙️ Model Parameters"],
+                 key="forecast_tabs")
+
+if tabs[0].open:
+    with tabs[0]:
+        st.subheader(f"🔮 Daily Purchase Forecast by {dimension}")
+        history = segment_series(cube, dimension, selected_segments).tail(180)
+        history = history.reset_index().melt(
+            id_vars="Creation Date", var_name="Segment", value_name="Extended Price")
+        history["Series"] = "Actual"
+        forecast = forecasts[forecasts["Segment"].isin(selected_segments)].rename(
+            columns={"Forecast": "Extended Price"})
+        forecast["Series"] = "Forecast"
+        df_forecast = pd.concat([history.astype({"Segment": str}), forecast],
+                                ignore_index=True)
+        df_forecast["Segment"] = df_forecast["Segment"] + \
+            " (" + df_forecast["Series"] + ")"
+        fig_forecast = line_figure(df_forecast, x="Creation Date", y="Extended Price", color="Segment",
+                                   title=f"Actual and Forecast Purchases by {dimension}")
+        plotly_chart(fig_forecast)
+
+if tabs[1].open:
+    with tabs[1]:
+        st.subheader("⚙️ Fitted Model Parameters")
+        st.dataframe(parameters)
+
+debug_panel()
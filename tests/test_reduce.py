@@ -0,0 +1,32 @@
+import pandas as pd
+import plotly.graph_objects as go
+
+from core.reduce import BOX_STATS, box_figure, box_stats
+
+
+def lines():
+    return pd.DataFrame({
+        "Department": pd.Categorical(["IT", "IT", "IT", "Legal", "Legal"]),
+        "Extended Price": [10.0, 12.0, 500.0, 7.0, 9.0]})
+
+
+def test_box_stats_per_group():
+    stats, outliers = box_stats(lines(), "Department", "Extended Price")
+    assert list(stats.columns) == BOX_STATS
+    assert list(stats.index) == ["IT", "Legal"]
+    assert stats.loc["Legal", "median"] == 8.0
+
+
+def test_box_stats_of_empty_selection():
+    empty = lines().iloc[:0]
+    stats, outliers = box_stats(empty, "Department", "Extended Price")
+    assert list(stats.columns) == BOX_STATS
+    assert stats.empty and outliers.empty
+
+
+def test_box_figure_of_empty_selection():
+    fig = box_figure(lines().iloc[:0], "Department", "Extended Price",
+                     title="Expense Variation by Department")
+    assert isinstance(fig, go.Figure)
+    assert not fig.data
+    assert fig.layout.title.text == "Expense Variation by Department"